@@ -6,7 +6,7 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[('config.py', '.'), ('assets/Discord-Logo.ico', 'assets')],
-    hiddenimports=['tkinter', 'customtkinter', 'requests', 'pytz', 'websocket', 'websocket._app', 'threading', 'json', 'datetime'],
+    hiddenimports=['tkinter', 'customtkinter', 'requests', 'pytz', 'websockets', 'websockets.sync.client', 'websockets.extensions.permessage_deflate', 'threading', 'json', 'datetime'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -61,8 +61,9 @@ def build_server_gui_exe():
         "--hidden-import=customtkinter",
         "--hidden-import=requests",
         "--hidden-import=pytz",
-        "--hidden-import=websocket",
-        "--hidden-import=websocket._app",
+        "--hidden-import=websockets",
+        "--hidden-import=websockets.sync.client",
+        "--hidden-import=websockets.extensions.permessage_deflate",
         "--hidden-import=threading",
         "--hidden-import=json",
         "--hidden-import=datetime",
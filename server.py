@@ -1,14 +1,35 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 import asyncio
+import atexit
 import json
-from datetime import datetime, timedelta
+import logging
+import uuid
+import heapq
+import random
+import stat
+import struct
+import tempfile
+import time
+from bisect import bisect_left, bisect_right
+from collections import deque
+from contextlib import asynccontextmanager
+from itertools import islice
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+from datetime import datetime, timedelta, timezone
 import pytz
-from pymongo import MongoClient, DESCENDING
+import pymongo
+from pymongo import MongoClient, UpdateOne, ASCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from bson import ObjectId
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 import os
 import sys
-from typing import List
+from typing import Callable, Dict, List, Optional
 
 # Try to import from config.py
 try:
@@ -30,24 +51,541 @@ PORT = int(os.getenv('PORT', 8088))
 # Timezone configuration - Vietnam
 VIETNAM_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
 
-# MongoDB connection
-try:
-    client = MongoClient(
-        MONGODB_URI, 
-        serverSelectionTimeoutMS=10000,
-        tls=True,
-        tlsAllowInvalidCertificates=True
-    )
-    db = client[DATABASE_NAME]
-    collection = db[COLLECTION_NAME]
-    selected_collection = db['selected_list']  # Collection mới cho selected list
-    client.admin.command('ping')
-    print("✓ Connected to MongoDB successfully!")
-except Exception as e:
-    print(f"✗ MongoDB connection error: {e}")
-    sys.exit(1)
+# Logging: mỗi log là một event có cấu trúc (tên event + field), ghi ra stdout
+# bởi một thread riêng qua hàng đợi nên event loop không bao giờ bị block khi
+# stdout (pipe trên Render) ghi chậm. LOG_FORMAT=text cho log dễ đọc khi chạy local.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # json | text
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))  # Record chờ ghi tối đa, đầy thì bỏ
+# Tỉ lệ giữ lại của các event trên hot path, theo tên event hoặc prefix (vd. "ingest"
+# áp dụng cho "ingest.change"). WARNING trở lên luôn được ghi.
+LOG_SAMPLING = os.getenv('LOG_SAMPLING', 'ingest=0.1,broadcast=0.1,auto_off.machine=0.2')
+
+log = logging.getLogger("vmix")
+log_stats = {"emitted": 0, "sampled_out": 0, "dropped": 0}
+
+def parse_log_sampling(value: str) -> Dict[str, float]:
+    rates = {}
+    for item in value.split(","):
+        event, _, rate = item.partition("=")
+        if event.strip() and rate.strip():
+            rates[event.strip()] = max(0.0, min(1.0, float(rate)))
+    return rates
+
+log_sampling = parse_log_sampling(LOG_SAMPLING)
+_sample_rate_cache = {}
+
+def sample_rate(event: str) -> float:
+    """Tỉ lệ sampling của event: khớp tên đầy đủ trước, rồi tới prefix dài nhất"""
+    rate = _sample_rate_cache.get(event)
+    if rate is None:
+        rate = 1.0
+        parts = event.split(".")
+        for i in range(len(parts), 0, -1):
+            prefix = ".".join(parts[:i])
+            if prefix in log_sampling:
+                rate = log_sampling[prefix]
+                break
+        _sample_rate_cache[event] = rate
+    return rate
+
+def log_event(level: int, event: str, message: str, **fields):
+    """Ghi một log event. Trên hot path nên dùng message cố định và đưa giá
+    trị vào fields: event bị sampling loại thì không tốn gì thêm."""
+    if not log.isEnabledFor(level):
+        return
+    rate = sample_rate(event) if level < logging.WARNING else 1.0
+    if rate < 1.0 and random.random() >= rate:
+        log_stats["sampled_out"] += 1
+        return
+    log_stats["emitted"] += 1
+    log.log(level, message, extra={"event": event, "fields": fields, "sample_rate": rate})
+
+def log_debug(event: str, message: str, **fields):
+    log_event(logging.DEBUG, event, message, **fields)
+
+def log_info(event: str, message: str, **fields):
+    log_event(logging.INFO, event, message, **fields)
+
+def log_warning(event: str, message: str, **fields):
+    log_event(logging.WARNING, event, message, **fields)
+
+def log_error(event: str, message: str, **fields):
+    log_event(logging.ERROR, event, message, **fields)
+
+class JsonLogFormatter(logging.Formatter):
+    """Một dòng JSON mỗi event: ts, level, event, msg và các field"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, VIETNAM_TZ).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "event": getattr(record, "event", record.name),
+            "msg": record.getMessage()
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        rate = getattr(record, "sample_rate", 1.0)
+        if rate < 1.0:
+            entry["sample_rate"] = rate  # Mỗi dòng đại diện cho ~1/rate event
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextLogFormatter(logging.Formatter):
+    """Format dễ đọc khi chạy local: icon theo level, message rồi các field"""
+    ICONS = {logging.DEBUG: "·", logging.INFO: "✓", logging.WARNING: "⚠", logging.ERROR: "✗", logging.CRITICAL: "✗"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = f"{self.ICONS.get(record.levelno, '')} {record.getMessage()}"
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler không bao giờ block: hàng đợi đầy (stdout quá chậm) thì bỏ record"""
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            log_stats["dropped"] += 1
+
+_log_listener = None
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, stream=None):
+    """Cấu hình logger "vmix": QueueHandler → thread QueueListener → stream (mặc định stdout)"""
+    global _log_listener
+    stop_logging()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonLogFormatter() if fmt == "json" else TextLogFormatter())
+    log_queue = Queue(LOG_QUEUE_SIZE)
+    log.handlers = [NonBlockingQueueHandler(log_queue)]
+    log.setLevel(level)
+    log.propagate = False
+    _log_listener = QueueListener(log_queue, handler)
+    _log_listener.start()
+
+def stop_logging():
+    """Ghi hết các record còn trong hàng đợi rồi dừng thread ghi log"""
+    global _log_listener
+    if _log_listener is not None:
+        try:
+            _log_listener.stop()
+        except Full:
+            pass
+        _log_listener = None
+
+setup_logging()
+atexit.register(stop_logging)
+
+# MongoDB pool / timeout configuration
+MONGO_POOL_SIZE = int(os.getenv('MONGO_POOL_SIZE', 16))  # Số thread + số connection tối đa
+MONGO_OP_TIMEOUT = float(os.getenv('MONGO_OP_TIMEOUT', 10))  # Timeout mỗi thao tác (giây)
+
+
+# Lịch sử thay đổi trạng thái: mỗi document = một máy trong một giờ
+HISTORY_COLLECTION = os.getenv('HISTORY_COLLECTION', 'status_history')
+HISTORY_BUCKET_MAX = int(os.getenv('HISTORY_BUCKET_MAX', 500))  # Số event tối đa mỗi bucket
+# Rollup thời gian ON/OFF theo máy, theo giờ và theo ngày
+UPTIME_COLLECTION = os.getenv('UPTIME_COLLECTION', 'uptime_rollups')
+UPTIME_CHECKPOINT_INTERVAL = float(os.getenv('UPTIME_CHECKPOINT_INTERVAL', 60))  # giây
+# Discord outbox: message chờ gửi được lưu trong collection này
+DISCORD_OUTBOX_COLLECTION = os.getenv('DISCORD_OUTBOX_COLLECTION', 'discord_outbox')
+DISCORD_MAX_ATTEMPTS = int(os.getenv('DISCORD_MAX_ATTEMPTS', 8))
+DISCORD_RETRY_BASE = float(os.getenv('DISCORD_RETRY_BASE', 2))  # giây, nhân đôi sau mỗi lần lỗi
+DISCORD_RETRY_MAX = float(os.getenv('DISCORD_RETRY_MAX', 300))
+DISCORD_TIMEOUT = float(os.getenv('DISCORD_TIMEOUT', 10))
+DISCORD_MESSAGE_MAX = 2000  # Giới hạn số ký tự content của Discord
+# Alert engine phía server: gửi Discord khi máy trong selected list đổi status/IPWAN
+# (giống AUTO SEND của server_gui_advanced.py). Tắt mặc định, bật bằng ALERTS_ENABLED=1.
+ALERTS_ENABLED = os.getenv('ALERTS_ENABLED', '0') == '1'
+ALERT_PREFIX = os.getenv('ALERT_PREFIX', os.getenv('PREFIX', 'SRT'))
+ALERT_WEBHOOK = os.getenv('ALERT_WEBHOOK', '')  # Mặc định dùng DISCORD_WEBHOOK
+ALERT_WINDOW = int(os.getenv('ALERT_WINDOW_MS', 200)) / 1000  # Gộp các thay đổi gần nhau vào một message
+ALERT_SELECTED_REFRESH = float(os.getenv('ALERT_SELECTED_REFRESH', 30))  # giây, đọc lại selected list
+
+# JSON serializer cho mọi response và WebSocket payload: orjson nếu có
+# (nhanh hơn stdlib vài lần), không thì stdlib json. JSON_SERIALIZER=json để ép dùng stdlib.
+JSON_SERIALIZER = os.getenv('JSON_SERIALIZER', 'orjson')
+orjson = None
+if JSON_SERIALIZER == 'orjson':
+    try:
+        import orjson
+    except ImportError:
+        log_warning("startup.serializer", "orjson not installed, falling back to stdlib json")
+# REST response lớn hơn ngưỡng này (bytes) được gzip nếu client hỗ trợ
+GZIP_MIN_SIZE = int(os.getenv('GZIP_MIN_SIZE', 1024))
+# Nén WebSocket message bằng permessage-deflate (nếu client đề nghị)
+WS_PER_MESSAGE_DEFLATE = os.getenv('WS_PER_MESSAGE_DEFLATE', '1') != '0'
+
+def dumps_bytes(obj) -> bytes:
+    """Serialize sang JSON UTF-8 (compact)"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def dumps_text(obj) -> str:
+    """Như dumps_bytes nhưng trả về str (cho WebSocket text frame)"""
+    return dumps_bytes(obj).decode("utf-8")
+
+
+# Metrics kiểu Prometheus (text exposition format) cho /metrics. Số liệu là
+# của từng process (mỗi uvicorn worker một bộ). observe()/inc() chỉ là vài
+# phép cộng trên list/dict nên gần như không tốn gì trên hot path
+# (đo bằng tools/bench_metrics.py).
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for values, total in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, values)} {total:g}")
+        return lines
+
+class HistogramSeries:
+    """Một series của Histogram đã gắn sẵn label - observe() không phải tra dict"""
+    __slots__ = ("_buckets", "_series")
+
+    def __init__(self, buckets: tuple, series: list):
+        self._buckets = buckets
+        self._series = series
+
+    def observe(self, value: float):
+        series = self._series
+        series[bisect_left(self._buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self.buckets = buckets
+        # label values -> [số observation của từng bucket (không cộng dồn)..., +Inf, sum, count]
+        self._series: Dict[tuple, list] = {}
+
+    def _get_series(self, label_values: tuple) -> list:
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 3)
+        return series
+
+    def labels(self, *label_values) -> HistogramSeries:
+        """Series gắn sẵn label cho hot path"""
+        return HistogramSeries(self.buckets, self._get_series(label_values))
+
+    def observe(self, value: float, *label_values):
+        series = self._get_series(label_values)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for values, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                bucket_labels = _format_labels(self.label_names, values, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, values)} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, values)} {series[-1]}")
+        return lines
+
+INGEST_SECONDS = Histogram("vmix_ingest_seconds", "Tổng thời gian xử lý một request ingest", ("endpoint",))
+INGEST_PHASE_SECONDS = Histogram(
+    "vmix_ingest_phase_seconds",
+    "Thời gian ingest theo phase: parse (build, chờ ingest lock, diff với pre-image lấy từ "
+    "fleet state trong bộ nhớ), mongo_write (chỉ update_one/bulk_write), broadcast (áp dụng "
+    "state qua bus và đưa vào delta feed)",
+    ("endpoint", "phase")
+)
+WS_FANOUT_SECONDS = Histogram("vmix_ws_fanout_seconds", "Thời gian gửi một payload tới mọi WebSocket client")
+WS_SEND_SECONDS = Histogram("vmix_ws_send_seconds", "Thời gian gửi một payload tới một WebSocket client")
+AUTO_OFF_SECONDS = Histogram("vmix_auto_off_sweep_seconds", "Thời gian một lần auto-OFF sweep")
+AUTO_OFF_MACHINES = Counter("vmix_auto_off_machines_total", "Số máy bị auto-OFF")
+MONGO_OPS = Counter("vmix_mongo_operations_total", "Số thao tác MongoDB theo loại", ("op",))
+MONGO_ERRORS = Counter("vmix_mongo_errors_total", "Số thao tác MongoDB bị lỗi/timeout theo loại", ("op",))
+MONGO_SECONDS = Histogram("vmix_mongo_operation_seconds", "Thời gian thao tác MongoDB theo loại", ("op",))
+# Series gắn sẵn label cho ingest: endpoint -> (total, parse, mongo_write, broadcast)
+INGEST_SERIES = {
+    endpoint: (INGEST_SECONDS.labels(endpoint),
+               *(INGEST_PHASE_SECONDS.labels(endpoint, phase) for phase in ("parse", "mongo_write", "broadcast")))
+    for endpoint in ("single", "batch")
+}
+WS_SEND_SERIES = WS_SEND_SECONDS.labels()
+WS_FANOUT_SERIES = WS_FANOUT_SECONDS.labels()
+METRICS = [INGEST_SECONDS, INGEST_PHASE_SECONDS, WS_FANOUT_SECONDS, WS_SEND_SECONDS,
+           AUTO_OFF_SECONDS, AUTO_OFF_MACHINES, MONGO_OPS, MONGO_ERRORS, MONGO_SECONDS]
+
+
+class MongoStore:
+    """Lớp truy cập MongoDB không chặn event loop.
+
+    pymongo là driver đồng bộ, nên mọi thao tác được chạy trong một
+    ThreadPoolExecutor riêng (kích thước = pool size của MongoClient) và
+    bị giới hạn bởi timeout cho từng thao tác.
+    """
+
+    def __init__(self, uri: str, database_name: str, collection_name: str,
+                 pool_size: int = MONGO_POOL_SIZE, op_timeout: float = MONGO_OP_TIMEOUT,
+                 tls: bool = True, client_factory=MongoClient):
+        self.uri = uri
+        self.database_name = database_name
+        self.collection_name = collection_name
+        self.pool_size = max(1, pool_size)
+        self.op_timeout = op_timeout
+        self.tls = tls
+        self.client_factory = client_factory  # vd. mongomock.MongoClient khi load test
+        self.client = None
+        self.db = None
+        self.logs = None
+        self.selected_list = None
+        self.history = None
+        self.uptime = None
+        self.outbox = None
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="mongo")
+
+    def connect(self):
+        """Tạo MongoClient và ping thử (chạy trong executor)"""
+        options = {
+            "serverSelectionTimeoutMS": 10000,
+            "maxPoolSize": self.pool_size,
+            # Timestamp lưu dạng BSON date, đọc ra là datetime giờ Việt Nam
+            "tz_aware": True,
+            "tzinfo": VIETNAM_TZ,
+        }
+        if self.tls:
+            options.update(tls=True, tlsAllowInvalidCertificates=True)
+        self.client = self.client_factory(self.uri, **options)
+        self.db = self.client[self.database_name]
+        self.logs = self.db[self.collection_name]
+        self.selected_list = self.db['selected_list']  # Collection mới cho selected list
+        self.history = self.db[HISTORY_COLLECTION]
+        self.uptime = self.db[UPTIME_COLLECTION]
+        self.outbox = self.db[DISCORD_OUTBOX_COLLECTION]
+        self.client.admin.command('ping')
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+        self._executor.shutdown(wait=False)
 
-app = FastAPI()
+    async def run(self, fn, *args, timeout: Optional[float] = None, **kwargs):
+        """Chạy một hàm pymongo trong executor với timeout riêng cho thao tác đó"""
+        timeout = self.op_timeout if timeout is None else timeout
+
+        def call():
+            # pymongo.timeout() áp dụng client-side timeout cho mọi lệnh bên trong
+            with pymongo.timeout(timeout):
+                return fn(*args, **kwargs)
+
+        op = getattr(fn, "__name__", "call")
+        MONGO_OPS.inc(op)
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            # Chặn thêm ở phía asyncio phòng trường hợp thread bị treo ngoài driver
+            return await asyncio.wait_for(loop.run_in_executor(self._executor, call), timeout + 1)
+        except Exception:
+            MONGO_ERRORS.inc(op)
+            raise
+        finally:
+            MONGO_SECONDS.observe(time.perf_counter() - start, op)
+
+    async def find_all(self, collection, query: dict, sort=None, limit: int = 0,
+                       timeout: Optional[float] = None) -> list:
+        """find() và đọc hết cursor trong executor (không iterate cursor trên event loop)"""
+        def find():
+            cursor = collection.find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            if limit:
+                cursor = cursor.limit(limit)
+            return list(cursor)
+
+        return await self.run(find, timeout=timeout)
+
+
+store = MongoStore(MONGODB_URI, DATABASE_NAME, COLLECTION_NAME)
+
+# Fail khi khởi động nếu một hot query phải COLLSCAN (đặt 0 để chỉ cảnh báo)
+INDEX_CHECK_STRICT = os.getenv('INDEX_CHECK_STRICT', '1') != '0'
+
+# Index cho collection logs: (keys, options)
+LOGS_INDEXES = [
+    # Ingest (upsert theo name)
+    ([("name", ASCENDING)], {"name": "name_1", "unique": True}),
+    # /delete, /update_ip, /get_by_ip tra MachineRegistry trong bộ nhớ; index
+    # này chỉ còn cho query thủ công theo ip/ip+port
+    ([("ip", ASCENDING), ("port", ASCENDING)], {"name": "ip_1_port_1"}),
+    # Đọc lại các máy vừa bị auto-OFF theo sweep id
+    ([("auto_off_sweep", ASCENDING)], {"name": "auto_off_sweep_1", "sparse": True}),
+]
+
+# Index cho collection history: đọc theo máy + khoảng thời gian, ghi theo bucket
+# (không unique vì bucket đầy sẽ mở bucket mới trong cùng giờ)
+HISTORY_INDEXES = [
+    ([("name", ASCENDING), ("hour", ASCENDING), ("_id", ASCENDING)], {"name": "name_1_hour_1__id_1"}),
+]
+
+# Index cho rollup uptime: cả fleet theo khoảng thời gian, hoặc một máy
+UPTIME_INDEXES = [
+    ([("period", ASCENDING), ("start", ASCENDING), ("name", ASCENDING)], {"name": "period_1_start_1_name_1", "unique": True}),
+    ([("name", ASCENDING), ("period", ASCENDING), ("start", ASCENDING)], {"name": "name_1_period_1_start_1"}),
+]
+
+# Index cho Discord outbox: nạp lại message pending theo thứ tự tạo
+OUTBOX_INDEXES = [
+    ([("status", ASCENDING), ("created_at", ASCENDING)], {"name": "status_1_created_at_1"}),
+]
+
+# Các query nóng trên collection logs, phải luôn dùng được index
+HOT_QUERIES = {
+    "ingest_by_name": {"filter": {"name": "__probe__"}},
+    "auto_off_expired": {"filter": {
+        "$or": [{"name": "__probe__", "last_seen": {"$not": {"$gt": datetime(2000, 1, 1, tzinfo=timezone.utc)}}}],
+        "statusapp": 1
+    }},
+    "auto_off_affected": {"filter": {"auto_off_sweep": ObjectId("000000000000000000000000")}},
+    "history_range": {
+        "collection": "history",
+        "filter": {"name": "__probe__", "hour": {"$gte": datetime(2000, 1, 1, tzinfo=timezone.utc)}},
+        "sort": [("hour", ASCENDING), ("_id", ASCENDING)]
+    },
+    "uptime_fleet_range": {
+        "collection": "uptime",
+        "filter": {"period": "day", "start": {"$gte": datetime(2000, 1, 1, tzinfo=timezone.utc)}}
+    },
+    "uptime_machine_range": {
+        "collection": "uptime",
+        "filter": {"name": "__probe__", "period": "hour", "start": {"$gte": datetime(2000, 1, 1, tzinfo=timezone.utc)}}
+    },
+    "outbox_pending": {
+        "collection": "outbox",
+        "filter": {"status": "pending"},
+        "sort": [("created_at", ASCENDING)]
+    },
+}
+
+def ensure_indexes(collection, indexes):
+    """Tạo index nếu chưa có (chạy trong executor)"""
+    for keys, options in indexes:
+        try:
+            collection.create_index(keys, **options)
+        except DuplicateKeyError:
+            # Dữ liệu cũ có name trùng - vẫn tạo index thường để query không bị COLLSCAN
+            log_warning("indexes.duplicate", "Duplicate values, creating non-unique index instead", index=options['name'])
+            options = {**options, "unique": False}
+            collection.create_index(keys, **options)
+        except OperationFailure as e:
+            # Index cùng tên nhưng khác option (vd: unique) đã tồn tại
+            log_warning("indexes.conflict", "Index already exists with different options", index=options['name'], error=str(e))
+
+def _plan_stages(plan: dict) -> List[str]:
+    """Liệt kê các stage trong một query plan (đệ quy qua inputStage/inputStages)"""
+    stages = [plan.get("stage", "")]
+    if "inputStage" in plan:
+        stages += _plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        stages += _plan_stages(child)
+    return stages
+
+def _plan_indexes(plan: dict) -> List[str]:
+    """Tên các index được dùng trong một query plan"""
+    names = [plan["indexName"]] if "indexName" in plan else []
+    if "inputStage" in plan:
+        names += _plan_indexes(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        names += _plan_indexes(child)
+    return names
+
+def explain_query(spec: dict) -> dict:
+    """Chạy explain cho một query và tóm tắt winning plan (chạy trong executor)"""
+    cursor = getattr(store, spec.get("collection", "logs")).find(spec["filter"])
+    if spec.get("sort"):
+        cursor = cursor.sort(spec["sort"])
+    explain = cursor.explain()
+    plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+    # Server mới (SBE) bọc plan trong queryPlan
+    plan = plan.get("queryPlan", plan)
+    stages = _plan_stages(plan)
+    stats = explain.get("executionStats", {})
+    return {
+        "filter": str(spec["filter"]),
+        "stages": stages,
+        "indexes": _plan_indexes(plan),
+        "collscan": "COLLSCAN" in stages,
+        "keys_examined": stats.get("totalKeysExamined"),
+        "docs_examined": stats.get("totalDocsExamined"),
+        "returned": stats.get("nReturned"),
+    }
+
+def index_report() -> dict:
+    """Báo cáo index usage ($indexStats) và explain của các hot query (chạy trong executor)"""
+    usage = {}
+    for index_stat in store.logs.aggregate([{"$indexStats": {}}]):
+        usage[index_stat["name"]] = {
+            "key": dict(index_stat.get("key", {})),
+            "ops": index_stat.get("accesses", {}).get("ops", 0),
+            "since": str(index_stat.get("accesses", {}).get("since", "")),
+        }
+    queries = {name: explain_query(spec) for name, spec in HOT_QUERIES.items()}
+    return {
+        "ok": not any(q["collscan"] for q in queries.values()),
+        "indexes": usage,
+        "queries": queries,
+    }
+
+def migrate_string_timestamps() -> int:
+    """Chuyển last_updated/timestamp dạng ISO string (format cũ) sang BSON date (chạy trong executor)"""
+    operations = []
+    query = {"$or": [{"last_updated": {"$type": "string"}}, {"timestamp": {"$type": "string"}}]}
+    for doc in store.logs.find(query, {"last_updated": 1, "timestamp": 1}):
+        fields = {}
+        for field in ("last_updated", "timestamp"):
+            if isinstance(doc.get(field), str):
+                fields[field] = parse_timestamp(doc[field]) or datetime.now(VIETNAM_TZ)
+        operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": fields}))
+    if operations:
+        store.logs.bulk_write(operations, ordered=False)
+    return len(operations)
+
+def prepare_indexes() -> dict:
+    """Tạo index và kiểm tra query plan; raise nếu hot query bị COLLSCAN (khi strict)"""
+    ensure_indexes(store.logs, LOGS_INDEXES)
+    ensure_indexes(store.history, HISTORY_INDEXES)
+    ensure_indexes(store.uptime, UPTIME_INDEXES)
+    ensure_indexes(store.outbox, OUTBOX_INDEXES)
+    report = index_report()
+    for name, query in report["queries"].items():
+        if query["collscan"]:
+            log_error("indexes.collscan", "Hot query falls back to COLLSCAN", query=name, filter=query['filter'])
+    if not report["ok"] and INDEX_CHECK_STRICT:
+        raise RuntimeError("Hot query falls back to COLLSCAN - check indexes on the logs collection")
+    return report
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse serialize bằng dumps_bytes (orjson nếu có)"""
+    def render(self, content) -> bytes:
+        return dumps_bytes(content)
+
+app = FastAPI(default_response_class=FastJSONResponse)
 
 # CORS middleware
 app.add_middleware(
@@ -57,65 +595,1236 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_SIZE)
 
-# Store active WebSocket connections
-active_connections: List[WebSocket] = []
+# Store active WebSocket connections (WSClient, xem phần WebSocket bên dưới)
+active_connections: List["WSClient"] = []
 
-def send_discord_notification(machine_name: str, ipwan: str, port: str, status: str):
-    """Gửi notification lên Discord (nếu có webhook)"""
-    if not DISCORD_WEBHOOK:
-        return
-    
-    try:
-        import requests
+# Gửi keepalive nếu không có thay đổi nào trong khoảng thời gian này (giây)
+WS_KEEPALIVE_INTERVAL = float(os.getenv('WS_KEEPALIVE_INTERVAL', 25))
+# Gộp các thay đổi và broadcast tối đa một lần mỗi window (ms)
+BROADCAST_WINDOW = int(os.getenv('BROADCAST_WINDOW_MS', 150)) / 1000
+# Hàng đợi gửi của mỗi WebSocket client: số message tối đa, timeout một lần gửi (giây)
+# và thời gian tối đa một client được phép tụt lại phía sau trước khi bị ngắt (giây)
+WS_CLIENT_QUEUE_SIZE = int(os.getenv('WS_CLIENT_QUEUE_SIZE', 64))
+WS_SEND_TIMEOUT = float(os.getenv('WS_SEND_TIMEOUT', 10))
+WS_SLOW_CLIENT_TIMEOUT = float(os.getenv('WS_SLOW_CLIENT_TIMEOUT', 30))
+# Auto-OFF: máy không gửi dữ liệu quá timeout (giây) sẽ bị set statusapp = 0.
+# Agent có thể gửi heartbeat_timeout riêng cho từng máy (trong khoảng MIN..MAX).
+HEARTBEAT_TIMEOUT = float(os.getenv('HEARTBEAT_TIMEOUT', 60))
+HEARTBEAT_TIMEOUT_MIN = 5
+HEARTBEAT_TIMEOUT_MAX = 3600
+# Auto-OFF bị lỗi (vd. MongoDB timeout): thử lại các máy đó sau số giây này
+AUTO_OFF_RETRY = float(os.getenv('AUTO_OFF_RETRY', 5))
+# Số thay đổi gần nhất được giữ lại để client reconnect có thể resume
+CHANGE_LOG_SIZE = int(os.getenv('CHANGE_LOG_SIZE', 5000))
+# State bus giữa các worker: "local" (một process) hoặc "unix" (nhiều uvicorn worker trên một máy)
+STATE_BUS = os.getenv('STATE_BUS', 'local')
+# Socket (và file .lock) nằm trong thư mục riêng 0700 của user chạy server,
+# mặc định <tmp>/vmix-monitor-<uid>/bus.sock
+STATE_BUS_PATH = os.getenv('STATE_BUS_PATH', '')
+# Thời gian tối đa chờ hub gửi lại thay đổi vừa publish (trong ingest lock), giây
+STATE_BUS_APPLY_TIMEOUT = float(os.getenv('STATE_BUS_APPLY_TIMEOUT', 5))
+STATE_BUS_MAX_BUFFER = int(os.getenv('STATE_BUS_MAX_BUFFER', 64 * 1024 * 1024))  # bytes chờ gửi tối đa cho một worker
+# /logs?limit=: số entry mặc định / tối đa mỗi trang
+LOGS_PAGE_DEFAULT = 200
+LOGS_PAGE_MAX = 1000
+# /changes long-poll: thời gian chờ mặc định / tối đa (giây)
+LONG_POLL_TIMEOUT_DEFAULT = 25
+LONG_POLL_TIMEOUT_MAX = 60
+# Full snapshot trên WebSocket được gửi thành nhiều message, mỗi message tối đa chừng này entry
+SNAPSHOT_CHUNK_SIZE = int(os.getenv('SNAPSHOT_CHUNK_SIZE', 500))
+
+# Discord outbox: notification được ghi vào MongoDB rồi mới gửi, nên không
+# mất khi server restart. Một worker gửi bất đồng bộ với connection dùng lại
+# (httpx.AsyncClient), mỗi webhook gửi tuần tự (giữ thứ tự message), tôn
+# trọng rate limit của Discord (429 Retry-After, X-RateLimit-*) và retry với
+# exponential backoff. Giao ít nhất một lần (at-least-once).
+class DiscordOutbox:
+    def __init__(self):
+        self._queues: Dict[str, deque] = {}  # webhook -> message chờ gửi (FIFO)
+        self._blocked_until: Dict[str, float] = {}  # webhook -> epoch seconds
+        self._global_blocked_until = 0.0
+        self._in_flight = set()  # webhook đang có request
+        self._ids = set()
+        self._wakeup = asyncio.Event()
+        self._client = None
+        self._latencies = deque(maxlen=500)  # giây từ lúc enqueue tới lúc gửi xong
+        self.stats = {"enqueued": 0, "delivered": 0, "retried": 0, "rate_limited": 0, "dead": 0}
+
+    def _push(self, message: dict):
+        if message["_id"] in self._ids:
+            return
+        self._ids.add(message["_id"])
+        self._queues.setdefault(message["webhook"], deque()).append(message)
+        self._wakeup.set()
+
+    async def enqueue(self, content: str, webhook: Optional[str] = None) -> bool:
+        """Lưu message vào outbox (MongoDB) và đánh thức worker; False nếu không có webhook"""
+        webhook = webhook or DISCORD_WEBHOOK
+        if not webhook:
+            return False
+        now = datetime.now(VIETNAM_TZ)
+        message = {
+            "_id": ObjectId(),
+            "webhook": webhook,
+            "payload": {"content": content},
+            "status": "pending",
+            "attempts": 0,
+            "created_at": now,
+            "next_attempt_at": now
+        }
+        try:
+            await store.run(store.outbox.insert_one, dict(message))
+        except Exception as e:
+            # Vẫn gửi được, chỉ không sống sót qua restart
+            log_warning("discord.persist_error", "Discord outbox persist error", error=str(e))
+        self.stats["enqueued"] += 1
+        self._push(message)
+        return True
+
+    async def recover(self):
+        """Nạp lại các message chưa gửi được từ MongoDB (sau restart / đổi leader)"""
+        try:
+            pending = await store.find_all(store.outbox, {"status": "pending"}, sort=[("created_at", ASCENDING)])
+        except Exception as e:
+            log_error("discord.recover_error", "Discord outbox recover error", error=str(e))
+            return
+        before = len(self._ids)
+        for message in pending:
+            self._push(message)
+        if len(self._ids) > before:
+            log_info("discord.recovered", "Discord outbox: recovered pending messages", count=len(self._ids) - before)
+
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def describe(self) -> dict:
+        """Độ sâu hàng đợi, tuổi message cũ nhất và latency giao gần đây"""
+        now = datetime.now(VIETNAM_TZ)
+        heads = [queue[0]["created_at"] for queue in self._queues.values() if queue]
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float):
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3) if latencies else None
+
+        return {
+            "depth": self.depth(),
+            "oldest_age_seconds": round((now - min(heads)).total_seconds(), 3) if heads else 0,
+            "rate_limited_webhooks": sum(1 for until in self._blocked_until.values() if until > time.time()),
+            "latency_p50_seconds": percentile(0.5),
+            "latency_p95_seconds": percentile(0.95),
+            **self.stats
+        }
+
+    async def run(self):
+        """Background task: gửi message tới hạn, mỗi webhook tối đa một request cùng lúc"""
+        self._client = httpx.AsyncClient(timeout=DISCORD_TIMEOUT)
+        while True:
+            try:
+                now = time.time()
+                next_wake = None
+                for webhook, queue in self._queues.items():
+                    if not queue or webhook in self._in_flight:
+                        continue
+                    ready_at = max(self._blocked_until.get(webhook, 0), self._global_blocked_until,
+                                   queue[0]["next_attempt_at"].timestamp())
+                    if ready_at <= now:
+                        self._in_flight.add(webhook)
+                        asyncio.create_task(self._deliver(webhook))
+                    elif next_wake is None or ready_at < next_wake:
+                        next_wake = ready_at
+                
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), None if next_wake is None else max(0.0, next_wake - now))
+                except asyncio.TimeoutError:
+                    pass
+            except Exception as e:
+                log_error("discord.error", "Error in Discord outbox", error=str(e))
+                await asyncio.sleep(1)
+
+    def _apply_rate_limit_headers(self, webhook: str, response):
+        """Chặn webhook tới khi bucket reset nếu đã dùng hết (X-RateLimit-Remaining: 0)"""
+        if response.headers.get("x-ratelimit-remaining") == "0":
+            try:
+                reset_after = float(response.headers.get("x-ratelimit-reset-after", 1))
+            except ValueError:
+                reset_after = 1.0
+            self._blocked_until[webhook] = time.time() + reset_after
+
+    async def _deliver(self, webhook: str):
+        queue = self._queues[webhook]
+        message = queue[0]
+        try:
+            try:
+                response = await self._client.post(webhook, json=message["payload"])
+            except httpx.HTTPError as e:
+                await self._retry(message, f"{type(e).__name__}: {e}")
+                return
+            
+            self._apply_rate_limit_headers(webhook, response)
+            if response.status_code == 429:
+                # Không tính là một lần thử: chờ đúng Retry-After rồi gửi lại
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = {}
+                retry_after = float(body.get("retry_after") or response.headers.get("retry-after") or 1)
+                until = time.time() + retry_after
+                if body.get("global") or response.headers.get("x-ratelimit-global"):
+                    self._global_blocked_until = until
+                else:
+                    self._blocked_until[webhook] = until
+                self.stats["rate_limited"] += 1
+                log_warning("discord.rate_limited", "Discord rate limited", retry_after=round(retry_after, 2))
+            elif 200 <= response.status_code < 300:
+                queue.popleft()
+                self._ids.discard(message["_id"])
+                self.stats["delivered"] += 1
+                self._latencies.append((datetime.now(VIETNAM_TZ) - message["created_at"]).total_seconds())
+                try:
+                    await store.run(store.outbox.delete_one, {"_id": message["_id"]})
+                except Exception as e:
+                    log_warning("discord.cleanup_error", "Discord outbox cleanup error", error=str(e))
+            elif response.status_code >= 500:
+                await self._retry(message, f"HTTP {response.status_code}")
+            else:
+                # 4xx khác (webhook sai/bị xóa, payload lỗi): retry cũng không được
+                await self._give_up(message, f"HTTP {response.status_code}: {response.text[:200]}")
+        except Exception as e:
+            log_error("discord.delivery_error", "Discord delivery error", error=str(e))
+        finally:
+            self._in_flight.discard(webhook)
+            self._wakeup.set()
+
+    async def _retry(self, message: dict, error: str):
+        message["attempts"] += 1
+        if message["attempts"] >= DISCORD_MAX_ATTEMPTS:
+            await self._give_up(message, error)
+            return
+        delay = min(DISCORD_RETRY_MAX, DISCORD_RETRY_BASE * 2 ** (message["attempts"] - 1)) * random.uniform(0.8, 1.2)
+        message["next_attempt_at"] = datetime.now(VIETNAM_TZ) + timedelta(seconds=delay)
+        self.stats["retried"] += 1
+        log_warning("discord.retry", "Discord delivery failed, retrying", error=error, attempt=message['attempts'], delay=round(delay, 1))
+        await store.run(store.outbox.update_one, {"_id": message["_id"]}, {"$set": {
+            "attempts": message["attempts"],
+            "next_attempt_at": message["next_attempt_at"],
+            "last_error": error
+        }})
+
+    async def _give_up(self, message: dict, error: str):
+        """Bỏ message khỏi hàng đợi, giữ lại trong MongoDB với status dead để kiểm tra"""
+        self._queues[message["webhook"]].popleft()
+        self._ids.discard(message["_id"])
+        self.stats["dead"] += 1
+        log_error("discord.dead", "Discord message dropped", attempts=message['attempts'], error=error)
+        await store.run(store.outbox.update_one, {"_id": message["_id"]}, {"$set": {
+            "status": "dead",
+            "attempts": message["attempts"],
+            "last_error": error
+        }})
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+
+outbox = DiscordOutbox()
+
+async def send_discord_notification(machine_name: str, ipwan: str, port: str, status: str):
+    """Đưa notification vào Discord outbox (nếu có webhook)"""
+    # Gửi text đơn giản thay vì embed
+    message = f"[{machine_name}] SRT {status} | IPWAN: {ipwan} | PORT: {port}"
+    if await outbox.enqueue(message):
+        log_info("discord.queued", "Discord notification queued", machine=machine_name)
+
+class AlertEngine:
+    """Phát hiện thay đổi status/IPWAN của các máy trong selected list và gửi Discord.
+
+    Được gọi từ apply_change() trên worker leader với document trước/sau của
+    mỗi thay đổi: chỉ so sánh hai field và tra set name/port nên O(1) mỗi
+    thay đổi, không cần poll hay giữ snapshot riêng. Các thay đổi trong
+    ALERT_WINDOW giây được gộp vào một message cùng format với AUTO SEND của
+    GUI; máy đổi rồi đổi lại trong window thì không gửi.
+    Selected list được đọc từ MongoDB và giữ trong bộ nhớ, đọc lại sau mỗi
+    lần lưu và định kỳ mỗi ALERT_SELECTED_REFRESH giây.
+    """
+
+    def __init__(self, enabled: bool = ALERTS_ENABLED, prefix: str = ALERT_PREFIX):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.names = set()
+        self.ports = set()  # Entry không có tên trong selected list được match theo port (như GUI)
+        self.pending = {}  # name -> ((status, ipwan) lúc bắt đầu window, document mới nhất)
+        self.loaded = False
+        self._reload = True
+        self._wakeup = asyncio.Event()
+        self.stats = {"changes": 0, "alerts": 0, "messages": 0}
+
+    def set_selected(self, entries: List[dict]):
+        names, ports = set(), set()
+        for entry in entries:
+            data = entry.get("data", entry)
+            if data.get("name"):
+                names.add(data["name"])
+            elif data.get("port") not in (None, ""):
+                ports.add(str(data["port"]))
+        self.names, self.ports = names, ports
+        self.loaded = True
+
+    def request_reload(self):
+        self._reload = True
+        self._wakeup.set()
+
+    def observe(self, previous: Optional[dict], doc: dict):
+        """Một thay đổi từ apply_change (chỉ trên leader)"""
+        if not self.enabled:
+            return
+        name = doc.get("name", "")
+        if name not in self.names and str(doc.get("port", "")) not in self.ports:
+            return
+        current = (doc.get("status"), doc.get("ipwan"))
+        if previous is not None:
+            before = (previous.get("status"), previous.get("ipwan"))
+            if before == current and name not in self.pending:
+                return
+        else:
+            before = None
+        self.stats["changes"] += 1
+        baseline = self.pending[name][0] if name in self.pending else before
+        self.pending[name] = (baseline, doc)
+        self._wakeup.set()
+
+    def format_messages(self, docs: List[dict]) -> List[str]:
+        """Message theo format AUTO SEND của GUI, chia nhỏ theo giới hạn của Discord"""
+        now = datetime.now(VIETNAM_TZ)
+        title = f"=== STATUS CHANGED - {now.strftime('%d/%m/%Y %H:%M:%S')} ==="
+        messages, lines = [], [title]
+        for doc in docs:
+            line = f"[{self.prefix}][{doc.get('name', '')}] SRT {doc.get('status', '')} | IPWAN: {doc.get('ipwan', '')} | PORT: {doc.get('port', '')}"
+            if sum(len(l) + 1 for l in lines) + len(line) > DISCORD_MESSAGE_MAX:
+                messages.append("\n".join(lines))
+                lines = []
+            lines.append(line)
+        messages.append("\n".join(lines))
+        return messages
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        changed = [doc for baseline, doc in pending.values() if baseline != (doc.get("status"), doc.get("ipwan"))]
+        if not changed:
+            return
+        changed.sort(key=lambda doc: (doc.get("name", ""), str(doc.get("port", ""))))
+        for message in self.format_messages(changed):
+            if await outbox.enqueue(message, ALERT_WEBHOOK or None):
+                self.stats["messages"] += 1
+        self.stats["alerts"] += len(changed)
+        log_info("alerts.sent", "Alert: machines changed", count=len(changed))
+
+    async def load_selected(self):
+        documents = await store.find_all(store.selected_list, {})
+        self.set_selected(documents)
+        log_info("alerts.selected", "Alert engine: selected list loaded", watching=len(self.names) + len(self.ports))
+
+    async def run(self):
+        """Background task: gửi các thay đổi đã gộp, đọc lại selected list khi cần"""
+        if not self.enabled:
+            return
+        loop = asyncio.get_running_loop()
+        last_load = 0.0
+        while True:
+            try:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), ALERT_SELECTED_REFRESH)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                if not bus.is_leader:
+                    continue
+                if self._reload or loop.time() - last_load >= ALERT_SELECTED_REFRESH:
+                    self._reload = False
+                    last_load = loop.time()
+                    await self.load_selected()
+                if self.pending:
+                    await asyncio.sleep(ALERT_WINDOW)
+                    await self.flush()
+            except Exception as e:
+                log_error("alerts.error", "Alert engine error", error=str(e))
+
+    def describe(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "watching": len(self.names) + len(self.ports),
+            "pending": len(self.pending),
+            **self.stats
+        }
+
+alerts = AlertEngine()
+
+def parse_timestamp(value) -> Optional[datetime]:
+    """Chuyển timestamp (BSON datetime hoặc ISO string kiểu cũ) thành datetime có timezone"""
+    if isinstance(value, datetime):
+        dt = value
+    elif isinstance(value, str) and value:
+        try:
+            dt = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    else:
+        return None
+    # Document cũ không có timezone thì coi như giờ Việt Nam
+    if dt.tzinfo is None:
+        dt = VIETNAM_TZ.localize(dt)
+    return dt
+
+def format_timestamp(value) -> str:
+    """Timestamp dạng ISO string giờ Việt Nam (format GUI đang dùng)"""
+    dt = parse_timestamp(value)
+    return dt.astimezone(VIETNAM_TZ).isoformat() if dt else (value or "")
+
+def doc_to_entry(doc: dict) -> dict:
+    """Format document MongoDB thành entry tương thích với GUI"""
+    return {
+        "timestamp": format_timestamp(doc.get("last_updated", doc.get("timestamp", ""))),
+        "data": {
+            "name": doc.get("name", ""),
+            "ip": doc.get("ip", ""),
+            "ipwan": doc.get("ipwan", ""),
+            "status": doc.get("status", ""),
+            "port": doc.get("port", ""),
+            "statusapp": doc.get("statusapp", 0)
+        }
+    }
+
+# Fleet state trong bộ nhớ (name -> document, không có _id).
+# Load từ MongoDB lúc startup, sau đó được cập nhật cùng chỗ với mỗi lệnh ghi
+# (write-through) nên các thao tác đọc không cần query database.
+fleet_state: Dict[str, dict] = {}
+
+# Giới hạn số dòng mỗi loại khác biệt trong báo cáo kiểm tra registry
+REGISTRY_CHECK_LIMIT = 50
+
+class MachineRegistry:
+    """Index phụ (hash) của fleet_state: ip, (ip, port), ipwan -> tập name.
+
+    fleet_state chính là index theo name. Registry được cập nhật cùng chỗ với
+    fleet_state (apply_change, load_fleet_state) - kể cả auto-OFF vì auto-OFF
+    cũng đi qua bus - nên /get_by_ip, /delete và /update_ip chỉ tra dict,
+    không đọc MongoDB. Port được giữ nguyên kiểu như trong document, giống
+    query {"ip", "port"} của MongoDB.
+    """
+    FIELDS = ("ip", "endpoint", "ipwan")
+
+    def __init__(self):
+        self.index = {field: {} for field in self.FIELDS}
+
+    @staticmethod
+    def keys(doc: dict) -> tuple:
+        ip = doc.get("ip", "")
+        return (("ip", ip), ("endpoint", (ip, doc.get("port", ""))), ("ipwan", doc.get("ipwan", "")))
+
+    def add(self, name: str, doc: dict):
+        for field, key in self.keys(doc):
+            self.index[field].setdefault(key, set()).add(name)
+
+    def remove(self, name: str, doc: dict):
+        for field, key in self.keys(doc):
+            names = self.index[field].get(key)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self.index[field][key]
+
+    def replace(self, name: str, previous: Optional[dict], doc: Optional[dict]):
+        """Cập nhật index khi document của máy đổi từ previous sang doc (None = không có)"""
+        if previous is doc:
+            return
+        if previous is not None and doc is not None and self.keys(previous) == self.keys(doc):
+            return  # Heartbeat/đổi status: không đổi key nào
+        if previous is not None:
+            self.remove(name, previous)
+        if doc is not None:
+            self.add(name, doc)
+
+    def rebuild(self, documents: Dict[str, dict]):
+        self.index = {field: {} for field in self.FIELDS}
+        for name, doc in documents.items():
+            self.add(name, doc)
+
+    def lookup(self, field: str, key) -> List[dict]:
+        """Document của các máy có field = key, theo thứ tự name"""
+        names = self.index[field].get(key, ())
+        return [fleet_state[name] for name in sorted(names) if name in fleet_state]
+
+    def by_ip(self, ip: str) -> List[dict]:
+        return self.lookup("ip", ip)
+
+    def by_ipwan(self, ipwan: str) -> List[dict]:
+        return self.lookup("ipwan", ipwan)
+
+    def by_endpoint(self, ip: str, port) -> Optional[dict]:
+        """Máy theo ip + port (nếu trùng thì lấy máy có name nhỏ nhất)"""
+        documents = self.lookup("endpoint", (ip, port))
+        return documents[0] if documents else None
+
+    def check(self, documents: Optional[List[dict]] = None) -> dict:
+        """Kiểm tra registry với fleet_state và (nếu có) với documents đọc từ MongoDB.
+
+        - index: key thiếu/thừa so với index dựng lại từ fleet_state
+        - database: máy chỉ có ở một bên, hoặc ip/port/ipwan/version khác nhau
+        - duplicate_endpoints: nhiều máy cùng ip:port (/delete, /update_ip
+          chỉ tác động lên một máy) - chỉ để tham khảo, không tính là lỗi
+        Fleet đang nhận dữ liệu thì có thể thấy khác biệt tạm thời về version.
+        """
+        expected = MachineRegistry()
+        expected.rebuild(fleet_state)
+        index_errors = []
+        for field in self.FIELDS:
+            actual_index, expected_index = self.index[field], expected.index[field]
+            for key in actual_index.keys() | expected_index.keys():
+                actual_names, expected_names = actual_index.get(key, set()), expected_index.get(key, set())
+                if actual_names != expected_names:
+                    index_errors.append({
+                        "field": field,
+                        "key": "%s:%s" % key if field == "endpoint" else key,
+                        "missing": sorted(expected_names - actual_names),
+                        "extra": sorted(actual_names - expected_names)
+                    })
         
-        # Gửi text đơn giản thay vì embed
-        message = f"[{machine_name}] SRT {status} | IPWAN: {ipwan} | PORT: {port}"
-        payload = {"content": message}
+        report = {
+            "machines": len(fleet_state),
+            "keys": {field: len(self.index[field]) for field in self.FIELDS},
+            "index_errors": index_errors[:REGISTRY_CHECK_LIMIT],
+            "duplicate_endpoints": sorted(
+                "%s:%s" % key for key, names in self.index["endpoint"].items() if len(names) > 1
+            )[:REGISTRY_CHECK_LIMIT]
+        }
+        ok = not index_errors
         
-        response = requests.post(DISCORD_WEBHOOK, json=payload, timeout=5)
-        if response.status_code in [200, 204]:
-            print(f"✓ Discord notification sent for {machine_name}")
-        else:
-            print(f"⚠ Discord webhook failed: {response.status_code}")
-    except Exception as e:
-        print(f"✗ Discord notification error: {e}")
+        if documents is not None:
+            stored = {doc.get("name", ""): doc for doc in documents}
+            mismatched = []
+            for name in stored.keys() & fleet_state.keys():
+                for field in ("ip", "port", "ipwan", "version"):
+                    if stored[name].get(field) != fleet_state[name].get(field):
+                        mismatched.append({"name": name, "field": field, "database": stored[name].get(field),
+                                           "memory": fleet_state[name].get(field)})
+            missing_in_memory = sorted(stored.keys() - fleet_state.keys())
+            missing_in_database = sorted(fleet_state.keys() - stored.keys())
+            report["database"] = {
+                "machines": len(stored),
+                "missing_in_memory": missing_in_memory[:REGISTRY_CHECK_LIMIT],
+                "missing_in_database": missing_in_database[:REGISTRY_CHECK_LIMIT],
+                "mismatched": mismatched[:REGISTRY_CHECK_LIMIT]
+            }
+            ok = ok and not (missing_in_memory or missing_in_database or mismatched)
+        
+        report["ok"] = ok
+        return report
+
+    def describe(self) -> dict:
+        return {field: len(self.index[field]) for field in self.FIELDS}
+
+registry = MachineRegistry()
+
+# Sequence number của fleet state - tăng 1 cho mỗi thay đổi (upsert/delete).
+# epoch đổi mỗi lần server khởi động, nên seq của client chỉ có ý nghĩa
+# khi epoch trùng với server.
+state_version = 0
+state_epoch = uuid.uuid4().hex[:12]
+state_changed = asyncio.Event()
+
+# Change log: (seq, name, entry hoặc None nếu máy bị xóa). Client reconnect
+# với seq nằm trong log thì chỉ nhận phần thiếu, cũ hơn thì nhận full snapshot.
+change_log = deque(maxlen=CHANGE_LOG_SIZE)
+change_log_floor = 0  # Các seq <= floor không thể resume được
+
+# Bộ đếm broadcast: requested = số thay đổi, emitted = số lần thực sự gửi,
+# coalesced = số thay đổi được gộp vào broadcast của thay đổi khác,
+# resyncs = số lần hàng đợi của một client bị đầy và được thay bằng bản mới nhất,
+# evicted = số client chậm bị ngắt kết nối
+broadcast_stats = {"requested": 0, "coalesced": 0, "emitted": 0, "keepalives": 0, "resyncs": 0, "evicted": 0}
+
+def apply_change(seq: int, name: str, doc: Optional[dict]):
+    """Áp dụng một thay đổi đã được bus cấp seq (doc None = máy bị xóa).
+
+    Mọi worker áp dụng cùng các thay đổi theo cùng thứ tự nên fleet state và
+    seq giống nhau trên mọi worker. Ghi change log, đánh thức broadcaster; riêng
+    worker leader ghi history/uptime và theo dõi heartbeat.
+    """
+    global state_version
+    previous = fleet_state.get(name)
+    if doc is None:
+        fleet_state.pop(name, None)
+    elif previous is not None and previous.get("version", 0) > doc.get("version", 0):
+        # Hai worker publish cùng một máy gần như đồng thời: giữ bản mới hơn
+        doc = previous
+    else:
+        fleet_state[name] = doc
+    registry.replace(name, previous, doc)
+    
+    state_version = seq
+    broadcast_stats["requested"] += 1
+    change_log.append((seq, name, doc_to_entry(doc) if doc is not None else None))
+    state_changed.set()
+    
+    if bus.is_leader:
+        if doc is None:
+            if previous is not None:
+                close_uptime(name, datetime.now(VIETNAM_TZ))
+        elif doc is not previous:
+            record_transition(previous, doc)
+            alerts.observe(previous, doc)
+    track_liveness(name)
+
+def changes_since(since: int):
+    """Gộp các thay đổi sau seq `since` thành (upserts, deletes).
+
+    Trả về None nếu không thể resume (seq quá cũ hoặc không hợp lệ).
+    """
+    oldest_available = change_log[0][0] - 1 if change_log else state_version
+    if since > state_version or since < max(change_log_floor, oldest_available):
+        return None
+    
+    # Giữ thay đổi cuối cùng cho mỗi máy
+    latest = {}
+    for seq, name, entry in reversed(change_log):
+        if seq <= since:
+            break
+        if name not in latest:
+            latest[name] = entry
+    
+    upserts = [entry for entry in latest.values() if entry is not None]
+    deletes = [name for name, entry in latest.items() if entry is None]
+    return upserts, deletes
+
+async def load_fleet_state(seq: Optional[int] = None, epoch: Optional[str] = None):
+    """Load toàn bộ fleet từ MongoDB vào bộ nhớ.
+
+    seq/epoch do bus cấp khi chạy nhiều worker; mặc định là seq kế tiếp của
+    chính process này.
+    """
+    global state_version, state_epoch, change_log_floor
+    documents = await store.find_all(store.logs, {})
+    fleet_state.clear()
+    liveness.clear()
+    for doc in documents:
+        doc.pop('_id', None)
+        fleet_state[doc.get("name", "")] = doc
+        # Máy đang ON nhưng đã quá hạn sẽ bị auto-OFF ngay khi tracker chạy
+        track_liveness(doc.get("name", ""))
+    registry.rebuild(fleet_state)
+    
+    # State mới hoàn toàn - mọi client phải nhận lại full snapshot
+    state_version = seq if seq is not None else state_version + 1
+    state_epoch = epoch or state_epoch
+    change_log.clear()
+    change_log_floor = state_version
+    state_changed.set()
+    
+    # Chỉ leader theo dõi uptime; khoảng đang mở được cộng trước khi bắt đầu lại
+    if bus.is_leader:
+        checkpoint_uptime(datetime.now(VIETNAM_TZ))
+        start_uptime_tracking()
+        # Leader (mới) nhận luôn các Discord message chưa gửi xong
+        asyncio.create_task(outbox.recover())
+        alerts.request_reload()
+    else:
+        uptime_marks.clear()
+    log_info("state.loaded", "Loaded fleet state into memory", machines=len(fleet_state), epoch=state_epoch, seq=state_version)
+
+# Các hàm ghi state dưới đây trả về Future của bus.publish (None nếu thay đổi đã
+# được áp dụng ngay, vd. LocalBus); code giữ ingest lock phải await_applied()
+# trước khi nhả lock để request kế tiếp đọc được state mới.
+
+def set_machine_state(doc: dict) -> Optional[asyncio.Future]:
+    """Ghi (hoặc thay thế) state của một máy - qua bus để mọi worker cùng áp dụng"""
+    doc = dict(doc)
+    doc.pop('_id', None)
+    return bus.publish(doc.get("name", ""), doc)
+
+def apply_versioned_state(doc: dict) -> Optional[asyncio.Future]:
+    """Ghi state từ document MongoDB, bỏ qua nếu bộ nhớ đã có version mới hơn.
+
+    Hai request cho cùng một máy có thể hoàn thành theo thứ tự khác với thứ
+    tự ghi vào MongoDB; version tránh việc bản cũ ghi đè bản mới.
+    """
+    current = fleet_state.get(doc.get("name", ""))
+    if current is not None and current.get("version", 0) >= doc.get("version", 0):
+        return None
+    return set_machine_state(doc)
+
+def update_machine_fields(name: str, fields: dict) -> Optional[asyncio.Future]:
+    """Cập nhật một vài field của máy (nếu máy tồn tại)"""
+    if name in fleet_state:
+        return bus.publish(name, {**fleet_state[name], **fields})
+    return None
+
+def touch_machine_state(name: str, fields: dict) -> Optional[asyncio.Future]:
+    """Làm mới last_seen của máy mà không tạo thay đổi - qua bus để mọi worker (và leader) biết"""
+    if name in fleet_state:
+        return bus.touch(name, fields)
+    return None
+
+def apply_touch(name: str, fields: dict):
+    """Áp dụng heartbeat từ bus: cập nhật last_seen tại chỗ, không tăng seq"""
+    doc = fleet_state.get(name)
+    if doc is not None:
+        fleet_state[name] = {**doc, **fields}
+        track_liveness(name)
+
+def remove_machine_state(name: str) -> Optional[asyncio.Future]:
+    """Xóa một máy khỏi state"""
+    if name in fleet_state:
+        return bus.publish(name, None)
+    return None
+
+async def await_applied(*futures: Optional[asyncio.Future]):
+    """Chờ các thay đổi vừa publish được áp dụng vào fleet state của worker này.
+
+    Với UnixSocketBus state chỉ đổi khi hub gửi lại thay đổi; hub không trả
+    lời kịp (STATE_BUS_APPLY_TIMEOUT) thì bỏ chờ - MongoDB vẫn đã có thay đổi.
+    """
+    pending = [future for future in futures if future is not None and not future.done()]
+    if not pending:
+        return
+    _, not_done = await asyncio.wait(pending, timeout=STATE_BUS_APPLY_TIMEOUT)
+    if not_done:
+        log_warning("bus.apply_timeout", "State bus: change not echoed by hub in time", pending=len(not_done))
+
+def get_fleet_entries():
+    """Toàn bộ fleet dạng entry, sort theo last_updated (hoặc timestamp), mới nhất trước"""
+    oldest = datetime.min.replace(tzinfo=timezone.utc)
+    documents = sorted(
+        fleet_state.values(),
+        key=lambda doc: parse_timestamp(doc.get("last_updated", doc.get("timestamp"))) or oldest,
+        reverse=True
+    )
+    return [doc_to_entry(doc) for doc in documents]
 
 def get_all_logs():
-    """Get all logs from MongoDB - Compatible với format cũ"""
-    try:
-        # Sort theo last_updated (format cũ) hoặc timestamp
-        documents = collection.find().sort("last_updated", DESCENDING).limit(200)
-        entries = []
-        
-        for doc in documents:
-            # Debug: Print first doc
-            if len(entries) == 0:
-                print(f"📋 First document from MongoDB:")
-                print(f"  name: {doc.get('name', 'N/A')}")
-                print(f"  ip: {doc.get('ip', 'N/A')}")
-                print(f"  ipwan: {doc.get('ipwan', 'N/A')}")
-                print(f"  port: {doc.get('port', 'N/A')}")
-                print(f"  status: {doc.get('status', 'N/A')}")
+    """Get all logs từ fleet state trong bộ nhớ - Compatible với format cũ (không giới hạn số máy)"""
+    return get_fleet_entries()
+
+# Danh sách name đã sort, cache theo version: ((state_epoch, state_version), [name, ...]).
+# Là khóa sort ổn định cho cursor pagination và snapshot nhiều phần - khác với
+# last_updated, thứ tự name không đổi khi máy gửi heartbeat giữa hai trang.
+_sorted_names_cache = (None, [])
+
+def get_sorted_names() -> List[str]:
+    global _sorted_names_cache
+    if _sorted_names_cache[0] != (state_epoch, state_version):
+        _sorted_names_cache = ((state_epoch, state_version), sorted(fleet_state))
+    return _sorted_names_cache[1]
+
+def iter_fleet_entries(after: Optional[str] = None, match: Optional[Callable[[dict], bool]] = None):
+    """Generator entry theo thứ tự name, bắt đầu sau name `after`.
+
+    Chỉ giữ danh sách name; mỗi entry được tạo khi được lấy ra nên bộ nhớ
+    không tăng theo kích thước fleet. Máy bị xóa trong lúc duyệt sẽ bị bỏ qua.
+    `match(doc)` (nếu có) lọc các máy trước khi tạo entry.
+    """
+    names = get_sorted_names()
+    start = bisect_right(names, after) if after is not None else 0
+    for name in islice(names, start, None):
+        doc = fleet_state.get(name)
+        if doc is not None and (match is None or match(doc)):
+            yield doc_to_entry(doc)
+
+# State bus: mọi thay đổi fleet state đi qua bus.publish() và được áp dụng
+# (apply_change) khi bus trả về kèm seq. LocalBus dùng cho một process;
+# UnixSocketBus cho phép chạy `uvicorn server:app --workers N`, mỗi worker
+# giữ bản sao fleet state và broadcast cho các WebSocket client của riêng nó.
+BUS_HEADER = struct.Struct("!IBQ")  # độ dài payload, loại message, seq
+BUS_HELLO, BUS_CHANGE, BUS_TOUCH = 0, 1, 2
+PUBLISH_HEADER = struct.Struct("!IB")  # worker → hub: độ dài payload, loại message
+
+def encode_bus_value(value):
+    """Chuyển document sang dạng JSON thuần: datetime → {"$date": ISO}, ObjectId → str"""
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    if isinstance(value, dict):
+        return {key: encode_bus_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_bus_value(item) for item in value]
+    if isinstance(value, ObjectId):
+        return str(value)
+    return value
+
+def decode_bus_value(value):
+    if isinstance(value, dict):
+        if len(value) == 1 and "$date" in value:
+            return datetime.fromisoformat(value["$date"])
+        return {key: decode_bus_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode_bus_value(item) for item in value]
+    return value
+
+def decode_bus_payload(payload: bytes):
+    return decode_bus_value(orjson.loads(payload) if orjson is not None else json.loads(payload))
+
+def ensure_private_dir(path: str):
+    """Tạo thư mục 0700 cho socket của bus; từ chối nếu nó thuộc user khác,
+    là symlink hoặc người khác đọc/ghi được (vd. bị tạo trước trong /tmp)"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise RuntimeError(f"State bus directory {path} must be a 0700 directory owned by uid {os.getuid()}")
+
+class LocalBus:
+    """Một process: thay đổi được áp dụng ngay, seq do chính process cấp"""
+    is_leader = True
+
+    async def start(self):
+        await load_fleet_state()
+
+    def publish(self, name: str, doc: Optional[dict]) -> None:
+        apply_change(state_version + 1, name, doc)
+
+    def touch(self, name: str, fields: dict) -> None:
+        apply_touch(name, fields)
+
+    async def close(self):
+        pass
+
+    def describe(self) -> dict:
+        return {"type": "local", "leader": True}
+
+class UnixSocketBus:
+    """Bus giữa các worker trên cùng một máy qua Unix domain socket.
+
+    Worker giữ được flock trên `<path>.lock` làm hub: mở socket, cấp seq cho
+    mọi thay đổi theo thứ tự nhận và gửi lại cho tất cả worker (kể cả chính
+    nó), nên fleet state, seq và epoch giống nhau trên mọi worker - client
+    WebSocket reconnect vào worker khác vẫn resume được. Hub chết thì flock
+    được nhả, worker khác lên làm hub với epoch mới và mọi worker load lại
+    state từ MongoDB. Worker bị lỡ thay đổi (seq nhảy cóc) cũng load lại.
+
+    Worker → hub: PUBLISH_HEADER + JSON [name, doc, origin, token], hoặc
+    BUS_TOUCH + JSON [name, timestamp fields, origin, token] cho heartbeat
+    (không cấp seq). publish()/touch() trả về Future resolve khi hub gửi lại
+    message và worker đã áp dụng nó (origin/token nhận ra message của mình). Hub → worker:
+    BUS_HEADER + payload, hub chỉ chuyển tiếp payload chứ không decode.
+    Payload chỉ là dữ liệu (encode_bus_value), không bao giờ là object
+    Python. Socket nằm trong thư mục 0700 của chính user (kiểm tra lúc
+    start) và được chmod 600: chỉ process cùng user mới tạo/kết nối được.
+    """
+
+    def __init__(self, path: str, max_buffer: int = STATE_BUS_MAX_BUFFER):
+        self.path = path
+        self.max_buffer = max_buffer
+        self.is_leader = False
+        self.stats = {"published": 0, "applied": 0, "reloads": 0, "evicted_peers": 0}
+        self._lock_file = None
+        self._server = None
+        self._peers = set()
+        self._hub_epoch = None
+        self._hub_seq = 0
+        self._writer = None
+        self._outbox: List[bytes] = []  # publish trong lúc chưa kết nối tới hub
+        # Mỗi message mang (origin, token): khi hub gửi lại message của chính
+        # worker này và nó đã được áp dụng thì Future của publish() được resolve
+        self._origin = uuid.uuid4().hex[:12]
+        self._next_token = 0
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ready = asyncio.Event()
+        self._task = None
+
+    async def start(self):
+        """Kết nối tới hub (hoặc làm hub) và chờ load state lần đầu"""
+        ensure_private_dir(os.path.dirname(self.path))
+        self._task = asyncio.create_task(self._run())
+        await self._ready.wait()
+
+    def publish(self, name: str, doc: Optional[dict]) -> asyncio.Future:
+        """Gửi thay đổi tới hub; Future resolve khi worker này đã áp dụng nó"""
+        self.stats["published"] += 1
+        return self._send(BUS_CHANGE, name, doc)
+
+    def touch(self, name: str, fields: dict) -> asyncio.Future:
+        """Heartbeat: hub chuyển tiếp cho mọi worker nhưng không cấp seq"""
+        return self._send(BUS_TOUCH, name, fields)
+
+    def _send(self, kind: int, name: str, value: Optional[dict]) -> asyncio.Future:
+        self._next_token += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[self._next_token] = future
+        payload = dumps_bytes(encode_bus_value([name, value, self._origin, self._next_token]))
+        frame = PUBLISH_HEADER.pack(len(payload), kind) + payload
+        if self._writer is None:
+            self._outbox.append(frame)
+        else:
+            self._writer.write(frame)
+        return future
+
+    def _resolve(self, origin: str, token: int):
+        if origin == self._origin:
+            future = self._pending.pop(token, None)
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    def _resolve_all(self):
+        """State vừa được load lại từ MongoDB - đã gồm mọi thay đổi đã publish"""
+        for future in self._pending.values():
+            if not future.done():
+                future.set_result(None)
+        self._pending.clear()
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        if self._writer:
+            self._writer.close()
+        if self._server:
+            self._server.close()
+            for peer in list(self._peers):
+                peer.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        if self._lock_file:
+            self._lock_file.close()  # nhả flock cho worker khác
+
+    def describe(self) -> dict:
+        return {
+            "type": "unix",
+            "path": self.path,
+            "pid": os.getpid(),
+            "leader": self.is_leader,
+            "connected": self._writer is not None,
+            "peers": len(self._peers) if self.is_leader else None,
+            **self.stats
+        }
+
+    def _try_lock(self) -> bool:
+        """Thử giành quyền làm hub (không chặn)"""
+        import fcntl
+        lock_file = open(self.path + ".lock", "a+")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    async def _start_hub(self):
+        # Socket cũ của hub đã chết (flock đã được nhả) thì xóa đi
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._hub_epoch = uuid.uuid4().hex[:12]
+        self._hub_seq = 0
+        self._server = await asyncio.start_unix_server(self._serve_peer, path=self.path)
+        os.chmod(self.path, 0o600)
+        self.is_leader = True
+        log_info("bus.hub_started", "State bus hub started", path=self.path, pid=os.getpid(), epoch=self._hub_epoch)
+
+    async def _serve_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Hub: nhận thay đổi của một worker, cấp seq và gửi cho mọi worker"""
+        self._peers.add(writer)
+        epoch = self._hub_epoch.encode()
+        writer.write(BUS_HEADER.pack(len(epoch), BUS_HELLO, self._hub_seq) + epoch)
+        try:
+            while True:
+                length, kind = PUBLISH_HEADER.unpack(await reader.readexactly(PUBLISH_HEADER.size))
+                payload = await reader.readexactly(length)
+                if kind == BUS_CHANGE:
+                    self._hub_seq += 1
+                frame = BUS_HEADER.pack(length, kind, self._hub_seq) + payload
+                for peer in list(self._peers):
+                    if peer.transport.get_write_buffer_size() > self.max_buffer:
+                        # Worker không đọc kịp: ngắt, nó sẽ reconnect và load lại state
+                        self._peers.discard(peer)
+                        peer.close()
+                        self.stats["evicted_peers"] += 1
+                        log_warning("bus.peer_evicted", "State bus: dropped a worker that fell behind")
+                    else:
+                        peer.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._peers.discard(writer)
+            writer.close()
+
+    async def _run(self):
+        while True:
+            try:
+                if self._lock_file is None:
+                    self._try_lock()
+                if self._lock_file is not None and not self.is_leader:
+                    await self._start_hub()
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                # Hub chưa sẵn sàng hoặc vừa chết - thử lại (có thể lên làm hub)
+                await asyncio.sleep(0.2)
+                continue
             
-            # Format lại để tương thích với GUI
-            entry = {
-                "timestamp": doc.get("last_updated", doc.get("timestamp", "")),
-                "data": {
-                    "name": doc.get("name", ""),
-                    "ip": doc.get("ip", ""),
-                    "ipwan": doc.get("ipwan", ""),
-                    "status": doc.get("status", ""),
-                    "port": doc.get("port", ""),
-                    "statusapp": doc.get("statusapp", 0)
-                }
-            }
-            entries.append(entry)
+            try:
+                await self._consume(reader, writer)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                log_warning("bus.disconnected", "State bus: lost connection to hub, reconnecting")
+            except Exception as e:
+                log_error("bus.error", "State bus error", error=str(e))
+            finally:
+                self._writer = None
+                writer.close()
+            await asyncio.sleep(0.2)
+
+    async def _read_message(self, reader: asyncio.StreamReader) -> tuple:
+        length, kind, seq = BUS_HEADER.unpack(await reader.readexactly(BUS_HEADER.size))
+        return kind, seq, await reader.readexactly(length)
+
+    async def _consume(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Worker: nhận thay đổi từ hub và áp dụng theo thứ tự seq"""
+        kind, seq, payload = await self._read_message(reader)
+        epoch = payload.decode()
+        if epoch != state_epoch or seq != state_version or self._pending:
+            # Hub mới (hoặc lần đầu) / bị lỡ thay đổi trong lúc mất kết nối /
+            # message đã gửi cho connection cũ có thể bị mất
+            await load_fleet_state(seq, epoch)
+            self._resolve_all()
+            self.stats["reloads"] += 1
         
-        return entries
-    except Exception as e:
-        print(f"Error getting logs: {e}")
-        return []
+        self._writer = writer
+        for frame in self._outbox:
+            writer.write(frame)
+        self._outbox.clear()
+        self._ready.set()
+        
+        while True:
+            kind, seq, payload = await self._read_message(reader)
+            if kind == BUS_TOUCH:
+                name, fields, origin, token = decode_bus_payload(payload)
+                apply_touch(name, fields)
+                self._resolve(origin, token)
+                continue
+            if kind != BUS_CHANGE:
+                continue
+            if seq != state_version + 1:
+                # Lỡ thay đổi: MongoDB đã có mọi thay đổi đã publish nên load lại là đủ
+                log_warning("bus.seq_gap", "State bus: seq gap, reloading fleet state", seq=state_version, received=seq)
+                await load_fleet_state(seq, state_epoch)
+                self._resolve_all()
+                self.stats["reloads"] += 1
+                continue
+            name, doc, origin, token = decode_bus_payload(payload)
+            apply_change(seq, name, doc)
+            self._resolve(origin, token)
+            self.stats["applied"] += 1
+
+def create_bus():
+    if STATE_BUS == 'unix':
+        return UnixSocketBus(STATE_BUS_PATH or os.path.join(
+            tempfile.gettempdir(), f"vmix-monitor-{os.getuid()}", "bus.sock"))
+    if STATE_BUS != 'local':
+        log_warning("bus.unknown", "Unknown STATE_BUS, using local", bus=STATE_BUS)
+    return LocalBus()
+
+bus = create_bus()
+
+# Status history: mỗi transition quan trọng được đưa vào hàng đợi và ghi
+# theo lô (bulk_write) vào bucket của máy trong giờ đó, nên ingest không phải
+# chờ thêm một round trip MongoDB.
+HISTORY_FIELDS = ['status', 'statusapp', 'ipwan', 'ip']
+history_queue: asyncio.Queue = asyncio.Queue()
+
+def hour_bucket(dt: datetime) -> datetime:
+    """Đầu giờ (UTC) chứa thời điểm dt"""
+    return dt.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+def record_transition(previous: Optional[dict], current: dict):
+    """Đưa một event vào history nếu status/statusapp/ipwan/ip thay đổi"""
+    if previous is None:
+        changed = list(HISTORY_FIELDS)
+    else:
+        changed = [field for field in HISTORY_FIELDS if previous.get(field) != current.get(field)]
+    if not changed:
+        return
+    
+    # Auto-OFF không đổi last_updated nên dùng thời điểm hiện tại cho event
+    at = datetime.now(VIETNAM_TZ)
+    event = {"at": at, "changed": changed}
+    for field in HISTORY_FIELDS + ['port']:
+        event[field] = current.get(field)
+    history_queue.put_nowait((current.get("name", ""), event))
+    
+    if 'status' in changed or 'statusapp' in changed:
+        record_uptime(current.get("name", ""), current, at)
+
+async def write_history(batch: List[tuple]):
+    """Ghi một lô event (name, event) vào bucket theo giờ"""
+    operations = [
+        UpdateOne(
+            # Bucket đầy (count >= max) sẽ không khớp → upsert tạo bucket mới
+            {"name": name, "hour": hour_bucket(event["at"]), "count": {"$lt": HISTORY_BUCKET_MAX}},
+            {"$push": {"events": event}, "$inc": {"count": 1}},
+            upsert=True
+        )
+        for name, event in batch
+    ]
+    await store.run(store.history.bulk_write, operations, ordered=True)
+
+def drain_history_queue(limit: int = 500) -> List[tuple]:
+    """Lấy tối đa `limit` event đang chờ trong hàng đợi"""
+    batch = []
+    while not history_queue.empty() and len(batch) < limit:
+        batch.append(history_queue.get_nowait())
+    return batch
+
+async def history_writer():
+    """Background task: ghi các event trong hàng đợi vào history theo lô"""
+    while True:
+        try:
+            batch = [await history_queue.get()] + drain_history_queue(499)
+            await write_history(batch)
+        except Exception as e:
+            log_error("history.error", "Error writing status history", error=str(e))
+            await asyncio.sleep(1)
+
+def fetch_history_page(name: str, start: datetime, end: datetime, after: Optional[tuple], limit: int) -> List[dict]:
+    """Đọc một trang bucket theo (hour, _id) tăng dần (chạy trong executor)"""
+    query = {"name": name, "hour": {"$gte": hour_bucket(start), "$lte": end}}
+    if after is not None:
+        last_hour, last_id = after
+        query = {"$and": [query, {"$or": [
+            {"hour": {"$gt": last_hour}},
+            {"hour": last_hour, "_id": {"$gt": last_id}}
+        ]}]}
+    cursor = store.history.find(query, {"hour": 1, "events": 1}).sort([("hour", ASCENDING), ("_id", ASCENDING)]).limit(limit)
+    return list(cursor)
+
+async def iter_history(name: str, start: datetime, end: datetime, page_size: int = 24):
+    """Stream event của một máy trong [start, end] dạng NDJSON, mỗi lần chỉ giữ một trang bucket"""
+    after = None
+    while True:
+        buckets = await store.run(fetch_history_page, name, start, end, after, page_size)
+        for bucket in buckets:
+            for event in bucket.get("events", []):
+                if start <= event["at"] <= end:
+                    yield dumps_text({**event, "name": name, "at": format_timestamp(event["at"])}) + "\n"
+        if len(buckets) < page_size:
+            return
+        after = (buckets[-1]["hour"], buckets[-1]["_id"])
+
+# Uptime rollup: thời gian ON/OFF (SRT status và app statusapp) được cộng dồn
+# vào document theo giờ và theo ngày (giờ Việt Nam) mỗi khi có transition,
+# nên /uptime chỉ cần cộng rollup thay vì replay từng event.
+# uptime_marks: name -> (thời điểm bắt đầu trạng thái hiện tại, srt_on, app_on)
+uptime_marks: Dict[str, tuple] = {}
+# Các phần $inc chưa ghi: (name, period, start) -> {field: seconds}
+uptime_pending: Dict[tuple, Dict[str, float]] = {}
+UPTIME_FIELDS = ['srt_on_seconds', 'srt_off_seconds', 'app_on_seconds', 'app_off_seconds']
+
+def day_bucket(dt: datetime) -> datetime:
+    """0h (giờ Việt Nam) của ngày chứa thời điểm dt"""
+    local = dt.astimezone(VIETNAM_TZ)
+    return VIETNAM_TZ.localize(datetime(local.year, local.month, local.day)).astimezone(timezone.utc)
+
+def uptime_state(doc: dict) -> tuple:
+    """(srt_on, app_on) của một máy"""
+    return doc.get("status") == "ON", doc.get("statusapp") == 1
+
+def add_uptime_duration(name: str, start: datetime, end: datetime, srt_on: bool, app_on: bool):
+    """Cộng khoảng [start, end) vào rollup giờ/ngày, cắt theo ranh giới giờ"""
+    t = start
+    while t < end:
+        hour = hour_bucket(t)
+        segment_end = min(end, hour + timedelta(hours=1))
+        seconds = (segment_end - t).total_seconds()
+        for key in ((name, "hour", hour), (name, "day", day_bucket(t))):
+            counters = uptime_pending.setdefault(key, dict.fromkeys(UPTIME_FIELDS, 0.0))
+            counters["srt_on_seconds" if srt_on else "srt_off_seconds"] += seconds
+            counters["app_on_seconds" if app_on else "app_off_seconds"] += seconds
+        t = segment_end
+
+def record_uptime(name: str, current: dict, at: datetime):
+    """Đóng khoảng thời gian của trạng thái cũ và bắt đầu trạng thái mới"""
+    close_uptime(name, at)
+    uptime_marks[name] = (at, *uptime_state(current))
+
+def close_uptime(name: str, at: datetime):
+    """Cộng khoảng thời gian đang mở của máy vào rollup"""
+    mark = uptime_marks.pop(name, None)
+    if mark is not None:
+        since, srt_on, app_on = mark
+        add_uptime_duration(name, since, at, srt_on, app_on)
+
+def checkpoint_uptime(at: datetime):
+    """Cộng các khoảng đang mở tới thời điểm `at` (để không mất khi restart)"""
+    for name, (since, srt_on, app_on) in list(uptime_marks.items()):
+        add_uptime_duration(name, since, at, srt_on, app_on)
+        uptime_marks[name] = (at, srt_on, app_on)
+
+def start_uptime_tracking():
+    """Bắt đầu theo dõi uptime cho fleet vừa load (thời gian server down không được tính)"""
+    now = datetime.now(VIETNAM_TZ)
+    uptime_marks.clear()
+    for name, doc in fleet_state.items():
+        uptime_marks[name] = (now, *uptime_state(doc))
+
+async def flush_uptime():
+    """Ghi các $inc đang chờ bằng một bulk_write"""
+    if not uptime_pending:
+        return
+    pending = dict(uptime_pending)
+    uptime_pending.clear()
+    operations = [
+        UpdateOne({"name": name, "period": period, "start": start}, {"$inc": counters}, upsert=True)
+        for (name, period, start), counters in pending.items()
+    ]
+    try:
+        await store.run(store.uptime.bulk_write, operations, ordered=False)
+    except Exception:
+        # Ghi lỗi thì trả lại để lần sau ghi tiếp
+        for key, counters in pending.items():
+            current = uptime_pending.setdefault(key, dict.fromkeys(UPTIME_FIELDS, 0.0))
+            for field, value in counters.items():
+                current[field] += value
+        raise
+
+async def uptime_writer():
+    """Background task: ghi rollup định kỳ và checkpoint các khoảng đang mở"""
+    last_checkpoint = time.monotonic()
+    while True:
+        try:
+            await asyncio.sleep(5)
+            if time.monotonic() - last_checkpoint >= UPTIME_CHECKPOINT_INTERVAL:
+                checkpoint_uptime(datetime.now(VIETNAM_TZ))
+                last_checkpoint = time.monotonic()
+            await flush_uptime()
+        except Exception as e:
+            log_error("uptime.error", "Error writing uptime rollups", error=str(e))
+
+def split_uptime_range(start: datetime, end: datetime) -> List[tuple]:
+    """Chia [start, end) (đã làm tròn theo giờ) thành (period, from, to):
+    các ngày trọn vẹn dùng rollup ngày, phần lẻ hai đầu dùng rollup giờ"""
+    first_day = day_bucket(start)
+    if first_day < start:
+        first_day += timedelta(days=1)
+    last_day = day_bucket(end)
+    if first_day >= last_day:
+        return [("hour", start, end)]
+    ranges = [("day", first_day, last_day)]
+    if start < first_day:
+        ranges.append(("hour", start, first_day))
+    if last_day < end:
+        ranges.append(("hour", last_day, end))
+    return ranges
+
+def query_uptime(name: Optional[str], start: datetime, end: datetime) -> Dict[str, dict]:
+    """Cộng rollup trong [start, end) theo máy (chạy trong executor)"""
+    match = {"$or": [
+        {"period": period, "start": {"$gte": range_start, "$lt": range_end}}
+        for period, range_start, range_end in split_uptime_range(start, end)
+    ]}
+    if name:
+        match["name"] = name
+    group = {"_id": "$name", **{field: {"$sum": f"${field}"} for field in UPTIME_FIELDS}}
+    return {
+        row["_id"]: {field: row.get(field, 0) for field in UPTIME_FIELDS}
+        for row in store.uptime.aggregate([{"$match": match}, {"$group": group}])
+    }
 
 @app.get("/")
 async def health_check():
@@ -123,84 +1832,459 @@ async def health_check():
     from fastapi.responses import PlainTextResponse
     return PlainTextResponse("I am alive!")
 
+def render_metrics() -> str:
+    """Toàn bộ metrics dạng Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    gauges = [
+        ("vmix_ws_connections", "Số WebSocket client đang kết nối (process này)", len(active_connections)),
+        ("vmix_ws_subscribed", "Số WebSocket client có subscription filter", len(subscriptions.clients)),
+        ("vmix_long_poll_waiters", "Số request /changes đang chờ", long_poll_waiters),
+        ("vmix_machines", "Số máy trong fleet state", len(fleet_state)),
+        ("vmix_state_seq", "Seq hiện tại của fleet state", state_version),
+        ("vmix_bus_leader", "1 nếu process này là leader của state bus", int(bus.is_leader)),
+        ("vmix_discord_outbox_depth", "Số Discord message đang chờ gửi", outbox.depth()),
+        ("vmix_history_queue_depth", "Số history event chờ ghi", history_queue.qsize()),
+    ]
+    for name, help_text, value in gauges:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+    for key, value in broadcast_stats.items():
+        name = f"vmix_broadcast_{key}_total"
+        lines += [f"# HELP {name} Broadcast {key}", f"# TYPE {name} counter", f"{name} {value}"]
+    for key, value in log_stats.items():
+        name = f"vmix_log_{key}_total"
+        lines += [f"# HELP {name} Log events {key}", f"# TYPE {name} counter", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+@app.get("/metrics")
+async def get_metrics():
+    """Metrics cho Prometheus"""
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/stats")
+async def get_stats():
+    """Thống kê broadcast và kết nối"""
+    return FastJSONResponse(content={
+        "connections": len(active_connections),
+        "subscribed": len(subscriptions.clients),
+        "long_poll_waiters": long_poll_waiters,
+        "machines": len(fleet_state),
+        "seq": state_version,
+        "broadcast": broadcast_stats,
+        "serializer": "orjson" if orjson is not None else "json",
+        "epoch": state_epoch,
+        "bus": bus.describe(),
+        "discord_outbox": outbox.describe(),
+        "alerts": alerts.describe(),
+        "registry": registry.describe(),
+        "logging": {"level": logging.getLevelName(log.level), "format": LOG_FORMAT, **log_stats}
+    })
+
+@app.get("/admin/indexes")
+async def get_index_report():
+    """Index usage và explain của các hot query"""
+    try:
+        report = await store.run(index_report)
+        return FastJSONResponse(content=report, status_code=200 if report["ok"] else 500)
+    except Exception as e:
+        log_error("indexes.report_error", "Index report error", error=str(e))
+        return FastJSONResponse(content={"error": str(e)}, status_code=500)
+
+@app.get("/admin/registry")
+async def get_registry_report():
+    """Kiểm tra MachineRegistry với fleet state và với collection logs trong MongoDB"""
+    try:
+        documents = await store.find_all(store.logs, {})
+        report = registry.check(documents)
+        if not report["ok"]:
+            database = report["database"]
+            log_warning("registry.mismatch", "Machine registry differs from database",
+                        index_errors=len(report["index_errors"]),
+                        missing_in_memory=len(database["missing_in_memory"]),
+                        missing_in_database=len(database["missing_in_database"]),
+                        mismatched=len(database["mismatched"]))
+        return FastJSONResponse(content=report, status_code=200 if report["ok"] else 500)
+    except Exception as e:
+        log_error("registry.report_error", "Registry report error", error=str(e))
+        return FastJSONResponse(content={"error": str(e)}, status_code=500)
+
+def fleet_etag() -> str:
+    """ETag theo version của fleet state - đổi mỗi khi state thay đổi"""
+    return f'"{state_epoch}-{state_version}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Kiểm tra header If-None-Match (hỗ trợ nhiều ETag, weak ETag và *)"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == "*" or candidate == etag:
+            return True
+    return False
+
+def not_modified_response(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+# Cache body của /logs đã serialize: ((state_epoch, state_version), bytes)
+_logs_body_cache = (None, b"")
+
+def get_logs_page(after: Optional[str], limit: int) -> dict:
+    """Một trang của /logs theo name: {"entries": [...], "next": cursor hoặc None}"""
+    entries = list(islice(iter_fleet_entries(after), limit + 1))
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    return {
+        "entries": entries,
+        "next": entries[-1]["data"]["name"] if has_more else None
+    }
+
+async def iter_logs_ndjson(after: Optional[str] = None, batch_size: int = 200):
+    """Stream entry dạng NDJSON, nhường event loop sau mỗi batch"""
+    lines = []
+    for entry in iter_fleet_entries(after):
+        lines.append(dumps_text(entry) + "\n")
+        if len(lines) >= batch_size:
+            yield "".join(lines)
+            lines = []
+            await asyncio.sleep(0)
+    if lines:
+        yield "".join(lines)
+
 @app.get("/logs")
-async def get_all_data():
-    """GET endpoint - lấy tất cả dữ liệu"""
-    return JSONResponse(content=get_all_logs())
+async def get_all_data(request: Request, limit: Optional[int] = None, after: Optional[str] = None,
+                       output_format: Optional[str] = Query(None, alias="format")):
+    """GET endpoint - lấy tất cả dữ liệu (hỗ trợ If-None-Match → 304).
+
+    - Không có tham số: JSON list toàn bộ fleet, mới nhất trước (format cũ).
+    - `?limit=N&after=<cursor>`: phân trang theo name, trả về
+      {"entries": [...], "next": cursor trang sau hoặc null}.
+    - `?format=ndjson` (hoặc Accept: application/x-ndjson): stream mỗi dòng
+      một entry theo thứ tự name, có thể kèm `after`.
+    """
+    global _logs_body_cache
+    etag = fleet_etag()
+    if etag_matches(request, etag):
+        return not_modified_response(etag)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    
+    if output_format == "ndjson" or "application/x-ndjson" in request.headers.get("accept", ""):
+        return StreamingResponse(iter_logs_ndjson(after), media_type="application/x-ndjson", headers=headers)
+    
+    if limit is not None or after is not None:
+        limit = max(1, min(limit or LOGS_PAGE_DEFAULT, LOGS_PAGE_MAX))
+        return FastJSONResponse(content=get_logs_page(after, limit), headers=headers)
+    
+    if _logs_body_cache[0] != (state_epoch, state_version):
+        _logs_body_cache = ((state_epoch, state_version), dumps_bytes(get_all_logs()))
+    return Response(content=_logs_body_cache[1], media_type="application/json", headers=headers)
+
+# Long-poll: mọi request /changes đang chờ cùng await một future, broadcaster
+# resolve nó sau mỗi lần gửi delta. Chi phí mỗi thay đổi không phụ thuộc số
+# request đang chờ, và không cần thread cho request nào.
+_long_poll_future: Optional[asyncio.Future] = None
+long_poll_waiters = 0
+
+def wake_long_poll():
+    global _long_poll_future
+    if _long_poll_future is not None and not _long_poll_future.done():
+        _long_poll_future.set_result(None)
+    _long_poll_future = None
+
+async def wait_for_change(timeout: float) -> bool:
+    """Chờ tới lần broadcast tiếp theo; False nếu hết timeout"""
+    global _long_poll_future, long_poll_waiters
+    if _long_poll_future is None:
+        _long_poll_future = asyncio.get_running_loop().create_future()
+    long_poll_waiters += 1
+    try:
+        # shield: một request hết timeout không được cancel future chung
+        await asyncio.wait_for(asyncio.shield(_long_poll_future), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        long_poll_waiters -= 1
+
+@app.get("/changes")
+async def get_changes(since: Optional[int] = None, epoch: Optional[str] = None,
+                      timeout: float = Query(LONG_POLL_TIMEOUT_DEFAULT, ge=0, le=LONG_POLL_TIMEOUT_MAX)):
+    """Long-poll cho client không dùng được WebSocket.
+
+    `?since=<seq>&epoch=<epoch>`: nếu chưa có thay đổi nào sau seq thì giữ
+    request tới lần broadcast tiếp theo (hoặc hết `timeout` giây), rồi trả về
+    delta giống WebSocket {"type": "delta", "epoch", "seq", "upserts", "deletes"}
+    (rỗng nếu hết timeout). Lần đầu, epoch khác hoặc seq quá cũ thì trả về
+    {"type": "snapshot", ...} với toàn bộ fleet. Client gửi lại seq/epoch nhận được.
+    """
+    try:
+        resumable = since is not None and epoch == state_epoch
+        if resumable and since == state_version:
+            await wait_for_change(timeout)
+            resumable = epoch == state_epoch
+        
+        payload = get_delta_payload(since) if resumable else None
+        if payload is None:
+            payload = dumps_bytes({
+                "type": "snapshot",
+                "epoch": state_epoch,
+                "seq": state_version,
+                "part": 0,
+                "done": True,
+                "entries": list(iter_fleet_entries())
+            })
+        return Response(content=payload, media_type="application/json", headers={"Cache-Control": "no-cache"})
+    except Exception as e:
+        log_error("changes.error", "Changes error", error=str(e))
+        return FastJSONResponse(content={"error": str(e)}, status_code=500)
+
+def parse_heartbeat_timeout(value) -> float:
+    """Timeout heartbeat riêng của máy (giây), giới hạn trong khoảng hợp lệ"""
+    try:
+        timeout = float(value)
+    except (TypeError, ValueError):
+        return HEARTBEAT_TIMEOUT
+    return min(max(timeout, HEARTBEAT_TIMEOUT_MIN), HEARTBEAT_TIMEOUT_MAX)
+
+def build_document(data: dict, timestamp: datetime) -> dict:
+    """Tạo document lưu MongoDB từ dữ liệu agent gửi lên"""
+    return {
+        # Lấy name làm key để identify máy
+        "name": data.get('name', data.get('ip', 'Unknown')),
+        "ip": data.get('ip', ''),
+        "ipwan": data.get('ipwan', ''),
+        "status": data.get('status', 'UNKNOWN'),
+        "port": data.get('port', ''),
+        "statusapp": data.get('statusapp', 0),
+        "last_updated": timestamp,
+        "timestamp": timestamp,
+        "last_seen": timestamp,
+        "heartbeat_timeout": parse_heartbeat_timeout(data.get('heartbeat_timeout'))
+    }
+
+def detect_changes(existing: Optional[dict], data: dict) -> List[str]:
+    """So sánh document cũ với dữ liệu mới, trả về danh sách field thay đổi"""
+    if not existing:
+        return ["New machine added"]
+    
+    changed_fields = []
+    # So sánh từng field quan trọng (KHÔNG bao gồm statusapp để tránh spam)
+    fields_to_check = ['ip', 'ipwan', 'status', 'port', 'name']
+    for field in fields_to_check:
+        old_value = existing.get(field)
+        new_value = data.get(field)
+        if old_value != new_value:
+            changed_fields.append(f"{field}: {old_value} → {new_value}")
+    
+    # Kiểm tra statusapp riêng nhưng không tính là thay đổi quan trọng
+    old_statusapp = existing.get('statusapp')
+    new_statusapp = data.get('statusapp')
+    if old_statusapp != new_statusapp:
+        log_debug("ingest.statusapp", "statusapp changed", machine=data.get("name"), old=old_statusapp, new=new_statusapp)
+    
+    return changed_fields
+
+# Field tạo nên state của máy: chỉ thay đổi ở các field này mới publish qua bus
+# (tăng seq, gửi delta). Heartbeat chỉ đổi last_seen: last_updated/timestamp
+# luôn là thời điểm thay đổi cuối, nên body /logs (cache theo seq) và ETag khớp nhau.
+STATE_FIELDS = ("ip", "ipwan", "status", "port", "statusapp", "heartbeat_timeout")
+
+def is_heartbeat(existing: Optional[dict], document: dict) -> bool:
+    """Report không đổi gì ngoài thời điểm gửi so với state hiện tại"""
+    return existing is not None and all(existing.get(field) == document.get(field) for field in STATE_FIELDS)
+
+def ingest_update(existing: Optional[dict], document: dict) -> dict:
+    """Lệnh update MongoDB cho một report: heartbeat chỉ ghi last_seen, không tăng version"""
+    if is_heartbeat(existing, document):
+        return {"$set": {"last_seen": document["last_seen"]}}
+    return {"$set": document, "$inc": {"version": 1}}
+
+def apply_ingest(existing: Optional[dict], document: dict) -> tuple:
+    """Áp dụng report đã ghi MongoDB vào bộ nhớ (gọi trong ingest lock).
+
+    Trả về (version, Future của bus) - caller await_applied() trước khi nhả lock.
+
+    Heartbeat chỉ làm mới last_seen và deadline liveness, không tạo thay đổi
+    (seq, ETag, delta, /changes giữ nguyên khi fleet không có gì thay đổi).
+    """
+    if is_heartbeat(existing, document):
+        return existing.get("version", 0), touch_machine_state(document["name"], {
+            "last_seen": document["last_seen"]
+        })
+    version = (existing or {}).get("version", 0) + 1
+    return version, apply_versioned_state({**(existing or {}), **document, "version": version})
+
+def observe_ingest(endpoint: str, total: float, parse: float, mongo_write: float, broadcast: float):
+    """Ghi thời gian ingest (giây) theo phase vào metrics"""
+    total_series, parse_series, write_series, broadcast_series = INGEST_SERIES[endpoint]
+    total_series.observe(total)
+    parse_series.observe(parse)
+    write_series.observe(mongo_write)
+    broadcast_series.observe(broadcast)
+
+def log_changes(machine_name: str, changed_fields: List[str]):
+    """Log các thay đổi QUAN TRỌNG của một máy"""
+    if changed_fields:
+        log_info("ingest.change", "Changes detected", machine=machine_name, changes=changed_fields)
+        # Discord không gửi ở đây: AlertEngine (ALERTS_ENABLED=1) nhận thay đổi
+        # từ apply_change() trên leader và gửi qua DiscordOutbox
+
+class KeyedLocks:
+    """asyncio.Lock theo tên máy, tự dọn khi không còn coroutine nào giữ/chờ.
+
+    Ingest giữ lock từ lúc đọc state trong bộ nhớ tới lúc thay đổi đã được
+    áp dụng vào bộ nhớ sau khi ghi MongoDB (await_applied: với UnixSocketBus
+    là lúc hub gửi lại), nên hai request của cùng một máy ghi database và
+    cập nhật bộ nhớ theo cùng một thứ tự (trong một worker).
+    """
+
+    def __init__(self):
+        self._locks: Dict[str, list] = {}  # name -> [lock, số coroutine đang giữ/chờ]
+
+    @asynccontextmanager
+    async def hold(self, names):
+        # Lấy lock theo thứ tự name cố định để hai batch không chờ lẫn nhau
+        waiting, locked = [], []
+        try:
+            for name in sorted(set(names)):
+                entry = self._locks.setdefault(name, [asyncio.Lock(), 0])
+                entry[1] += 1
+                waiting.append(name)
+                await entry[0].acquire()
+                locked.append(name)
+            yield
+        finally:
+            for name in locked:
+                self._locks[name][0].release()
+            for name in waiting:
+                entry = self._locks[name]
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[name]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+ingest_locks = KeyedLocks()
 
 @app.post("/")
 async def receive_data(data: dict):
     """Nhận dữ liệu từ vMix"""
     try:
-        timestamp = datetime.now(VIETNAM_TZ).isoformat()
+        start = time.perf_counter()
+        timestamp = datetime.now(VIETNAM_TZ)
         
-        # Lấy name làm key để identify máy
-        machine_name = data.get('name', data.get('ip', 'Unknown'))
+        # Cập nhật hoặc insert document
+        document = build_document(data, timestamp)
+        machine_name = document["name"]
         
-        # Kiểm tra document cũ để phát hiện thay đổi
-        existing = collection.find_one({"name": machine_name})
-        has_changes = False
-        changed_fields = []
+        # Fleet state trong bộ nhớ là bản mới nhất nên dùng nó để so sánh thay
+        # đổi; MongoDB chỉ được ghi (update_one không trả document về). Lock
+        # theo máy giữ thứ tự ghi MongoDB và áp dụng vào bộ nhớ như nhau.
+        async with ingest_locks.hold([machine_name]):
+            existing = fleet_state.get(machine_name)
+            changed_fields = detect_changes(existing, data)
+            diffed = time.perf_counter()
+            await store.run(
+                store.logs.update_one,
+                {"name": machine_name},
+                ingest_update(existing, document),
+                upsert=True
+            )
+            written = time.perf_counter()
+            version, applied = apply_ingest(existing, document)
+            await await_applied(applied)
+        log_changes(machine_name, changed_fields)
+        done = time.perf_counter()
+        observe_ingest("single", done - start, diffed - start, written - diffed, done - written)
         
-        if existing:
-            # So sánh từng field quan trọng (KHÔNG bao gồm statusapp để tránh spam)
-            fields_to_check = ['ip', 'ipwan', 'status', 'port', 'name']
-            for field in fields_to_check:
-                old_value = existing.get(field)
-                new_value = data.get(field)
-                if old_value != new_value:
-                    has_changes = True
-                    changed_fields.append(f"{field}: {old_value} → {new_value}")
-            
-            # Kiểm tra statusapp riêng nhưng không tính là thay đổi quan trọng
-            old_statusapp = existing.get('statusapp')
-            new_statusapp = data.get('statusapp')
-            if old_statusapp != new_statusapp:
-                print(f"  ℹ️  statusapp changed: {old_statusapp} → {new_statusapp} (không gửi Discord)")
-        else:
-            has_changes = True
-            changed_fields.append("New machine added")
+        return FastJSONResponse(content={
+            "status": "success",
+            "message": f"Data received for {machine_name}",
+            "changes_detected": bool(changed_fields),
+            "modified": existing is not None,
+            "version": version
+        })
+    
+    except Exception as e:
+        log_error("ingest.error", "Error processing data", error=str(e))
+        return FastJSONResponse(content={"error": str(e)}, status_code=500)
+
+@app.post("/batch")
+async def receive_batch(payload: dict):
+    """Nhận trạng thái tất cả port của một máy trong một request.
+
+    Body: {"entries": [{name, ip, ipwan, status, port, statusapp}, ...]}.
+    Ghi bằng một bulk_write duy nhất và chỉ tạo một lần broadcast.
+    """
+    try:
+        entries = payload.get('entries', [])
+        if not isinstance(entries, list) or not entries:
+            return FastJSONResponse(content={"error": "entries must be a non-empty list"}, status_code=400)
         
-        # Cập nhật hoặc insert document
-        document = {
-            "name": machine_name,
-            "ip": data.get('ip', ''),
-            "ipwan": data.get('ipwan', ''),
-            "status": data.get('status', 'UNKNOWN'),
-            "port": data.get('port', ''),
-            "statusapp": data.get('statusapp', 0),
-            "last_updated": timestamp,
-            "timestamp": timestamp
-        }
+        start = time.perf_counter()
+        timestamp = datetime.now(VIETNAM_TZ)
         
-        result = collection.update_one(
-            {"name": machine_name},
-            {"$set": document},
-            upsert=True
-        )
+        # Mỗi name chỉ giữ entry cuối cùng trong batch
+        documents = {}
+        for data in entries:
+            document = build_document(data, timestamp)
+            documents[document["name"]] = (data, document)
         
-        # Nếu có thay đổi QUAN TRỌNG thì log
-        if has_changes:
-            print(f"⚠ Changes detected for {machine_name}:")
-            for change in changed_fields:
-                print(f"  - {change}")
+        # Cùng lock theo máy với POST /: fleet state trong bộ nhớ là bản mới
+        # nhất để so sánh thay đổi, và được cập nhật theo đúng thứ tự ghi MongoDB
+        async with ingest_locks.hold(documents):
+            existing = {name: fleet_state.get(name) for name in documents}
+            changes = {name: detect_changes(existing[name], data) for name, (data, _) in documents.items()}
             
-            # KHÔNG gửi Discord từ server nữa - để GUI tự quản lý
-            # Discord notification bây giờ được gửi từ GUI với logic chống spam
-        
-        # Broadcast update to all WebSocket clients
-        await broadcast_updates()
+            operations = [
+                UpdateOne({"name": name}, ingest_update(existing[name], document), upsert=True)
+                for name, (_, document) in documents.items()
+            ]
+            parsed = time.perf_counter()
+            result = await store.run(store.logs.bulk_write, operations, ordered=False)
+            written = time.perf_counter()
+            
+            applied = [apply_ingest(existing[name], document)[1] for name, (_, document) in documents.items()]
+            await await_applied(*applied)
+        for name in documents:
+            log_changes(name, changes[name])
+        done = time.perf_counter()
+        observe_ingest("batch", done - start, parsed - start, written - parsed, done - written)
         
-        return JSONResponse(content={
+        return FastJSONResponse(content={
             "status": "success",
-            "message": f"Data received for {machine_name}",
-            "changes_detected": has_changes,
-            "modified": result.modified_count > 0
+            "message": f"Batch received for {len(documents)} entries",
+            "count": len(documents),
+            "changes_detected": any(changes.values()),
+            "modified": result.modified_count + result.upserted_count,
+            "results": [
+                {"name": name, "changes_detected": bool(changed_fields)}
+                for name, changed_fields in changes.items()
+            ]
         })
     
     except Exception as e:
-        print(f"✗ Error processing data: {e}")
-        return JSONResponse(content={"error": str(e)}, status_code=500)
+        log_error("ingest.batch_error", "Error processing batch", error=str(e))
+        return FastJSONResponse(content={"error": str(e)}, status_code=500)
+
+async def delete_machine_at(ip: str, port) -> Optional[dict]:
+    """Xóa máy có ip + port (tra registry), trả về document đã xóa hoặc None"""
+    found = registry.by_endpoint(ip, port)
+    if found is None:
+        return None
+    name = found.get("name", "")
+    async with ingest_locks.hold([name]):
+        # Máy có thể đã đổi ip/port hoặc bị xóa trong lúc chờ lock
+        current = fleet_state.get(name)
+        if current is None or (current.get("ip"), current.get("port")) != (ip, port):
+            return None
+        await store.run(store.logs.delete_one, {"name": name})
+        await await_applied(remove_machine_state(name))
+    return current
 
 @app.post("/delete")
 async def delete_data(payload: dict):
@@ -210,59 +2294,119 @@ async def delete_data(payload: dict):
         ip = payload.get('ip', '')
         port = payload.get('port', 0)
         
-        # Xóa theo IP và Port để đảm bảo chính xác
-        query = {
-            "ip": ip,
-            "port": port
-        }
-        
-        result = collection.delete_one(query)
+        # Xóa theo IP và Port để đảm bảo chính xác (tra registry, xóa theo name)
+        deleted = await delete_machine_at(ip, port)
         
-        if result.deleted_count > 0:
-            print(f"✓ Deleted: {name} - {ip}:{port}")
-            # Broadcast update to all WebSocket clients
-            await broadcast_updates()
-            return JSONResponse(content={
+        if deleted:
+            log_info("machines.deleted", "Deleted machine", name=name, ip=ip, port=port)
+            return FastJSONResponse(content={
                 "success": True, 
-                "deleted": result.deleted_count,
+                "deleted": 1,
                 "message": f"Deleted {name} - {ip}:{port}"
             })
         else:
-            print(f"⚠ Not found: {name} - {ip}:{port}")
-            return JSONResponse(content={
+            log_warning("machines.not_found", "Machine to delete not found", name=name, ip=ip, port=port)
+            return FastJSONResponse(content={
                 "success": False,
                 "deleted": 0,
                 "message": f"Not found: {name} - {ip}:{port}"
             })
     except Exception as e:
-        print(f"✗ Delete error: {e}")
-        return JSONResponse(content={"success": False, "error": str(e)}, status_code=500)
+        log_error("machines.delete_error", "Delete error", error=str(e))
+        return FastJSONResponse(content={"success": False, "error": str(e)}, status_code=500)
 
 @app.get("/get_by_ip")
-async def get_by_ip(ip: str):
-    """Lấy dữ liệu theo IP"""
+async def get_by_ip(ip: str, request: Request):
+    """Lấy dữ liệu theo IP từ registry trong bộ nhớ (hỗ trợ If-None-Match → 304)"""
     try:
-        documents = collection.find({"ip": ip})
-        entries = []
+        # Fleet state là write-through nên version không đổi nghĩa là dữ liệu không đổi
+        etag = fleet_etag()
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
         
-        for doc in documents:
-            entry = {
-                "timestamp": doc.get("last_updated", doc.get("timestamp", "")),
-                "data": {
-                    "name": doc.get("name", ""),
-                    "ip": doc.get("ip", ""),
-                    "ipwan": doc.get("ipwan", ""),
-                    "status": doc.get("status", ""),
-                    "port": doc.get("port", ""),
-                    "statusapp": doc.get("statusapp", 0)
-                }
-            }
-            entries.append(entry)
+        entries = [doc_to_entry(doc) for doc in registry.by_ip(ip)]
         
-        return JSONResponse(content=entries)
+        return FastJSONResponse(content=entries, headers={"ETag": etag, "Cache-Control": "no-cache"})
     except Exception as e:
-        print(f"✗ Get by IP error: {e}")
-        return JSONResponse(content={"error": str(e)}, status_code=500)
+        log_error("machines.get_by_ip_error", "Get by IP error", error=str(e))
+        return FastJSONResponse(content={"error": str(e)}, status_code=500)
+
+@app.get("/history")
+async def get_history(name: str, start: Optional[str] = Query(None, alias="from"),
+                      end: Optional[str] = Query(None, alias="to")):
+    """Lịch sử transition của một máy (NDJSON, mỗi dòng một event).
+
+    from/to là ISO datetime (không có timezone thì hiểu là giờ Việt Nam),
+    mặc định là 24 giờ gần nhất.
+    """
+    end_dt = parse_timestamp(end) if end else datetime.now(VIETNAM_TZ)
+    start_dt = parse_timestamp(start) if start else (end_dt - timedelta(days=1) if end_dt else None)
+    if start_dt is None or end_dt is None:
+        return FastJSONResponse(content={"error": "from/to must be ISO datetimes"}, status_code=400)
+    return StreamingResponse(iter_history(name, start_dt, end_dt), media_type="application/x-ndjson")
+
+@app.get("/uptime")
+async def get_uptime(name: Optional[str] = None, start: Optional[str] = Query(None, alias="from"),
+                     end: Optional[str] = Query(None, alias="to")):
+    """Thời gian ON/OFF và % uptime theo máy trong khoảng [from, to).
+
+    from/to được làm tròn theo giờ, mặc định là 24 giờ gần nhất. Bỏ name
+    để lấy cả fleet.
+    """
+    now = datetime.now(VIETNAM_TZ)
+    end_dt = parse_timestamp(end) if end else now
+    start_dt = parse_timestamp(start) if start else (end_dt - timedelta(days=1) if end_dt else None)
+    if start_dt is None or end_dt is None or start_dt >= end_dt:
+        return FastJSONResponse(content={"error": "from/to must be ISO datetimes with from < to"}, status_code=400)
+    
+    # Làm tròn: from xuống đầu giờ, to lên đầu giờ kế tiếp
+    range_start = hour_bucket(start_dt)
+    range_end = hour_bucket(end_dt)
+    if range_end < end_dt:
+        range_end += timedelta(hours=1)
+    
+    try:
+        totals = await store.run(query_uptime, name, range_start, range_end)
+    except Exception as e:
+        log_error("uptime.query_error", "Uptime query error", error=str(e))
+        return FastJSONResponse(content={"error": str(e)}, status_code=500)
+    
+    def add(machine: str, counters: dict):
+        current = totals.setdefault(machine, dict.fromkeys(UPTIME_FIELDS, 0.0))
+        for field in UPTIME_FIELDS:
+            current[field] += counters.get(field, 0)
+    
+    # Cộng thêm phần chưa ghi xuống database (chỉ rollup giờ, tránh đếm hai lần)
+    for (machine, period, bucket_start), counters in uptime_pending.items():
+        if period == "hour" and range_start <= bucket_start < range_end and (not name or machine == name):
+            add(machine, counters)
+    # và khoảng thời gian đang mở của trạng thái hiện tại
+    for machine, (since, srt_on, app_on) in uptime_marks.items():
+        if name and machine != name:
+            continue
+        open_start, open_end = max(since, range_start), min(now, range_end)
+        if open_start < open_end:
+            seconds = (open_end - open_start).total_seconds()
+            add(machine, {
+                "srt_on_seconds" if srt_on else "srt_off_seconds": seconds,
+                "app_on_seconds" if app_on else "app_off_seconds": seconds
+            })
+    
+    machines = {}
+    for machine, counters in sorted(totals.items()):
+        srt_total = counters["srt_on_seconds"] + counters["srt_off_seconds"]
+        app_total = counters["app_on_seconds"] + counters["app_off_seconds"]
+        machines[machine] = {
+            **{field: round(counters[field], 1) for field in UPTIME_FIELDS},
+            "srt_uptime_pct": round(100 * counters["srt_on_seconds"] / srt_total, 2) if srt_total else None,
+            "app_uptime_pct": round(100 * counters["app_on_seconds"] / app_total, 2) if app_total else None
+        }
+    
+    return FastJSONResponse(content={
+        "from": format_timestamp(range_start),
+        "to": format_timestamp(range_end),
+        "machines": machines
+    })
 
 @app.post("/update_name")
 async def update_name(payload: dict):
@@ -272,20 +2416,36 @@ async def update_name(payload: dict):
         new_name = payload.get('new_name', '')
         ip = payload.get('ip', '')
         
-        result = collection.update_many(
+        result = await store.run(
+            store.logs.update_many,
             {"data.ip": ip},
             {"$set": {"data.name": new_name}}
         )
         
-        print(f"✓ Updated {result.modified_count} documents: {old_name} → {new_name}")
-        
-        # Broadcast update to all WebSocket clients
-        await broadcast_updates()
+        log_info("machines.renamed", "Updated machine name", old_name=old_name, new_name=new_name, modified=result.modified_count)
         
-        return JSONResponse(content={"success": True, "modified": result.modified_count})
+        return FastJSONResponse(content={"success": True, "modified": result.modified_count})
     except Exception as e:
-        print(f"✗ Update error: {e}")
-        return JSONResponse(content={"success": False, "error": str(e)}, status_code=500)
+        log_error("machines.rename_error", "Update error", error=str(e))
+        return FastJSONResponse(content={"success": False, "error": str(e)}, status_code=500)
+
+async def update_machine_ip(ip: str, port, new_ip: str) -> Optional[dict]:
+    """Đổi IP của máy có ip + port (tra registry), trả về document trước khi đổi hoặc None"""
+    found = registry.by_endpoint(ip, port)
+    if found is None:
+        return None
+    name = found.get("name", "")
+    async with ingest_locks.hold([name]):
+        current = fleet_state.get(name)
+        if current is None or (current.get("ip"), current.get("port")) != (ip, port):
+            return None
+        await store.run(
+            store.logs.update_one,
+            {"name": name},
+            {"$set": {"ip": new_ip}, "$inc": {"version": 1}}
+        )
+        await await_applied(apply_versioned_state({**current, "ip": new_ip, "version": current.get("version", 0) + 1}))
+    return current
 
 @app.post("/update_ip")
 async def update_ip(payload: dict):
@@ -296,28 +2456,23 @@ async def update_ip(payload: dict):
         port = payload.get('port', 0)
         name = payload.get('name', '')
         
-        # Update document với old_ip và port
-        result = collection.update_one(
-            {"ip": old_ip, "port": port},
-            {"$set": {"ip": new_ip}}
-        )
+        # Tìm máy theo old_ip và port trong registry, update theo name
+        current = await update_machine_ip(old_ip, port, new_ip)
+        modified_count = 1 if current and old_ip != new_ip else 0
         
-        if result.modified_count > 0:
-            print(f"✓ Updated IP for {name} (Port {port}): {old_ip} → {new_ip}")
+        if modified_count > 0:
+            log_info("machines.ip_updated", "Updated machine IP", name=name, port=port, old_ip=old_ip, new_ip=new_ip)
         else:
-            print(f"⚠ No document found to update: {name} - {old_ip}:{port}")
-        
-        # Broadcast update to all WebSocket clients
-        await broadcast_updates()
+            log_warning("machines.not_found", "No document found to update", name=name, ip=old_ip, port=port)
         
-        return JSONResponse(content={
+        return FastJSONResponse(content={
             "success": True, 
-            "modified": result.modified_count,
+            "modified": modified_count,
             "message": f"Updated {name} IP: {old_ip} → {new_ip}"
         })
     except Exception as e:
-        print(f"✗ Update IP error: {e}")
-        return JSONResponse(content={"success": False, "error": str(e)}, status_code=500)
+        log_error("machines.ip_update_error", "Update IP error", error=str(e))
+        return FastJSONResponse(content={"success": False, "error": str(e)}, status_code=500)
 
 @app.post("/save_selected_list")
 async def save_selected_list(payload: dict):
@@ -326,28 +2481,29 @@ async def save_selected_list(payload: dict):
         selected_data = payload.get('selected_data', [])
         
         # Xóa toàn bộ selected list cũ và lưu mới
-        selected_collection.delete_many({})
+        await store.run(store.selected_list.delete_many, {})
         
         if selected_data:
-            selected_collection.insert_many(selected_data)
-            print(f"✓ Saved {len(selected_data)} items to selected list")
+            await store.run(store.selected_list.insert_many, selected_data)
+            log_info("selected.saved", "Saved selected list", count=len(selected_data))
         else:
-            print("✓ Cleared selected list")
+            log_info("selected.saved", "Cleared selected list", count=0)
+        alerts.request_reload()
         
-        return JSONResponse(content={
+        return FastJSONResponse(content={
             "success": True, 
             "count": len(selected_data),
             "message": f"Saved {len(selected_data)} items"
         })
     except Exception as e:
-        print(f"✗ Save selected list error: {e}")
-        return JSONResponse(content={"success": False, "error": str(e)}, status_code=500)
+        log_error("selected.save_error", "Save selected list error", error=str(e))
+        return FastJSONResponse(content={"success": False, "error": str(e)}, status_code=500)
 
 @app.get("/load_selected_list")
 async def load_selected_list():
     """Load selected list từ database"""
     try:
-        documents = selected_collection.find()
+        documents = await store.find_all(store.selected_list, {})
         entries = []
         
         for doc in documents:
@@ -355,114 +2511,710 @@ async def load_selected_list():
             doc.pop('_id', None)
             entries.append(doc)
         
-        print(f"✓ Loaded {len(entries)} items from selected list")
-        return JSONResponse(content=entries)
+        log_info("selected.loaded", "Loaded selected list", count=len(entries))
+        return FastJSONResponse(content=entries)
     except Exception as e:
-        print(f"✗ Load selected list error: {e}")
-        return JSONResponse(content={"error": str(e)}, status_code=500)
+        log_error("selected.load_error", "Load selected list error", error=str(e))
+        return FastJSONResponse(content={"error": str(e)}, status_code=500)
+
+def iter_snapshot_payloads(match: Optional[Callable[[dict], bool]] = None):
+    """Full snapshot dạng nhiều message, mỗi message tối đa SNAPSHOT_CHUNK_SIZE entry.
+
+    {"type": "snapshot", "epoch", "seq", "part", "done", "entries"}: client
+    gom các part từ part 0 tới message có done = true rồi mới thay state.
+    Mỗi part được serialize khi gửi nên không có list toàn fleet trong bộ nhớ.
+    Thay đổi xảy ra trong lúc gửi được bù bằng delta từ `seq` của snapshot.
+    `match` giới hạn snapshot cho client có subscription filter.
+    """
+    seq = state_version
+    entries = iter_fleet_entries(match=match)
+    part = 0
+    chunk = list(islice(entries, SNAPSHOT_CHUNK_SIZE))
+    while True:
+        next_chunk = list(islice(entries, SNAPSHOT_CHUNK_SIZE))
+        yield dumps_text({
+            "type": "snapshot",
+            "epoch": state_epoch,
+            "seq": seq,
+            "part": part,
+            "done": not next_chunk,
+            "entries": chunk
+        })
+        if not next_chunk:
+            return
+        chunk = next_chunk
+        part += 1
+
+def make_delta_payload(upserts: List[dict], deletes: List[str], seq: int) -> str:
+    return dumps_text({
+        "type": "delta",
+        "epoch": state_epoch,
+        "seq": seq,
+        "upserts": upserts,
+        "deletes": deletes
+    })
+
+def get_delta_payload(since: int) -> Optional[str]:
+    """Delta từ seq `since` tới hiện tại, hoặc None nếu phải gửi snapshot"""
+    changes = changes_since(since)
+    if changes is None:
+        return None
+    upserts, deletes = changes
+    return make_delta_payload(upserts, deletes, state_version)
+
+def machine_key(data: dict) -> str:
+    """Khóa ip:port của một máy (document hoặc entry["data"])"""
+    return f"{data.get('ip', '')}:{data.get('port', '')}"
+
+# Các loại filter client có thể subscribe trên /ws
+SUBSCRIPTION_FIELDS = ("names", "keys", "ports", "ipwan", "prefixes")
+
+def parse_subscription(message: dict) -> Dict[str, set]:
+    """{"type": "subscribe", "names": [...], "keys": ["ip:port"], "ports": [...], "ipwan": [...], "prefixes": [...]}"""
+    subscription = {}
+    for field in SUBSCRIPTION_FIELDS:
+        values = message.get(field) or []
+        if not isinstance(values, list):
+            raise ValueError(f"'{field}' must be a list")
+        values = {str(value) for value in values if value not in (None, "")}
+        if values:
+            subscription[field] = values
+    return subscription
+
+class SubscriptionIndex:
+    """Inverted index từ khóa máy (name, ip:port, port, ipwan, prefix của name) tới các client đã subscribe.
+
+    Mỗi thay đổi chỉ tra các key của chính máy đó (prefix: một lần tra cho
+    mỗi độ dài prefix đang được dùng), không duyệt qua từng client.
+    `visible` (name -> client) ghi lại máy nào đã được gửi cho client nào, để
+    gửi delete khi máy bị xóa hoặc không còn khớp filter (vd. đổi IP).
+    """
+
+    def __init__(self):
+        self.index = {field: {} for field in SUBSCRIPTION_FIELDS}
+        self.prefix_lengths = {}  # độ dài prefix -> số lần xuất hiện
+        self.visible = {}
+        self.clients = set()
+
+    def subscribe(self, client: "WSClient", subscription: Dict[str, set]):
+        self.unsubscribe(client)
+        client.subscription = subscription
+        self.clients.add(client)
+        for field, values in subscription.items():
+            for value in values:
+                self.index[field].setdefault(value, set()).add(client)
+                if field == "prefixes":
+                    self.prefix_lengths[len(value)] = self.prefix_lengths.get(len(value), 0) + 1
+
+    def unsubscribe(self, client: "WSClient"):
+        if client.subscription is None:
+            return
+        for field, values in client.subscription.items():
+            for value in values:
+                clients = self.index[field].get(value)
+                if clients is not None:
+                    clients.discard(client)
+                    if not clients:
+                        del self.index[field][value]
+                if field == "prefixes":
+                    self.prefix_lengths[len(value)] -= 1
+                    if not self.prefix_lengths[len(value)]:
+                        del self.prefix_lengths[len(value)]
+        self.clear_visible(client)
+        self.clients.discard(client)
+        client.subscription = None
+
+    def show(self, client: "WSClient", name: str):
+        client.visible.add(name)
+        self.visible.setdefault(name, set()).add(client)
+
+    def hide(self, client: "WSClient", name: str):
+        client.visible.discard(name)
+        clients = self.visible.get(name)
+        if clients is not None:
+            clients.discard(client)
+            if not clients:
+                del self.visible[name]
+
+    def clear_visible(self, client: "WSClient"):
+        for name in list(client.visible):
+            self.hide(client, name)
+
+    def match(self, data: dict) -> set:
+        """Các client có filter khớp với máy này"""
+        name = data.get("name", "")
+        matched = set()
+        for field, key in (("names", name), ("keys", machine_key(data)), ("ports", str(data.get("port", ""))),
+                           ("ipwan", data.get("ipwan", ""))):
+            clients = self.index[field].get(key)
+            if clients:
+                matched |= clients
+        prefixes = self.index["prefixes"]
+        for length in self.prefix_lengths:
+            clients = prefixes.get(name[:length]) if len(name) >= length else None
+            if clients:
+                matched |= clients
+        return matched
+
+    def route(self, upserts: List[dict], deletes: List[str]) -> Dict["WSClient", tuple]:
+        """Chia một delta thành delta riêng cho từng client có filter: client -> (upserts, deletes)"""
+        routed = {}
+        if not self.clients:
+            return routed
+        for entry in upserts:
+            data = entry["data"]
+            name = data.get("name", "")
+            matched = self.match(data)
+            for client in matched:
+                routed.setdefault(client, ([], []))[0].append(entry)
+                self.show(client, name)
+            # Máy không còn khớp filter của client đã nhận nó trước đó
+            for client in self.visible.get(name, set()) - matched:
+                routed.setdefault(client, ([], []))[1].append(name)
+                self.hide(client, name)
+        for name in deletes:
+            for client in list(self.visible.get(name, ())):
+                routed.setdefault(client, ([], []))[1].append(name)
+                self.hide(client, name)
+        return routed
+
+subscriptions = SubscriptionIndex()
+
+class WSClient:
+    """Một WebSocket client với hàng đợi gửi riêng và task gửi riêng.
+
+    broadcast_updates() chỉ đưa payload vào hàng đợi (không await) nên thời
+    gian fan-out không phụ thuộc client chậm nhất. Hàng đợi có giới hạn
+    WS_CLIENT_QUEUE_SIZE: khi đầy thì bỏ toàn bộ backlog và lúc client đọc kịp
+    chỉ gửi trạng thái mới nhất (delta từ seq client đã nhận, hoặc snapshot).
+    Client tụt lại quá WS_SLOW_CLIENT_TIMEOUT giây hoặc một lần gửi quá
+    WS_SEND_TIMEOUT giây bị ngắt với code 1013, client tự reconnect và resume.
+
+    Client có subscription (xem SubscriptionIndex) chỉ nhận các máy khớp
+    filter; khi cần bản mới nhất thì luôn nhận snapshot của các máy đó.
+    """
+
+    def __init__(self, websocket: WebSocket, since: Optional[int] = None):
+        self.websocket = websocket
+        self.queue = deque()  # (payload, epoch, seq, is_delta)
+        self.sent_epoch = state_epoch if since is not None else None
+        self.sent_seq = since
+        self.resync = True  # Lần gửi đầu tiên: delta từ `since` hoặc full snapshot
+        self.backlogged_since = None
+        self.closed = False
+        self.subscription = None  # None = toàn bộ fleet
+        self.visible = set()  # Các máy đã gửi cho client (khi có subscription)
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        """Client đã ngắt kết nối: dừng task gửi"""
+        self.closed = True
+        if self._task is not None:
+            self._task.cancel()
+        self._detach()
+
+    def _detach(self):
+        if self in active_connections:
+            active_connections.remove(self)
+        subscriptions.unsubscribe(self)
+
+    def matches(self, data: dict) -> bool:
+        """Máy có khớp subscription của client không (dùng cho snapshot)"""
+        sub = self.subscription
+        if sub is None:
+            return True
+        name = data.get("name", "")
+        return (name in sub.get("names", ())
+                or machine_key(data) in sub.get("keys", ())
+                or str(data.get("port", "")) in sub.get("ports", ())
+                or data.get("ipwan", "") in sub.get("ipwan", ())
+                or any(name.startswith(prefix) for prefix in sub.get("prefixes", ())))
+
+    def enqueue(self, payload: Optional[str], seq: int, is_delta: bool = True):
+        """payload None = keepalive (tạo lúc gửi, kèm seq client đã nhận)"""
+        if self.closed:
+            return
+        if not self.resync:
+            if len(self.queue) < WS_CLIENT_QUEUE_SIZE:
+                self.queue.append((payload, state_epoch, seq, is_delta))
+                self._wakeup.set()
+                return
+            # Hàng đợi đầy: bản mới nhất thay cho toàn bộ backlog
+            self.queue.clear()
+            self.resync = True
+            broadcast_stats["resyncs"] += 1
+            self._wakeup.set()
+        now = time.monotonic()
+        if self.backlogged_since is None:
+            self.backlogged_since = now
+        elif now - self.backlogged_since > WS_SLOW_CLIENT_TIMEOUT:
+            self.evict(f"behind for {now - self.backlogged_since:.0f}s")
+
+    def request_resync(self, snapshot: bool = False):
+        """Delta chung không dùng được (vd. epoch mới): gửi bản mới nhất cho client này"""
+        if snapshot:
+            self.sent_epoch = None
+        self.queue.clear()
+        self.resync = True
+        self._wakeup.set()
+
+    def evict(self, reason: str):
+        if self.closed:
+            return
+        self.closed = True
+        broadcast_stats["evicted"] += 1
+        log_warning("ws.evict", "Evicting slow WebSocket client", reason=reason)
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _send(self, payload: str):
+        send_start = time.perf_counter()
+        await asyncio.wait_for(self.websocket.send_text(payload), WS_SEND_TIMEOUT)
+        WS_SEND_SERIES.observe(time.perf_counter() - send_start)
+
+    async def _send_latest(self):
+        """Gửi trạng thái mới nhất: delta từ seq đã gửi nếu resume được, không thì full snapshot"""
+        payload = None
+        if self.subscription is None and self.sent_epoch == state_epoch and self.sent_seq is not None:
+            payload = get_delta_payload(self.sent_seq)
+        epoch, seq = state_epoch, state_version
+        if payload:
+            await self._send(payload)
+        elif self.subscription is None:
+            for part in iter_snapshot_payloads():
+                await self._send(part)
+        else:
+            # Snapshot chỉ gồm các máy khớp filter - thường chỉ vài máy nên rẻ
+            # hơn việc tính xem client còn giữ máy nào
+            def match(doc: dict) -> bool:
+                if not self.matches(doc):
+                    return False
+                subscriptions.show(self, doc.get("name", ""))
+                return True
+            subscriptions.clear_visible(self)
+            for part in iter_snapshot_payloads(match):
+                await self._send(part)
+        self.sent_epoch, self.sent_seq = epoch, seq
+
+    async def _run(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                if self.resync:
+                    self.resync = False
+                    await self._send_latest()
+                while self.queue and not self.resync:
+                    payload, epoch, seq, is_delta = self.queue.popleft()
+                    if is_delta:
+                        # Đã nằm trong bản mới nhất vừa gửi
+                        if epoch == self.sent_epoch and seq <= self.sent_seq:
+                            continue
+                        if epoch != state_epoch:
+                            continue
+                    elif payload is None:
+                        if self.sent_seq is None:
+                            continue
+                        payload = dumps_text({"type": "keepalive", "epoch": self.sent_epoch, "seq": self.sent_seq})
+                    await self._send(payload)
+                    if is_delta:
+                        self.sent_epoch, self.sent_seq = epoch, seq
+                if not self.queue and not self.resync:
+                    self.backlogged_since = None
+        except asyncio.CancelledError:
+            pass
+        except asyncio.TimeoutError:
+            if not self.closed:
+                self.closed = True
+                broadcast_stats["evicted"] += 1
+                log_warning("ws.evict", "Evicting slow WebSocket client", reason=f"send timed out after {WS_SEND_TIMEOUT:g}s")
+        except Exception as e:
+            log_info("ws.send_failed", "Failed to send to client", error=str(e))
+            self.closed = True
+        finally:
+            self._detach()
+        if self.closed:
+            try:
+                await self.websocket.close(code=1013)
+            except Exception:
+                pass
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    """WebSocket endpoint for realtime updates"""
+    """WebSocket endpoint for realtime updates.
+
+    Client mới nhận full snapshot. Client reconnect có thể gửi
+    `/ws?since=<seq>&epoch=<epoch>` để chỉ nhận các thay đổi bị lỡ.
+    Sau đó broadcaster() đưa delta chung vào hàng đợi của từng client.
+
+    Subscription filter: client gửi
+    {"type": "subscribe", "names": [...], "keys": ["ip:port"], "ports": [...], "ipwan": [...], "prefixes": [...]}
+    để chỉ nhận các máy khớp một trong các điều kiện (snapshot mới của các
+    máy đó, sau đó là delta đã lọc), {"type": "unsubscribe"} để nhận lại toàn
+    bộ fleet. Với `/ws?filtered=1` server chờ message subscribe đầu tiên rồi
+    mới gửi dữ liệu, tránh gửi full snapshot thừa lúc kết nối.
+    """
     await websocket.accept()
-    active_connections.append(websocket)
-    print(f"✓ WebSocket client connected. Total connections: {len(active_connections)}")
+    
+    since = websocket.query_params.get("since")
+    if since is not None and websocket.query_params.get("epoch") == state_epoch:
+        try:
+            since = int(since)
+        except ValueError:
+            since = None
+    else:
+        since = None
+    
+    # Đăng ký ngay: WSClient tự gửi delta/snapshot ban đầu rồi mới gửi các
+    # delta trong hàng đợi có seq mới hơn
+    client = WSClient(websocket, since)
+    if websocket.query_params.get("filtered") != "1":
+        active_connections.append(client)
+        client.start()
+        log_info("ws.connected", "WebSocket client connected", connections=len(active_connections))
     
     try:
-        # Send initial data
-        data = get_all_logs()
-        await websocket.send_json(data)
-        
-        # Keep connection alive and send updates every 5 seconds
+        # Đọc subscription message, đồng thời giữ connection và phát hiện client ngắt kết nối
         while True:
-            data = get_all_logs()
-            await websocket.send_json(data)
-            await asyncio.sleep(5)
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+                msg_type = message.get("type") if isinstance(message, dict) else None
+                if msg_type == "subscribe":
+                    subscription = parse_subscription(message)
+                    if client._task is not None and subscription == client.subscription:
+                        continue  # Filter không đổi - không cần snapshot mới
+                    subscriptions.subscribe(client, subscription)
+                elif msg_type == "unsubscribe":
+                    if client._task is not None and client.subscription is None:
+                        continue  # Client chưa từng có filter - giữ nguyên delta/resume
+                    subscriptions.unsubscribe(client)
+                else:
+                    continue
+            except ValueError as e:
+                log_warning("ws.invalid_message", "Invalid WebSocket message", error=str(e))
+                continue
+            
+            if client._task is None:
+                active_connections.append(client)
+                client.start()
+                log_info("ws.connected", "WebSocket client connected", connections=len(active_connections), filtered=True)
+            else:
+                client.request_resync(snapshot=True)
             
     except WebSocketDisconnect:
-        active_connections.remove(websocket)
-        print(f"⚠ WebSocket client disconnected. Total connections: {len(active_connections)}")
+        client.stop()
+        log_info("ws.disconnected", "WebSocket client disconnected", connections=len(active_connections))
     except Exception as e:
-        print(f"✗ WebSocket error: {e}")
-        if websocket in active_connections:
-            active_connections.remove(websocket)
+        log_error("ws.error", "WebSocket error", error=str(e))
+        client.stop()
 
-async def broadcast_updates():
-    """Broadcast updates to all connected WebSocket clients"""
+def broadcast_updates(upserts: List[dict], deletes: List[str], seq: int):
+    """Đưa một delta vào hàng đợi của tất cả WebSocket clients.
+
+    Client không có subscription nhận chung một payload serialize một lần;
+    client có subscription chỉ nhận delta của các máy khớp filter (nếu có).
+    """
     if not active_connections:
         return
     
-    data = get_all_logs()
-    disconnected = []
-    
-    for connection in active_connections:
-        try:
-            await connection.send_json(data)
-        except Exception as e:
-            print(f"✗ Failed to send to client: {e}")
-            disconnected.append(connection)
-    
-    # Remove disconnected clients
-    for connection in disconnected:
-        active_connections.remove(connection)
+    fanout_start = time.perf_counter()
+    payload = None
+    for client in list(active_connections):
+        if client.subscription is None:
+            if payload is None:
+                payload = make_delta_payload(upserts, deletes, seq)
+            client.enqueue(payload, seq)
+    for client, (client_upserts, client_deletes) in subscriptions.route(upserts, deletes).items():
+        client.enqueue(make_delta_payload(client_upserts, client_deletes, seq), seq)
+    WS_FANOUT_SERIES.observe(time.perf_counter() - fanout_start)
 
-async def check_inactive_machines():
-    """Background task: Kiểm tra và tự động set statusapp = 0 nếu máy không gửi request trong 1 phút"""
+async def broadcaster():
+    """Background task duy nhất gửi update cho mọi WebSocket client.
+
+    Mutation chỉ đánh dấu state đã thay đổi; broadcaster gửi tối đa một lần
+    mỗi BROADCAST_WINDOW giây, gộp mọi thay đổi trong khoảng đó thành một
+    delta và serialize một lần. Nếu không có gì thay đổi trong
+    WS_KEEPALIVE_INTERVAL giây thì gửi một keepalive nhỏ (kèm seq để client
+    tự phát hiện nếu bị lỡ update).
+    """
+    loop = asyncio.get_running_loop()
+    sent_version = state_version
+    last_emit = 0.0
     while True:
         try:
-            # Chờ 30 giây trước mỗi lần kiểm tra
-            await asyncio.sleep(30)
-            
-            # Lấy thời gian hiện tại
-            now = datetime.now(VIETNAM_TZ)
-            timeout_threshold = now - timedelta(minutes=1)
+            try:
+                await asyncio.wait_for(state_changed.wait(), WS_KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
             
-            # Tìm tất cả máy có statusapp = 1 (đang ON)
-            active_machines = collection.find({"statusapp": 1})
-            
-            updated_count = 0
-            for machine in active_machines:
-                last_updated_str = machine.get("last_updated", "")
-                
-                if last_updated_str:
-                    try:
-                        # Parse last_updated timestamp
-                        last_updated = datetime.fromisoformat(last_updated_str)
-                        
-                        # Nếu quá 1 phút không update → set statusapp = 0
-                        if last_updated < timeout_threshold:
-                            machine_name = machine.get("name", "Unknown")
-                            ip = machine.get("ip", "")
-                            
-                            # Update statusapp = 0
-                            collection.update_one(
-                                {"_id": machine["_id"]},
-                                {"$set": {"statusapp": 0}}
-                            )
-                            
-                            updated_count += 1
-                            print(f"⏱️  Auto-OFF: {machine_name} ({ip}) - No activity for 1 minute")
-                    
-                    except Exception as e:
-                        print(f"⚠ Error parsing timestamp for {machine.get('name', 'Unknown')}: {e}")
-            
-            # Nếu có máy nào bị auto-off, broadcast update
-            if updated_count > 0:
-                print(f"✓ Auto-OFF applied to {updated_count} machine(s)")
-                await broadcast_updates()
+            if state_version != sent_version:
+                # Chờ hết window kể từ lần gửi trước để gộp thêm các thay đổi tới sau
+                delay = last_emit + BROADCAST_WINDOW - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                state_changed.clear()
                 
+                pending = state_version - sent_version
+                changes = changes_since(sent_version)
+                sent_version = state_version
+                last_emit = loop.time()
+                broadcast_stats["emitted"] += 1
+                broadcast_stats["coalesced"] += pending - 1
+                if changes is not None:
+                    broadcast_updates(*changes, sent_version)
+                    log_debug("broadcast.emit", "Broadcast delta", seq=sent_version, upserts=len(changes[0]),
+                              deletes=len(changes[1]), clients=len(active_connections))
+                else:
+                    # Không có delta chung (vd. epoch mới): mỗi client tự lấy bản mới nhất
+                    for client in list(active_connections):
+                        client.request_resync()
+                wake_long_poll()
+            else:
+                state_changed.clear()
+                broadcast_stats["keepalives"] += 1
+                # Keepalive mang seq cuối cùng mỗi client đã nhận (client có
+                # subscription không nhận delta của các máy ngoài filter)
+                for client in list(active_connections):
+                    client.enqueue(None, state_version, is_delta=False)
+        except Exception as e:
+            log_error("broadcast.error", "Error in broadcaster", error=str(e))
+
+def mark_machines_off(expired: List[tuple]) -> List[dict]:
+    """Set statusapp = 0 cho các máy hết hạn heartbeat (chạy trong executor).
+
+    expired: [(name, last_seen)]. Mỗi máy chỉ bị OFF nếu last_seen trong
+    database vẫn chưa mới hơn (tránh ghi đè heartbeat vừa tới). Document cũ
+    chưa có last_seen cũng khớp điều kiện $not/$gt.
+    Một update_many duy nhất, các document bị ảnh hưởng được đánh dấu bằng
+    sweep id để đọc lại (qua index) phục vụ broadcast.
+    """
+    sweep_id = ObjectId()
+    result = store.logs.update_many(
+        {
+            "$or": [{"name": name, "last_seen": {"$not": {"$gt": last_seen}}} for name, last_seen in expired],
+            "statusapp": 1
+        },
+        {"$set": {"statusapp": 0, "auto_off_sweep": sweep_id}, "$inc": {"version": 1}}
+    )
+    if result.modified_count == 0:
+        return []
+    return list(store.logs.find(
+        {"auto_off_sweep": sweep_id},
+        {"_id": 0, "name": 1, "ip": 1, "version": 1, "heartbeat_timeout": 1}
+    ))
+
+async def on_heartbeat_expired(expired: List[tuple]):
+    """Callback của LivenessTracker: auto-OFF các máy quá hạn heartbeat"""
+    sweep_start = time.perf_counter()
+    # Cùng lock với ingest: heartbeat tới trong lúc sweep được ghi sau auto-OFF
+    # ở cả MongoDB lẫn bộ nhớ
+    async with ingest_locks.hold([name for name, _ in expired]):
+        try:
+            affected = await store.run(mark_machines_off, expired)
         except Exception as e:
-            print(f"✗ Error in check_inactive_machines: {e}")
+            log_error("auto_off.error", "Error in auto-OFF", error=str(e), retry_in=AUTO_OFF_RETRY)
+            liveness.retry(expired, AUTO_OFF_RETRY)
+            return
+        finally:
+            AUTO_OFF_SECONDS.observe(time.perf_counter() - sweep_start)
+        await await_applied(*[
+            update_machine_fields(machine.get("name", "Unknown"), {
+                "statusapp": 0,
+                "version": machine.get("version", 0)
+            })
+            for machine in affected
+        ])
+    AUTO_OFF_MACHINES.inc(amount=len(affected))
+    
+    for machine in affected:
+        machine_name = machine.get("name", "Unknown")
+        timeout = machine.get("heartbeat_timeout", HEARTBEAT_TIMEOUT)
+        log_info("auto_off.machine", "Auto-OFF: no activity", machine=machine_name, ip=machine.get('ip', ''), timeout=timeout)
+    
+    # Nếu có máy nào bị auto-off, broadcaster sẽ tự gửi update
+    if affected:
+        log_info("auto_off.applied", "Auto-OFF applied", count=len(affected))
+
+class LivenessTracker:
+    """Deadline scheduler cho heartbeat của từng máy.
+
+    Mỗi máy đang ON có một deadline = last_seen + timeout. Deadline được
+    giữ trong min-heap (lazy deletion: entry cũ bị bỏ qua khi pop), nên mỗi
+    heartbeat tốn O(log n) và task chỉ thức dậy đúng lúc deadline sớm nhất
+    tới hạn thay vì quét toàn bộ fleet định kỳ.
+    """
+
+    def __init__(self, on_expired):
+        self._on_expired = on_expired
+        self._heap = []  # (deadline epoch seconds, name)
+        self._deadlines: Dict[str, tuple] = {}  # name -> (deadline, last_seen)
+        self._wakeup = asyncio.Event()
+
+    def refresh(self, name: str, last_seen: datetime, timeout: float):
+        """Đặt lại deadline của máy sau mỗi lần ingest"""
+        deadline = last_seen.timestamp() + timeout
+        current = self._deadlines.get(name)
+        if current is not None and current[0] == deadline:
+            return
+        self._deadlines[name] = (deadline, last_seen)
+        heapq.heappush(self._heap, (deadline, name))
+        if self._heap[0][1] == name:
+            self._wakeup.set()
+        # Dọn entry cũ khi heap phình to vì lazy deletion
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(deadline, name) for name, (deadline, _) in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def retry(self, expired: List[tuple], delay: float):
+        """Đặt lại deadline sau `delay` giây cho các máy auto-OFF chưa ghi được.
+
+        Máy đã có deadline mới (heartbeat tới trong lúc sweep) hoặc đã bị xóa
+        khỏi fleet state thì giữ nguyên.
+        """
+        deadline = time.time() + delay
+        for name, last_seen in expired:
+            if name in self._deadlines or name not in fleet_state:
+                continue
+            self._deadlines[name] = (deadline, last_seen)
+            heapq.heappush(self._heap, (deadline, name))
+        self._wakeup.set()
+
+    def discard(self, name: str):
+        """Bỏ theo dõi máy (đã OFF hoặc bị xóa)"""
+        self._deadlines.pop(name, None)
+
+    def clear(self):
+        """Bỏ theo dõi mọi máy (trước khi load lại fleet state)"""
+        self._deadlines.clear()
+        self._heap.clear()
+
+    def _pop_expired(self, now: float) -> List[tuple]:
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, name = heapq.heappop(self._heap)
+            current = self._deadlines.get(name)
+            if current is not None and current[0] == deadline:
+                del self._deadlines[name]
+                expired.append((name, current[1]))
+        return expired
+
+    async def run(self):
+        while True:
+            try:
+                expired = self._pop_expired(time.time())
+                if expired:
+                    await self._on_expired(expired)
+                
+                self._wakeup.clear()
+                timeout = max(0.0, self._heap[0][0] - time.time()) if self._heap else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except Exception as e:
+                log_error("auto_off.tracker_error", "Error in liveness tracker", error=str(e))
+                await asyncio.sleep(1)
+
+liveness = LivenessTracker(on_heartbeat_expired)
+
+def track_liveness(name: str):
+    """Cập nhật deadline heartbeat theo state hiện tại của máy (chỉ worker leader auto-OFF)"""
+    doc = fleet_state.get(name)
+    last_seen = parse_timestamp(doc.get("last_seen") or doc.get("last_updated")) if doc else None
+    if not bus.is_leader or doc is None or doc.get("statusapp") != 1 or last_seen is None:
+        liveness.discard(name)
+        return
+    liveness.refresh(name, last_seen, doc.get("heartbeat_timeout", HEARTBEAT_TIMEOUT))
 
 @app.on_event("startup")
 async def startup_event():
     """Start background tasks when server starts"""
-    asyncio.create_task(check_inactive_machines())
-    print("✓ Background task started: Auto-OFF inactive machines (1 min timeout)")
+    try:
+        await store.run(store.connect, timeout=30)
+        log_info("startup.mongo", "Connected to MongoDB", pool_size=store.pool_size, op_timeout=store.op_timeout)
+    except Exception as e:
+        log_error("startup.mongo_error", "MongoDB connection error", error=str(e))
+        raise RuntimeError(f"MongoDB connection error: {e}")
+    
+    migrated = await store.run(migrate_string_timestamps, timeout=120)
+    if migrated:
+        log_info("startup.migrated", "Migrated documents to BSON date timestamps", count=migrated)
+    report = await store.run(prepare_indexes, timeout=60)
+    log_info("startup.indexes", "Indexes ready", indexes=list(report['indexes']))
+    # Load fleet state (qua bus: seq/epoch chung giữa các worker)
+    await bus.start()
+    
+    asyncio.create_task(broadcaster())
+    asyncio.create_task(liveness.run())
+    asyncio.create_task(history_writer())
+    asyncio.create_task(uptime_writer())
+    asyncio.create_task(outbox.run())
+    asyncio.create_task(alerts.run())
+    if alerts.enabled:
+        log_info("startup.alerts", "Alert engine enabled", prefix=alerts.prefix, window_ms=ALERT_WINDOW * 1000)
+    log_info("startup.ready", "Background tasks started", heartbeat_timeout=HEARTBEAT_TIMEOUT)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Ghi nốt history còn trong hàng đợi và đóng kết nối MongoDB khi server dừng"""
+    batch = drain_history_queue(limit=100000)
+    if batch:
+        try:
+            await write_history(batch)
+        except Exception as e:
+            log_error("history.flush_error", "Error flushing status history", error=str(e))
+    checkpoint_uptime(datetime.now(VIETNAM_TZ))
+    try:
+        await flush_uptime()
+    except Exception as e:
+        log_error("uptime.flush_error", "Error flushing uptime rollups", error=str(e))
+    await bus.close()
+    await outbox.close()
+    store.close()
+
+def check_indexes_cli():
+    """python server.py --check-indexes: tạo index, in báo cáo, exit 1 nếu có COLLSCAN"""
+    store.connect()
+    ensure_indexes(store.logs, LOGS_INDEXES)
+    ensure_indexes(store.history, HISTORY_INDEXES)
+    ensure_indexes(store.uptime, UPTIME_INDEXES)
+    ensure_indexes(store.outbox, OUTBOX_INDEXES)
+    report = index_report()
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    store.close()
+    sys.exit(0 if report["ok"] else 1)
+
+def check_registry_cli():
+    """python server.py --check-registry [url]: kiểm tra registry của server đang chạy
+    với MongoDB (qua /admin/registry), in báo cáo, exit 1 nếu có khác biệt"""
+    args = sys.argv[sys.argv.index("--check-registry") + 1:]
+    base_url = args[0] if args and not args[0].startswith("-") else f"http://localhost:{PORT}"
+    response = httpx.get(base_url.rstrip("/") + "/admin/registry", timeout=60)
+    report = response.json()
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    sys.exit(0 if response.status_code == 200 and report.get("ok") else 1)
 
 if __name__ == "__main__":
+    if "--check-indexes" in sys.argv:
+        check_indexes_cli()
+    if "--check-registry" in sys.argv:
+        check_registry_cli()
+    
     import uvicorn
-    print(f"🚀 Starting WebSocket server on http://localhost:{PORT}")
-    print(f"📡 WebSocket endpoint: ws://localhost:{PORT}/ws")
-    print(f"🔌 REST API endpoint: http://localhost:{PORT}/")
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    workers = int(os.getenv('WEB_CONCURRENCY', 1))
+    log_info("startup.listen", "Starting WebSocket server", url=f"http://localhost:{PORT}",
+             websocket=f"ws://localhost:{PORT}/ws")
+    if workers > 1:
+        # Nhiều worker cần bus chung để thay đổi ở worker này tới client của worker khác
+        os.environ.setdefault('STATE_BUS', 'unix')
+        log_info("startup.workers", "Starting multiple workers", workers=workers, bus=os.environ['STATE_BUS'])
+        uvicorn.run("server:app", host="0.0.0.0", port=PORT, workers=workers,
+                    ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=PORT, ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE)
@@ -6,7 +6,8 @@ import threading
 import json
 from datetime import datetime
 import pytz
-import websocket
+from websockets.sync.client import connect as ws_connect
+from websockets.exceptions import ConnectionClosed
 import time
 
 # Set appearance mode and color theme
@@ -34,6 +35,7 @@ class ServerDataGUI:
 
         self.api_url = "https://tooldiscordvmix.onrender.com/logs"
         self.ws_url = "wss://tooldiscordvmix.onrender.com/ws"
+        self.changes_url = "https://tooldiscordvmix.onrender.com/changes"
         self.webhook_var = ctk.StringVar(value="https://discord.com/api/webhooks/1448559948408684669/s6plN6AIy9IFBo6coyNCF9YmmHIfIIVe-tEntpPnArRGI0JdIyl1pCz10rL5TyTP1JV6")
         self.prefix_var = ctk.StringVar(value="SRT")
         self.data = []  # All data from database
@@ -49,6 +51,24 @@ class ServerDataGUI:
         self.use_websocket = True  # Set False to fallback to REST API
         self.ws_reconnect_attempts = 0
         self.rest_polling_active = False  # Flag cho REST polling backup
+        # Mỗi lần WebSocket kết nối lại / bắt đầu long-poll mới thì tăng: thread
+        # long-poll cũ (có thể đang chờ request 25s) thấy generation đổi thì dừng
+        self.rest_poll_generation = 0
+        # Bảo vệ feed state (ws_entries, ws_seq, ws_epoch, ws_filtered, data) giữa
+        # thread WebSocket và thread long-poll
+        self.feed_lock = threading.RLock()
+        # Delta feed state: máy theo name + seq/epoch cuối cùng đã nhận (để resume)
+        self.ws_entries = {}
+        self.ws_seq = None
+        self.ws_epoch = None
+        self.ws_snapshot_parts = None  # Snapshot nhiều phần đang nhận dở
+        self.ws_filtered = False  # Connection hiện tại đang dùng subscription filter
+        self.ws_awaiting_subscription = False  # Connection mở với ?filtered=1, server chờ message đầu tiên
+        # Chỉ nhận realtime update của các máy trong selected list (subscription filter
+        # phía server). Mặc định tắt: khi bật, bảng trái chỉ cập nhật khi bấm Scan máy
+        self.ws_selected_only = ctk.BooleanVar(value=False)
+        # ETag của lần GET /logs gần nhất (conditional GET → 304 khi không đổi)
+        self.logs_etag = None
 
         # Top controls
         top_frame = ctk.CTkFrame(self.root)
@@ -71,6 +91,8 @@ class ServerDataGUI:
         ctk.CTkButton(row2, text="� Scan máy", command=self.refresh_data, fg_color="#4CAF50", hover_color="#45a049", width=110, font=("Arial", 12, "bold")).pack(side="left", padx=3)
         self.toggle_btn = ctk.CTkButton(row2, text="AUTO SEND: OFF", command=self.toggle_auto_send, fg_color="#9E9E9E", hover_color="#757575", width=140, font=("Arial", 12, "bold"))
         self.toggle_btn.pack(side="left", padx=3)
+        ctk.CTkSwitch(row2, text="WS: chỉ list đã chọn", variable=self.ws_selected_only,
+                      command=self.send_ws_subscription, width=60).pack(side="left", padx=3)
         ctk.CTkButton(row2, text="➡️ Add", command=self.add_to_selected, fg_color="#2196F3", hover_color="#1976D2", width=90).pack(side="left", padx=3)
         ctk.CTkButton(row2, text="🗑️ Clear", command=self.clear_selected, fg_color="#f44336", hover_color="#d32f2f", width=90).pack(side="left", padx=3)
         ctk.CTkButton(row2, text="💾 Save", command=self.save_selected_to_file, fg_color="#9C27B0", hover_color="#7B1FA2", width=90).pack(side="left", padx=3)
@@ -164,28 +186,8 @@ class ServerDataGUI:
         """Kết nối WebSocket để nhận realtime updates"""
         def on_message(ws, message):
             try:
-                data = json.loads(message)
-                print(f"📩 WebSocket received: {len(data)} items")
-                
-                # Update data
-                if isinstance(data, list):
-                    # Check if có thay đổi về danh sách IP+Port
-                    has_list_changed = self.has_data_changed(self.data, data)
-                    
-                    self.data = data
-                    
-                    # Nếu có thay đổi danh sách -> update bảng trái
-                    if has_list_changed:
-                        print("✓ WebSocket: Danh sách máy thay đổi, update bảng trái")
-                        self.root.after(0, self.update_all_table)
-                    
-                    # Luôn update selected data và bảng phải
-                    self.update_selected_data()
-                    self.root.after(0, self.update_selected_table)
-                    
-                    # Check for changes and send Discord
-                    if self.auto_send_enabled:
-                        self.send_to_discord_auto()
+                with self.feed_lock:
+                    self.on_feed_update(self.apply_ws_message(json.loads(message)))
             except json.JSONDecodeError as e:
                 print(f"✗ WebSocket JSON error: {e}")
             except Exception as e:
@@ -212,21 +214,48 @@ class ServerDataGUI:
         
         def on_open(ws):
             print("✓ WebSocket connected!")
-            self.ws_connected = True
-            self.ws_reconnect_attempts = 0  # Reset counter
-            self.rest_polling_active = False  # Stop REST polling
+            with self.feed_lock:
+                self.ws_connected = True
+                self.ws_reconnect_attempts = 0  # Reset counter
+                # Stop REST polling: thread đang chờ /changes sẽ bỏ kết quả và dừng
+                self.rest_polling_active = False
+                self.rest_poll_generation += 1
+                self.ws_snapshot_parts = None  # Bỏ snapshot nhận dở của connection trước
+            self.send_ws_subscription()
             self.root.after(0, lambda: self.status_label.configure(text="🟢 Connected", text_color="#4CAF50"))
         
         def run_ws():
             try:
-                self.ws = websocket.WebSocketApp(
-                    self.ws_url,
-                    on_message=on_message,
-                    on_error=on_error,
-                    on_close=on_close,
-                    on_open=on_open
-                )
-                self.ws.run_forever()
+                url = self.ws_url
+                with self.feed_lock:
+                    self.ws_filtered = False  # Connection mới chưa có filter
+                    self.ws_awaiting_subscription = self.ws_selected_only.get()
+                    if self.ws_awaiting_subscription:
+                        # Server chờ message subscribe rồi mới gửi snapshot của các máy đã chọn
+                        url = f"{self.ws_url}?filtered=1"
+                    elif self.ws_seq is not None and self.ws_epoch:
+                        # Resume: server chỉ gửi các thay đổi bị lỡ kể từ seq này
+                        url = f"{self.ws_url}?since={self.ws_seq}&epoch={self.ws_epoch}"
+                try:
+                    # permessage-deflate: snapshot/delta lặp lại cùng key cho mỗi máy nên nén rất tốt
+                    self.ws = ws_connect(url, compression="deflate", open_timeout=30, max_size=None)
+                except Exception as e:
+                    on_error(None, e)
+                    on_close(None, None, None)
+                    return
+                
+                on_open(self.ws)
+                close_code, close_msg = None, None
+                try:
+                    while True:
+                        on_message(self.ws, self.ws.recv())
+                except ConnectionClosed as e:
+                    if e.rcvd is not None:
+                        close_code, close_msg = e.rcvd.code, e.rcvd.reason
+                except Exception as e:
+                    on_error(self.ws, e)
+                    self.ws.close()
+                on_close(self.ws, close_code, close_msg)
             except Exception as e:
                 print(f"✗ WebSocket connection failed: {e}")
                 print("⚠ Falling back to REST API polling...")
@@ -238,56 +267,192 @@ class ServerDataGUI:
         self.ws_thread = threading.Thread(target=run_ws, daemon=True)
         self.ws_thread.start()
     
+    def on_feed_update(self, data):
+        """Cập nhật bảng và gửi Discord với danh sách entry mới từ WebSocket/long-poll"""
+        # Subscription filter: chỉ nhận các máy trong selected list
+        if isinstance(data, list) and self.ws_filtered:
+            self.update_selected_data(data)
+            self.root.after(0, self.update_selected_table)
+            if self.auto_send_enabled:
+                self.send_to_discord_auto()
+        
+        # Update data
+        elif isinstance(data, list):
+            # Check if có thay đổi về danh sách IP+Port
+            has_list_changed = self.has_data_changed(self.data, data)
+            
+            self.data = data
+            
+            # Nếu có thay đổi danh sách -> update bảng trái
+            if has_list_changed:
+                print("✓ Danh sách máy thay đổi, update bảng trái")
+                self.root.after(0, self.update_all_table)
+            
+            # Luôn update selected data và bảng phải
+            self.update_selected_data()
+            self.root.after(0, self.update_selected_table)
+            
+            # Check for changes and send Discord
+            if self.auto_send_enabled:
+                self.send_to_discord_auto()
+    
+    def send_ws_subscription(self):
+        """Gửi subscription filter theo selected list (hoặc bỏ filter) cho server.
+
+        Máy có tên được subscribe theo name, máy chưa có tên theo port - cùng
+        khóa update_selected_data dùng để match, nên máy đổi IP vẫn nằm trong
+        feed. Server trả về snapshot mới của các máy khớp filter. Chỉ gửi
+        unsubscribe khi đang có filter (hoặc server đang chờ message đầu tiên):
+        unsubscribe thừa làm server gửi lại full snapshot sau delta resume.
+        """
+        if self.ws is None or not self.ws_connected:
+            return
+        if not self.ws_selected_only.get() and not self.ws_filtered and not self.ws_awaiting_subscription:
+            return
+        if self.ws_selected_only.get():
+            names, ports = [], []
+            for entry in self.selected_data:
+                d = entry.get("data", {})
+                if d.get("name"):
+                    names.append(d["name"])
+                elif d.get("port"):
+                    ports.append(str(d["port"]))
+            message = {"type": "subscribe", "names": names, "ports": ports}
+        else:
+            message = {"type": "unsubscribe"}
+        try:
+            with self.feed_lock:
+                self.ws.send(json.dumps(message))
+                self.ws_filtered = message["type"] == "subscribe"
+                self.ws_awaiting_subscription = False
+            print(f"📡 WebSocket {message['type']}: {len(self.selected_data) if self.ws_filtered else 'all'} machines")
+        except Exception as e:
+            print(f"✗ WebSocket subscribe error: {e}")
+    
+    def apply_ws_message(self, message):
+        """Áp dụng message của delta feed (snapshot/delta/keepalive).
+
+        Trả về danh sách entry mới nếu fleet thay đổi, None nếu không cần update.
+        """
+        if isinstance(message, list):
+            # Server cũ: luôn gửi full list
+            print(f"📩 WebSocket received: {len(message)} items")
+            return message
+        
+        msg_type = message.get("type")
+        if msg_type == "snapshot":
+            # Server gửi snapshot thành nhiều part, chỉ thay state khi nhận đủ (done)
+            if message.get("part", 0) == 0:
+                self.ws_snapshot_parts = {}
+            elif self.ws_snapshot_parts is None:
+                return None  # Không nhận được part 0 - delta sau sẽ bù phần thay đổi
+            for e in message.get("entries", []):
+                self.ws_snapshot_parts[e.get("data", {}).get("name", "")] = e
+            if not message.get("done", True):
+                return None
+            self.ws_entries = self.ws_snapshot_parts
+            self.ws_snapshot_parts = None
+            print(f"📩 WebSocket snapshot: {len(self.ws_entries)} items (seq {message.get('seq')})")
+        elif msg_type == "delta":
+            if self.ws_seq is not None and message.get("seq", 0) <= self.ws_seq:
+                return None
+            for entry in message.get("upserts", []):
+                self.ws_entries[entry.get("data", {}).get("name", "")] = entry
+            for name in message.get("deletes", []):
+                self.ws_entries.pop(name, None)
+            print(f"📩 WebSocket delta: {len(message.get('upserts', []))} upserts, {len(message.get('deletes', []))} deletes (seq {message.get('seq')})")
+        elif msg_type == "keepalive":
+            if self.ws_seq is not None and message.get("seq", 0) > self.ws_seq:
+                # Bị lỡ update - đóng connection để reconnect và resume
+                print("⚠ WebSocket missed updates, reconnecting...")
+                self.ws.close()
+            return None
+        else:
+            return None
+        
+        self.ws_seq = message.get("seq")
+        self.ws_epoch = message.get("epoch")
+        # Giữ thứ tự như server: mới nhất trước
+        return sorted(self.ws_entries.values(), key=lambda e: str(e.get("timestamp", "")), reverse=True)
+    
     def start_rest_polling(self):
         """Fallback: Polling REST API nếu WebSocket không hoạt động"""
-        if self.auto_send_enabled and not self.ws_connected:
-            self.check_for_changes()
+        if not self.ws_connected:
+            self.start_rest_polling_backup()
     
     def start_rest_polling_backup(self):
         """Backup polling khi WebSocket mất kết nối"""
-        if self.rest_polling_active or self.ws_connected:
-            return
-        
-        self.rest_polling_active = True
+        with self.feed_lock:
+            if self.rest_polling_active or self.ws_connected:
+                return
+            self.rest_polling_active = True
+            self.rest_poll_generation += 1
+            generation = self.rest_poll_generation
         print("🔄 Starting REST polling backup...")
-        self.rest_poll_loop()
+        self.rest_poll_loop(generation)
     
-    def rest_poll_loop(self):
-        """Loop polling REST API"""
-        if not self.rest_polling_active or self.ws_connected:
-            self.rest_polling_active = False
-            return
+    def rest_poll_loop(self, generation):
+        """Long-poll /changes cho tới khi WebSocket kết nối lại.
+
+        Server giữ request tới khi fleet có thay đổi (hoặc hết timeout) rồi trả
+        về delta/snapshot cùng format và cùng seq với WebSocket: gần như không
+        có traffic khi không có gì thay đổi, và WebSocket resume được từ seq đó.
+        Server cũ không có /changes thì poll /logs mỗi 3 giây như trước.
+        Kết quả chỉ được áp dụng khi `generation` vẫn là lần poll hiện tại
+        (WebSocket chưa kết nối lại trong lúc chờ response).
+        """
+        def current():
+            return generation == self.rest_poll_generation and not self.ws_connected
         
         def poll():
-            try:
-                resp = requests.get(self.api_url, timeout=5)
-                if resp.status_code == 200:
-                    data = resp.json()
-                    if isinstance(data, list):
-                        # Check if có thay đổi
-                        has_list_changed = self.has_data_changed(self.data, data)
-                        self.data = data
-                        
-                        if has_list_changed:
-                            self.root.after(0, self.update_all_table)
-                        
-                        # Always update selected data
-                        self.update_selected_data()
-                        self.root.after(0, self.update_selected_table)
-                        
-                        # Check for changes and send Discord
-                        if self.auto_send_enabled:
-                            current_snapshot = self.get_data_snapshot()
-                            if current_snapshot != self.previous_data:
-                                self.send_to_discord_auto()
-                                self.previous_data = current_snapshot
-            except Exception as e:
-                print(f"⚠ REST polling error: {e}")
+            with self.feed_lock:
+                if current() and self.ws_filtered:
+                    # State hiện tại chỉ có các máy đã chọn - lấy lại full snapshot
+                    self.ws_filtered = False
+                    self.ws_seq = None
+            errors = 0
+            while True:
+                try:
+                    with self.feed_lock:
+                        if not current():
+                            break
+                        params = {"timeout": 25}
+                        if self.ws_seq is not None and self.ws_epoch:
+                            params.update(since=self.ws_seq, epoch=self.ws_epoch)
+                    resp = requests.get(self.changes_url, params=params, timeout=40)
+                    if resp.status_code == 404:
+                        data = self.fetch_logs_if_changed(timeout=5)
+                        with self.feed_lock:
+                            if current():
+                                self.on_feed_update(data)
+                        time.sleep(3)
+                        continue
+                    resp.raise_for_status()
+                    with self.feed_lock:
+                        if current():
+                            self.on_feed_update(self.apply_ws_message(resp.json()))
+                    errors = 0
+                except Exception as e:
+                    errors += 1
+                    print(f"⚠ REST polling error: {e}")
+                    time.sleep(min(3 * errors, 30))
+            with self.feed_lock:
+                if generation == self.rest_poll_generation:
+                    self.rest_polling_active = False
         
         threading.Thread(target=poll, daemon=True).start()
-        
-        # Schedule next poll (3 seconds)
-        self.root.after(3000, self.rest_poll_loop)
+
+    def fetch_logs_if_changed(self, timeout=10):
+        """GET /logs với If-None-Match; trả về None nếu server trả 304 (không đổi) hoặc lỗi"""
+        headers = {"If-None-Match": self.logs_etag} if self.logs_etag else {}
+        resp = requests.get(self.api_url, headers=headers, timeout=timeout)
+        if resp.status_code == 304:
+            return None
+        if resp.status_code != 200:
+            print(f"⚠ GET /logs error: HTTP {resp.status_code}")
+            return None
+        self.logs_etag = resp.headers.get("ETag")
+        return resp.json()
 
     def toggle_auto_send(self):
         """Bật/Tắt chế độ tự động gửi Discord khi có thay đổi"""
@@ -303,9 +468,9 @@ class ServerDataGUI:
             print(f"📸 Đã lưu snapshot ban đầu: {len(self.previous_data)} items")
             # GỬI TOÀN BỘ LIST NGAY LẦN ĐẦU khi bật ON
             self.send_full_list_to_discord()
-            # Bắt đầu auto-check (chỉ nếu không dùng WebSocket)
+            # Không có WebSocket thì nhận thay đổi qua long-poll
             if not self.ws_connected:
-                self.check_for_changes()
+                self.start_rest_polling_backup()
         else:
             self.toggle_btn.configure(text="AUTO SEND: OFF", fg_color="#9E9E9E")
             print("✗ Auto-send to Discord: DISABLED")
@@ -368,35 +533,6 @@ class ServerDataGUI:
         
         threading.Thread(target=send, daemon=True).start()
     
-    def check_for_changes(self):
-        """Kiểm tra thay đổi và tự động gửi Discord - CHỈ monitor selected list, KHÔNG refresh bảng trái"""
-        if not self.auto_send_enabled:
-            return
-        
-        # Chỉ check status của selected items, không update bảng trái
-        def check():
-            url = self.api_url
-            try:
-                resp = requests.get(url, timeout=10)
-                if resp.status_code == 200:
-                    data = resp.json()
-                    if isinstance(data, list):
-                        self.data = data
-                        # CHỈ update selected data và bảng phải, KHÔNG update bảng trái
-                        self.update_selected_data()
-                        self.update_selected_table()
-                        
-                        # So sánh với dữ liệu cũ
-                        self.send_to_discord_auto()
-            except Exception as e:
-                print(f"Error checking: {e}")
-        
-        threading.Thread(target=check, daemon=True).start()
-        
-        # Schedule next check (5 seconds)
-        if self.auto_send_enabled:
-            self.root.after(5000, self.check_for_changes)
-    
     def send_to_discord_auto(self):
         """Gửi CHỈ những item có thay đổi về SRT STATUS hoặc IPWAN lên Discord"""
         # Tránh gửi duplicate nếu đang trong quá trình gửi
@@ -777,6 +913,7 @@ class ServerDataGUI:
         result = messagebox.askyesno("Confirm", f"Remove all {len(self.selected_data)} items?")
         if result:
             self.selected_data = []
+            self.send_ws_subscription()
             self.update_all_table()
             self.update_selected_table()
             print("✓ Cleared all selected items")
@@ -816,8 +953,13 @@ class ServerDataGUI:
             threading.Thread(target=update_name, daemon=True).start()
             self.update_selected_table()
 
-    def update_selected_data(self):
-        """Update selected data with latest info from database - Match by NAME or PORT"""
+    def update_selected_data(self, source=None):
+        """Update selected data with latest info from database - Match by NAME or PORT
+
+        source: danh sách entry để match (mặc định self.data - toàn bộ fleet).
+        """
+        if source is None:
+            source = self.data
         for i, sel_entry in enumerate(self.selected_data):
             sel_d = sel_entry.get("data", {})
             sel_name = sel_d.get("name", "")
@@ -825,7 +967,7 @@ class ServerDataGUI:
             
             # Tìm matching entry: ưu tiên match theo NAME (nếu có), không thì match theo PORT
             matched = False
-            for entry in self.data:
+            for entry in source:
                 entry_d = entry.get("data", {})
                 entry_name = entry_d.get("name", "")
                 entry_port = entry_d.get("port", "")
@@ -910,6 +1052,8 @@ class ServerDataGUI:
 
     def save_selected_to_database(self):
         """Đồng bộ selected list lên database"""
+        self.send_ws_subscription()  # Selected list đổi -> đổi subscription filter
+        
         def save():
             try:
                 url = f"{self.api_url}/save_selected_list"
@@ -935,6 +1079,7 @@ class ServerDataGUI:
                     if isinstance(loaded_data, list):
                         self.selected_data = loaded_data
                         print(f"✓ Loaded {len(self.selected_data)} items from database")
+                        self.send_ws_subscription()
                         # Update UI
                         self.root.after(0, self.update_selected_table)
                         self.root.after(0, self.update_all_table)
@@ -0,0 +1,117 @@
+"""Đo throughput của ingest path với logging bật và tắt.
+
+Mỗi request là một thay đổi (status đổi liên tục) nên đều đi qua log_changes.
+So sánh print() đồng bộ kiểu cũ với logger mới ở ba mức: tắt (LOG_LEVEL=WARNING),
+sampling mặc định và ghi toàn bộ. Stream đích giả lập pipe stdout của Render:
+mỗi lần write ngủ --write-latency-us µs, nên print() đồng bộ phải chờ còn
+logger mới chỉ đẩy record vào hàng đợi (thread riêng ghi, đầy thì bỏ).
+
+    python tools/bench_logging.py --requests 20000 --write-latency-us 50
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+class SlowStream:
+    """Stream mà mỗi write tốn `latency` giây, như pipe bị đầy"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.writes = 0
+
+    def write(self, data: str) -> int:
+        self.writes += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def print_log_changes(machine_name: str, changed_fields: list):
+    """log_changes trước khi có logger: nhiều dòng print() cho mỗi thay đổi"""
+    if changed_fields:
+        print(f"⚠ Changes detected for {machine_name}:")
+        for change in changed_fields:
+            print(f"  - {change}")
+
+
+def ingest(count: int, machines: int, log_changes) -> float:
+    """Số request/giây của phần CPU ingest, mỗi request là một thay đổi status"""
+    server.fleet_state.clear()
+    server.uptime_marks.clear()
+    previous = {}
+    start = time.perf_counter()
+    for i in range(count):
+        name = f"SRT-{i % machines:04d}"
+        data = {"name": name, "ip": "192.168.1.10", "ipwan": "113.161.1.1",
+                "status": "ON" if (i // machines) % 2 else "OFF", "port": 9000, "statusapp": 1}
+        document = server.build_document(data, datetime.now(server.VIETNAM_TZ))
+        existing = previous.get(name)
+        changed_fields = server.detect_changes(existing, data)
+        version = (existing or {}).get("version", 0) + 1
+        previous[name] = {**document, "version": version}
+        server.apply_versioned_state(previous[name])
+        log_changes(name, changed_fields)
+    elapsed = time.perf_counter() - start
+    # Dọn các event history/uptime sinh ra trong lúc đo
+    while not server.history_queue.empty():
+        server.history_queue.get_nowait()
+    server.uptime_pending.clear()
+    return count / elapsed
+
+
+def run_mode(mode: str, args) -> dict:
+    stream = SlowStream(args.write_latency_us / 1e6)
+    server.log_stats.update(emitted=0, sampled_out=0, dropped=0)
+    if mode == "print":
+        server.setup_logging("WARNING", "json", stream)
+        with contextlib.redirect_stdout(stream):
+            rate = ingest(args.requests, args.machines, print_log_changes)
+    else:
+        level = "WARNING" if mode == "off" else "INFO"
+        server.log_sampling = server.parse_log_sampling("" if mode == "full" else server.LOG_SAMPLING)
+        server._sample_rate_cache.clear()
+        server.setup_logging(level, "json", stream)
+        rate = ingest(args.requests, args.machines, server.log_changes)
+    server.stop_logging()
+    return {"mode": mode, "requests_per_s": round(rate), "writes": stream.writes, **server.log_stats}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput ingest với logging bật/tắt")
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--machines", type=int, default=2000)
+    parser.add_argument("--write-latency-us", type=float, default=50.0,
+                        help="Thời gian mỗi lần write vào stdout (µs), 0 = stdout nhanh")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    results = [run_mode(mode, args) for mode in ("print", "off", "sampled", "full")]
+    baseline = results[1]["requests_per_s"]
+    for r in results:
+        r["vs_off_pct"] = round(r["requests_per_s"] / baseline * 100, 1)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'mode':>8} | {'req/s':>8} | {'% of off':>8} | {'writes':>7} | {'emitted':>7} | {'sampled':>7} | {'dropped':>7}")
+    print("-" * 72)
+    for r in results:
+        print(f"{r['mode']:>8} | {r['requests_per_s']:>8} | {r['vs_off_pct']:>8} | {r['writes']:>7} | "
+              f"{r['emitted']:>7} | {r['sampled_out']:>7} | {r['dropped']:>7}")
+    print(f"(write latency {args.write_latency_us:g} µs, sampling: {server.LOG_SAMPLING})")
+
+
+if __name__ == "__main__":
+    main()
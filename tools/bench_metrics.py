@@ -0,0 +1,96 @@
+"""Đo overhead của instrumentation /metrics trên ingest path.
+
+Mỗi request POST / gọi perf_counter() 5 lần, observe_ingest() (4 series gắn
+sẵn label) và Counter.inc() + Histogram.observe() cho thao tác MongoDB. Script đo chi phí
+các lời gọi đó và so với phần CPU của ingest trong process (build_document,
+detect_changes, áp dụng state, tạo delta entry) - chưa tính round trip
+MongoDB, nên tỉ lệ thực tế còn nhỏ hơn nhiều.
+
+    python tools/bench_metrics.py --requests 20000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+def instrumentation_cost(count: int) -> float:
+    """Thời gian (µs) của phần instrumentation cho một request ingest"""
+    ops = server.Counter("bench_ops_total", "bench", ("op",))
+    mongo = server.Histogram("bench_mongo_seconds", "bench", ("op",))
+    perf_counter = time.perf_counter
+
+    start = perf_counter()
+    for _ in range(count):
+        t0 = perf_counter()
+        t1 = perf_counter()
+        t2 = perf_counter()
+        t3 = perf_counter()
+        t4 = perf_counter()
+        ops.inc("find_one_and_update")
+        mongo.observe(t2 - t1, "find_one_and_update")
+        server.observe_ingest("single", t4 - t0, (t1 - t0) + (t3 - t2), t2 - t1, t4 - t3)
+    return (perf_counter() - start) / count * 1e6
+
+
+def ingest_cpu_cost(count: int, machines: int) -> float:
+    """Thời gian (µs) của phần CPU ingest trong process cho một request"""
+    server.fleet_state.clear()
+    server.uptime_marks.clear()
+    previous = {}
+    start = time.perf_counter()
+    for i in range(count):
+        name = f"SRT-{i % machines:04d}"
+        data = {"name": name, "ip": "192.168.1.10", "ipwan": "113.161.1.1",
+                "status": "ON" if i % 7 else "OFF", "port": 9000, "statusapp": 1}
+        document = server.build_document(data, datetime.now(server.VIETNAM_TZ))
+        existing = previous.get(name)
+        server.detect_changes(existing, data)
+        version = (existing or {}).get("version", 0) + 1
+        previous[name] = {**document, "version": version}
+        server.apply_versioned_state(previous[name])
+    elapsed = (time.perf_counter() - start) / count * 1e6
+    # Dọn các event history/uptime sinh ra trong lúc đo
+    while not server.history_queue.empty():
+        server.history_queue.get_nowait()
+    server.uptime_pending.clear()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Overhead của metrics trên ingest path")
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--machines", type=int, default=2000)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    # Log thay đổi của mỗi request không phải là thứ cần đo ở đây
+    server.log_changes = lambda *a, **k: None
+
+    metrics_us = min(instrumentation_cost(args.requests) for _ in range(3))
+    ingest_us = min(ingest_cpu_cost(args.requests, args.machines) for _ in range(3))
+    result = {
+        "requests": args.requests,
+        "instrumentation_us_per_request": round(metrics_us, 3),
+        "ingest_cpu_us_per_request": round(ingest_us, 3),
+        "overhead_pct_of_cpu_path": round(metrics_us / ingest_us * 100, 2),
+        # Request thật còn có ít nhất một round trip MongoDB (~1 ms trong cùng datacenter)
+        "overhead_pct_with_1ms_mongo": round(metrics_us / (ingest_us + 1000) * 100, 3),
+    }
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f"Instrumentation:     {result['instrumentation_us_per_request']} µs/request")
+        print(f"Ingest CPU path:     {result['ingest_cpu_us_per_request']} µs/request (không tính MongoDB)")
+        print(f"Overhead:            {result['overhead_pct_of_cpu_path']}% của phần CPU, "
+              f"{result['overhead_pct_with_1ms_mongo']}% của request có round trip MongoDB 1 ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Micro-benchmark: thời gian serialize và số bytes trên đường truyền của payload fleet.
+
+So sánh stdlib json (cách cũ) với serializer của server (orjson nếu có),
+và kích thước payload khi gửi thô, gzip (REST) và permessage-deflate (WebSocket).
+
+Chạy từ thư mục gốc của repo:
+    python tools/bench_serialization.py
+    python tools/bench_serialization.py --sizes 200 2000 20000 --repeat 20 --json
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+def make_fleet(count: int) -> list:
+    """Fleet giả lập: tên, IP LAN/WAN và port giống dữ liệu agent gửi lên"""
+    rng = random.Random(count)
+    now = datetime.now(server.VIETNAM_TZ)
+    documents = []
+    for i in range(count):
+        site = i // 8
+        documents.append({
+            "name": f"SRT-{site:04d}-{i % 8}",
+            "ip": f"192.168.{site % 256}.{10 + i % 8}",
+            "ipwan": f"113.{rng.randint(160, 190)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+            "status": rng.choice(["Running", "Running", "Running", "Stopped"]),
+            "port": str(9000 + i % 8),
+            "statusapp": rng.choice([0, 1, 1, 1]),
+            "last_updated": now - timedelta(seconds=rng.randint(0, 3600))
+        })
+    return [server.doc_to_entry(doc) for doc in documents]
+
+
+def best_time(fn, repeat: int) -> float:
+    """Thời gian nhỏ nhất (ms) trong `repeat` lần chạy"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def deflate_size(payloads: list) -> int:
+    """Số bytes sau permessage-deflate (raw deflate, giữ context giữa các message)"""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    total = 0
+    for payload in payloads:
+        data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        total += len(data) - 4  # RFC 7692: bỏ 4 byte 00 00 ff ff cuối mỗi message
+    return total
+
+
+def bench(count: int, repeat: int) -> dict:
+    entries = make_fleet(count)
+    message = {"type": "snapshot", "epoch": "bench", "seq": 1, "part": 0, "done": True, "entries": entries}
+
+    stdlib_ms = best_time(lambda: json.dumps(message).encode("utf-8"), repeat)
+    server_ms = best_time(lambda: server.dumps_bytes(message), repeat)
+
+    stdlib_body = json.dumps(message).encode("utf-8")
+    body = server.dumps_bytes(message)
+
+    # Snapshot trên WebSocket được chia thành nhiều part
+    chunk = server.SNAPSHOT_CHUNK_SIZE
+    parts = [
+        server.dumps_bytes({**message, "part": i // chunk, "done": i + chunk >= count, "entries": entries[i:i + chunk]})
+        for i in range(0, count, chunk)
+    ]
+
+    return {
+        "machines": count,
+        "serializer": "orjson" if server.orjson is not None else "json",
+        "serialize_ms": {"stdlib_json": round(stdlib_ms, 3), "server": round(server_ms, 3)},
+        "bytes": {
+            "stdlib_json": len(stdlib_body),
+            "raw": len(body),
+            "gzip": len(gzip.compress(body, compresslevel=9)),
+            "ws_deflate": deflate_size(parts)
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[200, 2000, 20000])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="In kết quả dạng JSON")
+    args = parser.parse_args()
+
+    results = [bench(count, args.repeat) for count in args.sizes]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'machines':>9} | {'json ms':>8} | {'server ms':>9} | {'json B':>10} | {'raw B':>10} | {'gzip B':>9} | {'ws deflate B':>12}")
+    print("-" * 86)
+    for r in results:
+        print(f"{r['machines']:>9} | {r['serialize_ms']['stdlib_json']:>8} | {r['serialize_ms']['server']:>9} | "
+              f"{r['bytes']['stdlib_json']:>10} | {r['bytes']['raw']:>10} | {r['bytes']['gzip']:>9} | {r['bytes']['ws_deflate']:>12}")
+    print(f"(serializer của server: {results[0]['serializer']})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Discord webhook giả lập để test Discord outbox của server.py ở local.
+
+Nhận POST /api/webhooks/<id>/<token> như Discord, trả về các header
+X-RateLimit-* và 429 kèm Retry-After khi vượt rate limit, có thể giả lập
+lỗi 5xx ngẫu nhiên và độ trễ. GET /messages trả về các message đã nhận,
+DELETE /messages để xóa.
+
+    python tools/discord_webhook_stub.py --port 8099 --limit 5 --window 2 --fail-rate 0.1
+    DISCORD_WEBHOOK=http://127.0.0.1:8099/api/webhooks/1/test python server.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class WebhookState:
+    def __init__(self, limit: int, window: float, fail_rate: float, latency: float):
+        self.limit = limit
+        self.window = window
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self.messages = []
+        self.buckets = {}  # path -> (window start, số request trong window)
+        self.stats = {"accepted": 0, "rate_limited": 0, "failed": 0}
+        self.lock = threading.Lock()
+
+    def take(self, path: str) -> tuple:
+        """(được phép?, số request còn lại, giây tới lúc reset)"""
+        now = time.monotonic()
+        with self.lock:
+            start, count = self.buckets.get(path, (now, 0))
+            if now - start >= self.window:
+                start, count = now, 0
+            reset_after = self.window - (now - start)
+            if count >= self.limit:
+                return False, 0, reset_after
+            self.buckets[path] = (start, count + 1)
+            return True, self.limit - count - 1, reset_after
+
+
+def make_handler(state: WebhookState):
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, body, headers=None):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/messages":
+                with state.lock:
+                    self._send_json(200, {"stats": state.stats, "messages": state.messages})
+            else:
+                self._send_json(404, {"message": "Unknown route"})
+
+        def do_DELETE(self):
+            if self.path == "/messages":
+                with state.lock:
+                    state.messages.clear()
+                self._send_json(200, {"cleared": True})
+            else:
+                self._send_json(404, {"message": "Unknown route"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+            if not self.path.startswith("/api/webhooks/"):
+                self._send_json(404, {"message": "Unknown Webhook", "code": 10015})
+                return
+            if state.latency:
+                time.sleep(state.latency)
+
+            allowed, remaining, reset_after = state.take(self.path)
+            rate_headers = {
+                "X-RateLimit-Limit": str(state.limit),
+                "X-RateLimit-Remaining": str(remaining),
+                "X-RateLimit-Reset-After": f"{reset_after:.3f}",
+                "X-RateLimit-Bucket": self.path.rsplit("/", 1)[0],
+            }
+            if not allowed:
+                with state.lock:
+                    state.stats["rate_limited"] += 1
+                self._send_json(429, {
+                    "message": "You are being rate limited.",
+                    "retry_after": round(reset_after, 3),
+                    "global": False
+                }, {**rate_headers, "Retry-After": str(max(1, round(reset_after)))})
+                return
+            if random.random() < state.fail_rate:
+                with state.lock:
+                    state.stats["failed"] += 1
+                self._send_json(500, {"message": "Internal Server Error"}, rate_headers)
+                return
+
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                self._send_json(400, {"message": "Cannot send an empty message", "code": 50006})
+                return
+            with state.lock:
+                state.stats["accepted"] += 1
+                state.messages.append({"path": self.path, "received_at": time.time(), "payload": payload})
+            print(f"📩 {payload.get('content', payload)}")
+            self.send_response(204)
+            for key, value in rate_headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Discord webhook stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--limit", type=int, default=5, help="Số request mỗi window cho mỗi webhook")
+    parser.add_argument("--window", type=float, default=2.0, help="Độ dài window rate limit (giây)")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Tỉ lệ trả về 500 ngẫu nhiên (0..1)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Độ trễ mỗi request (giây)")
+    args = parser.parse_args()
+
+    state = WebhookState(args.limit, args.window, args.fail_rate, args.latency)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    print(f"🚀 Discord webhook stub on http://{args.host}:{args.port}/api/webhooks/1/test")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""Load test cho server.py: N agent gửi trạng thái/heartbeat, M viewer WebSocket.
+
+Script chạy server.py (uvicorn, một process) trong một subprocess riêng, trỏ
+tới MongoDB local (--mongo-uri, database tạm vloadtest_<thời gian>) hoặc
+MongoDB in-memory (mongomock, mặc định - `pip install mongomock`), rồi giả
+lập:
+
+- Agent: mỗi agent có `--ports` port, gửi POST /batch như vmix_monitor_gui.py
+  (heartbeat tất cả port mỗi `--heartbeat` giây ± 10%, thay đổi status theo
+  phân phối Poisson `--changes-per-min` lần/port/phút chỉ gửi port đổi).
+- Viewer: kết nối /ws (permessage-deflate), nhận snapshot/delta như
+  server_gui_advanced.py. `--slow-viewers` thêm các viewer kết nối nhưng
+  không đọc (đường truyền rất chậm) để kiểm tra chúng không làm chậm viewer khác.
+
+Kết quả (JSON): throughput, latency ingest p50/p95/p99 phía client, latency
+từ lúc agent gửi thay đổi tới lúc viewer nhận được, RSS của server và thời
+gian ingest theo phase từ /metrics. So sánh với lần chạy trước bằng --compare.
+
+    python tools/loadtest.py --agents 200 --viewers 20 --duration 60 --output run.json
+    python tools/loadtest.py --agents 200 --viewers 20 --duration 60 --compare run.json
+    python tools/loadtest.py --mongo-uri mongodb://localhost:27017 --agents 500 --heartbeat 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import httpx
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def serve(args):
+    """Chạy trong subprocess: server.py với MongoDB local hoặc in-memory"""
+    sys.path.insert(0, ROOT)
+    import uvicorn
+    import server
+
+    if args.mongo_uri:
+        database = f"vloadtest_{int(time.time())}"
+        server.store = server.MongoStore(args.mongo_uri, database, "logs", tls=False)
+        print(f"✓ Load test database: {database}")
+    else:
+        import mongomock
+        server.store = server.MongoStore("mongodb://in-memory", "vloadtest", "logs", tls=False,
+                                         client_factory=mongomock.MongoClient)
+        # mongomock không có query planner ($indexStats/explain) - bỏ qua kiểm tra index
+        server.prepare_indexes = lambda: {"ok": True, "indexes": {}, "queries": {}}
+    uvicorn.run(server.app, host="127.0.0.1", port=args.port, log_level="warning",
+                ws_per_message_deflate=server.WS_PER_MESSAGE_DEFLATE)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_mb(pid: int):
+    """RSS (MB) của process, None nếu không đọc được (/proc chỉ có trên Linux)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss / 1024 / 1024
+    except Exception:
+        return None
+
+
+def summarize(values: list, scale: float = 1000) -> dict:
+    """count/mean/p50/p95/p99/max (mặc định đổi giây → ms)"""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * scale, 3)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered) * scale, 3),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(ordered[-1] * scale, 3),
+    }
+
+
+class LoadState:
+    def __init__(self):
+        self.ingest_latencies = []
+        self.propagation = []
+        self.requests = 0
+        self.updates = 0
+        self.errors = 0
+        self.error_samples = []
+        # name -> (change id, status, thời điểm agent bắt đầu gửi)
+        self.pending_changes = {}
+        self.change_counter = 0
+        self.viewer_messages = 0
+        self.viewer_bytes = 0
+        self.viewers_connected = 0
+        self.slow_viewers_connected = 0
+
+
+async def run_agent(index: int, client: httpx.AsyncClient, state: LoadState, args, deadline: float):
+    rng = random.Random(index)
+    ports = [{
+        "name": f"LT-{index:04d}-{p}",
+        "ip": f"10.{index // 250}.{index % 250}.{10 + p}",
+        "ipwan": f"113.{160 + index % 30}.{index % 250}.1",
+        "status": "ON",
+        "port": 9000 + p,
+        "statusapp": 1,
+        "heartbeat_timeout": args.heartbeat * 3,
+    } for p in range(args.ports)]
+    change_rate = args.changes_per_min / 60 * args.ports  # thay đổi/giây của cả agent
+
+    async def send(entries: list):
+        start = time.perf_counter()
+        try:
+            response = await client.post("/batch", json={"entries": entries})
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}")
+            state.ingest_latencies.append(time.perf_counter() - start)
+            state.updates += len(entries)
+        except Exception as e:
+            state.errors += 1
+            if len(state.error_samples) < 10:
+                state.error_samples.append(f"{type(e).__name__}: {e}")
+        state.requests += 1
+
+    # Các agent khởi động rải đều trong một chu kỳ heartbeat
+    await asyncio.sleep(rng.uniform(0, min(args.heartbeat, args.duration / 4)))
+    next_heartbeat = time.perf_counter()
+    next_change = time.perf_counter() + (rng.expovariate(change_rate) if change_rate else float("inf"))
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            return
+        if now >= next_heartbeat:
+            await send([dict(p) for p in ports])
+            next_heartbeat = now + args.heartbeat * rng.uniform(0.9, 1.1)
+        elif now >= next_change:
+            port = rng.choice(ports)
+            port["status"] = "OFF" if port["status"] == "ON" else "ON"
+            state.change_counter += 1
+            state.pending_changes[port["name"]] = (state.change_counter, port["status"], time.perf_counter())
+            await send([dict(port)])
+            next_change = now + rng.expovariate(change_rate)
+        await asyncio.sleep(max(0.0, min(next_heartbeat, next_change, deadline) - time.perf_counter()))
+
+
+async def run_viewer(url: str, state: LoadState, deadline: float):
+    seen = {}  # name -> change id đã đo
+
+    def observe(entries: list):
+        now = time.perf_counter()
+        for entry in entries:
+            data = entry.get("data", {})
+            pending = state.pending_changes.get(data.get("name"))
+            if pending and data.get("status") == pending[1] and seen.get(data["name"]) != pending[0]:
+                seen[data["name"]] = pending[0]
+                state.propagation.append(now - pending[2])
+
+    try:
+        async with websockets.connect(url, compression="deflate", max_size=None, open_timeout=30) as ws:
+            state.viewers_connected += 1
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return
+                try:
+                    message = await asyncio.wait_for(ws.recv(), remaining)
+                except asyncio.TimeoutError:
+                    return
+                state.viewer_messages += 1
+                state.viewer_bytes += len(message)
+                payload = json.loads(message)
+                if payload.get("type") == "snapshot":
+                    observe(payload.get("entries", []))
+                elif payload.get("type") == "delta":
+                    observe(payload.get("upserts", []))
+    except Exception as e:
+        state.errors += 1
+        if len(state.error_samples) < 10:
+            state.error_samples.append(f"viewer {type(e).__name__}: {e}")
+
+
+async def run_slow_viewer(url: str, state: LoadState, deadline: float):
+    """Viewer trên đường truyền rất chậm: kết nối rồi không đọc gì nữa.
+
+    max_queue=1 nên client ngừng đọc socket, send của server bị nghẽn khi
+    TCP buffer đầy. Các viewer khác không được chậm theo.
+    """
+    try:
+        async with websockets.connect(url, max_size=None, max_queue=1, open_timeout=30):
+            state.slow_viewers_connected += 1
+            await asyncio.sleep(max(0.0, deadline - time.perf_counter()))
+    except Exception:
+        pass
+
+
+def parse_phase_means(metrics_text: str) -> dict:
+    """Thời gian trung bình (ms) theo endpoint/phase từ vmix_ingest_phase_seconds"""
+    sums, counts = {}, {}
+    for line in metrics_text.splitlines():
+        for suffix, target in (("_sum", sums), ("_count", counts)):
+            prefix = f"vmix_ingest_phase_seconds{suffix}" + "{"
+            if line.startswith(prefix):
+                labels, value = line[len(prefix):].split("} ")
+                target[labels.replace('"', "")] = float(value)
+    return {key: round(sums[key] / counts[key] * 1000, 3) for key in sums if counts.get(key)}
+
+
+async def run_load(args, base_url: str, server_pid: int) -> dict:
+    state = LoadState()
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        rss_samples = [rss_mb(server_pid)]
+        started = time.perf_counter()
+        deadline = started + args.duration
+        ws_url = base_url.replace("http://", "ws://") + "/ws"
+        tasks = [asyncio.create_task(run_viewer(ws_url, state, deadline)) for _ in range(args.viewers)]
+        tasks += [asyncio.create_task(run_slow_viewer(ws_url, state, deadline)) for _ in range(args.slow_viewers)]
+        tasks += [asyncio.create_task(run_agent(i, client, state, args, deadline)) for i in range(args.agents)]
+
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(0.5)
+            rss_samples.append(rss_mb(server_pid))
+        await asyncio.gather(*tasks, return_exceptions=True)
+        elapsed = time.perf_counter() - started
+
+        server_stats = (await client.get("/stats")).json()
+        metrics_text = (await client.get("/metrics")).text
+
+    rss_samples = [value for value in rss_samples if value is not None]
+    return {
+        "throughput": {
+            "requests": state.requests,
+            "updates": state.updates,
+            "errors": state.errors,
+            "requests_per_sec": round(state.requests / elapsed, 2),
+            "updates_per_sec": round(state.updates / elapsed, 2),
+        },
+        "ingest_latency_ms": summarize(state.ingest_latencies),
+        "propagation_latency_ms": summarize(state.propagation),
+        "viewers": {
+            "connected": state.viewers_connected,
+            "slow_connected": state.slow_viewers_connected,
+            "messages": state.viewer_messages,
+            "bytes": state.viewer_bytes,
+        },
+        "server": {
+            "rss_mb": {
+                "start": round(rss_samples[0], 1),
+                "peak": round(max(rss_samples), 1),
+                "end": round(rss_samples[-1], 1),
+            } if rss_samples else None,
+            "ingest_phase_mean_ms": parse_phase_means(metrics_text),
+            "stats": server_stats,
+        },
+        "error_samples": state.error_samples,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+COMPARE_KEYS = [
+    ("throughput", "requests_per_sec", True),
+    ("ingest_latency_ms", "p50", False),
+    ("ingest_latency_ms", "p95", False),
+    ("ingest_latency_ms", "p99", False),
+    ("propagation_latency_ms", "p50", False),
+    ("propagation_latency_ms", "p95", False),
+    ("propagation_latency_ms", "p99", False),
+]
+
+
+def compare(previous: dict, current: dict):
+    """In thay đổi của các chỉ số chính so với lần chạy trước"""
+    print(f"\n{'metric':<32} {'before':>10} {'after':>10} {'change':>9}")
+    for section, key, higher_is_better in COMPARE_KEYS:
+        before = previous.get(section, {}).get(key)
+        after = current.get(section, {}).get(key)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        worse = change < 0 if higher_is_better else change > 0
+        flag = " ⚠" if worse and abs(change) >= 10 else ""
+        print(f"{section + '.' + key:<32} {before:>10} {after:>10} {change:>+8.1f}%{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test cho server.py")
+    parser.add_argument("--agents", type=int, default=50)
+    parser.add_argument("--ports", type=int, default=4, help="Số port (máy) mỗi agent")
+    parser.add_argument("--viewers", type=int, default=10)
+    parser.add_argument("--slow-viewers", type=int, default=0, help="Số viewer kết nối nhưng không đọc")
+    parser.add_argument("--duration", type=float, default=30, help="Giây")
+    parser.add_argument("--heartbeat", type=float, default=20, help="Chu kỳ heartbeat của agent (giây)")
+    parser.add_argument("--changes-per-min", type=float, default=0.5, help="Số lần đổi status mỗi port mỗi phút")
+    parser.add_argument("--connections", type=int, default=100, help="Số HTTP connection tối đa của các agent")
+    parser.add_argument("--mongo-uri", default="", help="MongoDB local; bỏ trống để dùng mongomock in-memory")
+    parser.add_argument("--output", help="Ghi kết quả JSON ra file")
+    parser.add_argument("--compare", help="File JSON của lần chạy trước để so sánh")
+    parser.add_argument("--server-log", action="store_true", help="Hiện log của server (mặc định ẩn)")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    port = free_port()
+    command = [sys.executable, os.path.abspath(__file__), "--serve", "--port", str(port)]
+    if args.mongo_uri:
+        command += ["--mongo-uri", args.mongo_uri]
+    process = subprocess.Popen(command, cwd=ROOT, stdout=None if args.server_log else subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(120):
+            if process.poll() is not None:
+                sys.exit(f"✗ Server exited with code {process.returncode}")
+            try:
+                if httpx.get(base_url + "/", timeout=1).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.25)
+        else:
+            sys.exit("✗ Server did not start in time")
+
+        config = {key: value for key, value in vars(args).items() if key not in ("serve", "port", "output", "compare", "server_log")}
+        result = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": sys.version.split()[0],
+            "config": {**config, "mongo": "local" if args.mongo_uri else "mongomock"},
+            **asyncio.run(run_load(args, base_url, process.pid)),
+        }
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+        print(f"✓ Results written to {args.output}")
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
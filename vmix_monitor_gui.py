@@ -49,6 +49,7 @@ class VmixMonitorGUI:
         self.log_queue = queue.Queue()
         self.tray_icon = None
         self.port_list = []  # Danh sách các port entries
+        self.http_cache = {}  # url -> (ETag, data) cho conditional GET
         self.setup_ui()
         self.setup_tray()
         self.check_log_queue()
@@ -437,8 +438,6 @@ class VmixMonitorGUI:
     
     def import_from_old_ip(self, old_ip: str):
         """Import và migrate data từ IP cũ sang IP mới"""
-        import requests
-        
         try:
             current_ip = self.ip_var.get().strip()
             
@@ -450,10 +449,9 @@ class VmixMonitorGUI:
             
             # Lấy data từ IP cũ
             url = f"https://tooldiscordvmix.onrender.com/get_by_ip?ip={old_ip}"
-            response = requests.get(url, timeout=20)
+            status_code, data = self.get_json_cached(url, timeout=20)
             
-            if response.status_code == 200:
-                data = response.json()
+            if status_code == 200:
                 if data and isinstance(data, list):
                     imported_count = 0
                     
@@ -492,7 +490,7 @@ class VmixMonitorGUI:
                 else:
                     self.log(f"ℹ️ Không có dữ liệu cho IP {old_ip}")
             else:
-                self.log(f"❌ Lỗi lấy data từ IP {old_ip}: HTTP {response.status_code}")
+                self.log(f"❌ Lỗi lấy data từ IP {old_ip}: HTTP {status_code}")
         except Exception as e:
             self.log(f"❌ Lỗi import: {str(e)}")
     
@@ -567,9 +565,27 @@ class VmixMonitorGUI:
         except Exception as e:
             self.log(f"❌ ERROR cập nhật IP: {str(e)}")
     
+    def get_json_cached(self, url, timeout):
+        """GET JSON với If-None-Match; server trả 304 thì dùng lại dữ liệu đã cache.
+
+        Trả về (status_code, data) - 304 được đổi thành 200 kèm dữ liệu cache.
+        """
+        import requests
+        cached = self.http_cache.get(url)
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        response = requests.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and cached:
+            return 200, cached[1]
+        if response.status_code != 200:
+            return response.status_code, None
+        data = response.json()
+        etag = response.headers.get("ETag")
+        if etag:
+            self.http_cache[url] = (etag, data)
+        return 200, data
+
     def check_server_status(self):
         """Kiểm tra trạng thái server"""
-        import requests
         threading.Thread(target=self._check_server_thread, daemon=True).start()
     
     def _check_server_thread(self):
@@ -582,15 +598,15 @@ class VmixMonitorGUI:
         
         try:
             url = "https://tooldiscordvmix.onrender.com/logs"
-            response = requests.get(url, timeout=30)
+            status_code, _ = self.get_json_cached(url, timeout=30)
             elapsed = time.time() - start_time
             
-            if response.status_code == 200:
+            if status_code == 200:
                 self.log(f"✅ Server hoạt động tốt! (Phản hồi trong {elapsed:.1f}s)")
-            elif response.status_code == 500:
+            elif status_code == 500:
                 self.log(f"⚠️ Server đang có vấn đề (500). Có thể đang khởi động lại...")
             else:
-                self.log(f"❓ Server phản hồi: HTTP {response.status_code}")
+                self.log(f"❓ Server phản hồi: HTTP {status_code}")
         except requests.exceptions.Timeout:
             self.log("⏱️ Server timeout (>30s) - có thể đang cold start, hãy thử lại sau 1 phút")
         except requests.exceptions.ConnectionError:
@@ -605,10 +621,9 @@ class VmixMonitorGUI:
             ip = self.ip_var.get().strip()
             url = f"https://tooldiscordvmix.onrender.com/get_by_ip?ip={ip}"
             self.log(f"⏳ Đang tải dữ liệu từ server...")
-            response = requests.get(url, timeout=20)
+            status_code, data = self.get_json_cached(url, timeout=20)
             
-            if response.status_code == 200:
-                data = response.json()
+            if status_code == 200:
                 if data and isinstance(data, list):
                     # Clear existing data
                     self.port_list.clear()
@@ -641,10 +656,10 @@ class VmixMonitorGUI:
                     self.log(f"ℹ️ Không có dữ liệu cho IP {ip} trong database")
                     # Check if there's data with other IPs
                     self.check_for_old_ip_data()
-            elif response.status_code == 500:
+            elif status_code == 500:
                 self.log(f"⚠️ Server đang có vấn đề (500) - có thể đang cold start, hãy thử lại sau 30s")
             else:
-                self.log(f"❌ Không thể tải dữ liệu: HTTP {response.status_code}")
+                self.log(f"❌ Không thể tải dữ liệu: HTTP {status_code}")
         except requests.exceptions.Timeout:
             self.log(f"⏱️ Timeout khi tải dữ liệu - server có thể đang ngủ, hãy đợi 30-60s")
         except Exception as e:
@@ -652,14 +667,12 @@ class VmixMonitorGUI:
     
     def check_for_old_ip_data(self):
         """Kiểm tra xem có data với IP cũ không và hỏi user có muốn import không"""
-        import requests
         try:
             # Get all data from database
             url = "https://tooldiscordvmix.onrender.com/logs"
-            response = requests.get(url, timeout=10)
+            status_code, all_data = self.get_json_cached(url, timeout=10)
             
-            if response.status_code == 200:
-                all_data = response.json()
+            if status_code == 200:
                 if all_data and isinstance(all_data, list):
                     current_ip = self.ip_var.get().strip()
                     found_ips = set()
@@ -844,6 +857,13 @@ class VmixMonitorGUI:
         except Exception as e:
             self.log(f"ERROR xóa DB: {str(e)}")
 
+    def post_batch(self, entries, timeout=15):
+        """Gửi trạng thái nhiều port của máy này trong một request (POST /batch)"""
+        import requests
+        url = "https://tooldiscordvmix.onrender.com/batch"
+        headers = {"Content-Type": "application/json"}
+        return requests.post(url, json={"entries": entries}, headers=headers, timeout=timeout)
+
     def send_app_status(self, status_value):
         """Gửi trạng thái app (1=ON, 0=OFF) cho tất cả các port entries"""
         import requests
@@ -860,9 +880,9 @@ class VmixMonitorGUI:
         try:
             wan_ip = self.get_wan_ip()
             
-            # Gửi từng port entry lên server
-            for entry in self.port_list:
-                data = {
+            # Gửi tất cả port entries lên server trong một request
+            entries = [
+                {
                     "name": entry['name'],
                     "ip": ip,
                     "ipwan": wan_ip,
@@ -870,43 +890,45 @@ class VmixMonitorGUI:
                     "port": entry['port'],
                     "statusapp": status_value  # App status: 1=ON, 0=OFF
                 }
-                url = "https://tooldiscordvmix.onrender.com"
-                headers = {"Content-Type": "application/json"}
-                
-                # Retry logic (3 attempts)
-                max_retries = 3
-                for attempt in range(max_retries):
-                    try:
-                        response = requests.post(url, json=data, headers=headers, timeout=15)
-                        if response.status_code == 200:
-                            status_text = "ON" if status_value == 1 else "OFF"
+                for entry in self.port_list
+            ]
+            names = ", ".join(entry['name'] for entry in self.port_list)
+            
+            # Retry logic (3 attempts)
+            max_retries = 3
+            for attempt in range(max_retries):
+                try:
+                    response = self.post_batch(entries, timeout=15)
+                    if response.status_code == 200:
+                        status_text = "ON" if status_value == 1 else "OFF"
+                        for entry in self.port_list:
                             self.log(f"✅ App status {status_text}: {entry['name']} - Port {entry['port']}")
-                            break
-                        elif response.status_code == 500:
-                            error_detail = ""
-                            try:
-                                error_detail = response.json().get('detail', '')
-                            except:
-                                error_detail = response.text[:100]
-                            
-                            if attempt < max_retries - 1:
-                                wait_time = (attempt + 1) * 2
-                                self.log(f"⚠️ Server error 500 ({entry['name']}), retry sau {wait_time}s... (lần {attempt + 1}/{max_retries})")
-                                time.sleep(wait_time)
-                            else:
-                                self.log(f"❌ Lỗi 500 {entry['name']}: {error_detail}")
-                        else:
-                            self.log(f"❌ Lỗi gửi {entry['name']}: HTTP {response.status_code}")
-                            break
-                    except requests.exceptions.Timeout:
+                        break
+                    elif response.status_code == 500:
+                        error_detail = ""
+                        try:
+                            error_detail = response.json().get('detail', '')
+                        except:
+                            error_detail = response.text[:100]
+                        
                         if attempt < max_retries - 1:
-                            self.log(f"⏱️ Timeout ({entry['name']}), retry...")
-                            time.sleep(2)
+                            wait_time = (attempt + 1) * 2
+                            self.log(f"⚠️ Server error 500 ({names}), retry sau {wait_time}s... (lần {attempt + 1}/{max_retries})")
+                            time.sleep(wait_time)
                         else:
-                            self.log(f"❌ Timeout sau {max_retries} lần thử: {entry['name']}")
-                    except requests.exceptions.ConnectionError:
-                        self.log(f"❌ Không kết nối được server: {entry['name']}")
+                            self.log(f"❌ Lỗi 500 {names}: {error_detail}")
+                    else:
+                        self.log(f"❌ Lỗi gửi {names}: HTTP {response.status_code}")
                         break
+                except requests.exceptions.Timeout:
+                    if attempt < max_retries - 1:
+                        self.log(f"⏱️ Timeout ({names}), retry...")
+                        time.sleep(2)
+                    else:
+                        self.log(f"❌ Timeout sau {max_retries} lần thử: {names}")
+                except requests.exceptions.ConnectionError:
+                    self.log(f"❌ Không kết nối được server: {names}")
+                    break
         except Exception as e:
             self.log(f"❌ ERROR gửi app status: {str(e)}")
 
@@ -1033,6 +1055,9 @@ class VmixMonitorGUI:
         last_ip_check = datetime.now(VIETNAM_TZ)
         wan_refresh_sec = 30  # Refresh WAN IP every 30 seconds
         ip_check_sec = 5  # Check local IP every 5 seconds
+        last_heartbeat = datetime.now(VIETNAM_TZ)
+        heartbeat_sec = 20  # Gửi lại trạng thái mỗi 20 giây để server biết app còn chạy
+        heartbeat_timeout = 60  # Server auto-OFF nếu quá 60 giây không nhận được gì
         
         self.log(f"Bắt đầu giám sát {len(self.port_list)} port(s)...")
         
@@ -1053,27 +1078,25 @@ class VmixMonitorGUI:
                         entry['ip'] = new_local_ip
                     # Update table display
                     self.root.after(0, self.update_table_display)
-                    # GỬI NGAY data mới lên server với IP mới
-                    for entry in self.port_list:
-                        port = entry['port']
-                        name = entry['name']
-                        current_status = "ON" if self.is_vmix_on_port(port) else "OFF"
-                        try:
-                            data = {
-                                "name": name,
-                                "ip": new_local_ip,
-                                "ipwan": wan_ip,
-                                "status": current_status,
-                                "port": port,
-                                "statusapp": 1
-                            }
-                            url = "https://tooldiscordvmix.onrender.com"
-                            headers = {"Content-Type": "application/json"}
-                            response = requests.post(url, json=data, headers=headers, timeout=10)
-                            if response.status_code == 200:
-                                self.log(f"✅ Đã cập nhật IP mới: {name}")
-                        except Exception as e:
-                            self.log(f"❌ Lỗi update IP: {name}")
+                    # GỬI NGAY data mới lên server với IP mới (một request cho tất cả port)
+                    entries = [
+                        {
+                            "name": entry['name'],
+                            "ip": new_local_ip,
+                            "ipwan": wan_ip,
+                            "status": "ON" if self.is_vmix_on_port(entry['port']) else "OFF",
+                            "port": entry['port'],
+                            "statusapp": 1
+                        }
+                        for entry in self.port_list
+                    ]
+                    try:
+                        response = self.post_batch(entries, timeout=10)
+                        if response.status_code == 200:
+                            for entry in entries:
+                                self.log(f"✅ Đã cập nhật IP mới: {entry['name']}")
+                    except Exception as e:
+                        self.log(f"❌ Lỗi update IP: {', '.join(entry['name'] for entry in entries)}")
                 last_ip_check = now
             
             # Check if WAN IP needs refresh
@@ -1087,71 +1110,80 @@ class VmixMonitorGUI:
                         entry['ipwan'] = new_wan
                     # Update table display
                     self.root.after(0, self.update_table_display)
-                    # GỬI NGAY data mới lên server với IPWAN mới
-                    for entry in self.port_list:
-                        port = entry['port']
-                        name = entry['name']
-                        current_status = "ON" if self.is_vmix_on_port(port) else "OFF"
-                        try:
-                            data = {
-                                "name": name,
-                                "ip": ip,
-                                "ipwan": new_wan,
-                                "status": current_status,
-                                "port": port,
-                                "statusapp": 1
-                            }
-                            url = "https://tooldiscordvmix.onrender.com"
-                            headers = {"Content-Type": "application/json"}
-                            response = requests.post(url, json=data, headers=headers, timeout=10)
-                            if response.status_code == 200:
-                                self.log(f"✅ Đã cập nhật IPWAN mới: {name}")
-                        except Exception as e:
-                            self.log(f"❌ Lỗi update IPWAN: {name}")
+                    # GỬI NGAY data mới lên server với IPWAN mới (một request cho tất cả port)
+                    entries = [
+                        {
+                            "name": entry['name'],
+                            "ip": ip,
+                            "ipwan": new_wan,
+                            "status": "ON" if self.is_vmix_on_port(entry['port']) else "OFF",
+                            "port": entry['port'],
+                            "statusapp": 1
+                        }
+                        for entry in self.port_list
+                    ]
+                    try:
+                        response = self.post_batch(entries, timeout=10)
+                        if response.status_code == 200:
+                            for entry in entries:
+                                self.log(f"✅ Đã cập nhật IPWAN mới: {entry['name']}")
+                    except Exception as e:
+                        self.log(f"❌ Lỗi update IPWAN: {', '.join(entry['name'] for entry in entries)}")
                 last_wan_check = now
             
-            # Check each port
+            # Check each port - chỉ gửi những port có thay đổi trạng thái hoặc lần đầu tiên,
+            # tới hạn heartbeat thì gửi lại tất cả port
+            heartbeat_due = (now - last_heartbeat).total_seconds() >= heartbeat_sec
+            entries = []
+            changed_ports = set()
             for entry in self.port_list:
                 port = entry['port']
-                name = entry['name']
                 
                 # Kiểm tra trạng thái thực tế của vMix
                 vmix_running = self.is_vmix_on_port(port)
                 current_status = "ON" if vmix_running else "OFF"
                 
-                # Chỉ gửi khi có thay đổi trạng thái hoặc lần đầu tiên
                 if prev_status.get(port) != current_status:
-                    try:
-                        data = {
-                            "name": name,
-                            "ip": ip,
-                            "ipwan": wan_ip,
-                            "status": current_status,
-                            "port": port,
-                            "statusapp": 1  # App is running (1=ON)
-                        }
-                        url = "https://tooldiscordvmix.onrender.com"
-                        headers = {"Content-Type": "application/json"}
-                        response = requests.post(url, json=data, headers=headers, timeout=15)
-                        if response.status_code == 200:
-                            icon = "🟢" if current_status == "ON" else "🔴"
-                            self.log(f"{icon} SRT {current_status}: {name} {ip}:{port}")
-                            prev_status[port] = current_status
-                        elif response.status_code == 500:
-                            error_msg = ""
-                            try:
-                                error_msg = response.json().get('detail', response.text[:100])
-                            except:
-                                error_msg = response.text[:100]
-                            self.log(f"⚠️ Server error 500 ({name}): {error_msg}")
-                        else:
-                            self.log(f"❌ HTTP {response.status_code} gửi {name}")
-                    except requests.exceptions.Timeout:
-                        self.log(f"⏱️ Timeout gửi {name}")
-                    except requests.exceptions.ConnectionError:
-                        self.log(f"❌ Mất kết nối ({name})")
-                    except Exception as e:
-                        self.log(f"❌ ERROR {name}: {str(e)}")
+                    changed_ports.add(port)
+                if port in changed_ports or heartbeat_due:
+                    entries.append({
+                        "name": entry['name'],
+                        "ip": ip,
+                        "ipwan": wan_ip,
+                        "status": current_status,
+                        "port": port,
+                        "statusapp": 1,  # App is running (1=ON)
+                        "heartbeat_timeout": heartbeat_timeout
+                    })
+            
+            # Gửi tất cả thay đổi (và heartbeat) trong một request
+            if entries:
+                names = ", ".join(data['name'] for data in entries)
+                try:
+                    response = self.post_batch(entries, timeout=15)
+                    if response.status_code == 200:
+                        last_heartbeat = now
+                        for data in entries:
+                            if data['port'] not in changed_ports:
+                                continue
+                            icon = "🟢" if data['status'] == "ON" else "🔴"
+                            self.log(f"{icon} SRT {data['status']}: {data['name']} {ip}:{data['port']}")
+                            prev_status[data['port']] = data['status']
+                    elif response.status_code == 500:
+                        error_msg = ""
+                        try:
+                            error_msg = response.json().get('detail', response.text[:100])
+                        except:
+                            error_msg = response.text[:100]
+                        self.log(f"⚠️ Server error 500 ({names}): {error_msg}")
+                    else:
+                        self.log(f"❌ HTTP {response.status_code} gửi {names}")
+                except requests.exceptions.Timeout:
+                    self.log(f"⏱️ Timeout gửi {names}")
+                except requests.exceptions.ConnectionError:
+                    self.log(f"❌ Mất kết nối ({names})")
+                except Exception as e:
+                    self.log(f"❌ ERROR {names}: {str(e)}")
             
             # Sleep 1 second (check every second)
             for _ in range(10):